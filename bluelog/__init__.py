@@ -10,6 +10,7 @@
 
 
 import os
+import json
 import click
 from flask import Flask, request, render_template
 from bluelog.settings import config
@@ -17,17 +18,34 @@ from bluelog.blueprints.admin import admin_bp
 from bluelog.blueprints.auth import auth_bp
 from bluelog.blueprints.blog import blog_bp
 from bluelog.extensions import bootstrap, ckeditor, mail, moment, db, login_manager, csrf
-from bluelog.models import Admin, Category, Link, Post, Comment, Reply
+from bluelog.caching import site_cache, page_cache
+from bluelog.export import SiteExporter, auto_exporter
+from bluelog.profiler import profiler, summarize, load_records
+from bluelog.benchmark import TIERS, Benchmark, ConcurrencyBenchmark, compare
+from bluelog.search import search_index
+from bluelog.emails import outbox
+from bluelog.uploads import image_store
+from bluelog.assets import assets
+from bluelog.compression import compress
+from bluelog.feeds import feeds
+from bluelog.sitemaps import sitemaps
+from bluelog.streaming import stream_flush
+from bluelog.migrations import upgrade, pending, check_query_plans
+from bluelog.signals import site_changed, site_info_changed
+from bluelog.models import Admin, Category, rebuild_counters, rebuild_post_summaries
 from flask_login import current_user
 from flask_wtf.csrf import CSRFError
 
 
-def create_app(config_name=None):
+def create_app(config_name=None, overrides=None):
     if config_name is None:
         config_name = os.getenv('FLASK_CONFIG', 'development')
 
     app = Flask('bluelog')
     app.config.from_object(config[config_name])
+    app.config['BLUELOG_CONFIG_NAME'] = config_name
+    if overrides:
+        app.config.update(overrides)
 
     register_blueprint(app)  # 注册篮本
     register_extensions(app)    # 注册扩展
@@ -35,7 +53,6 @@ def create_app(config_name=None):
     register_template_context(app)  # 注册模板上下文
     register_errors(app)    # 注册错误页
     register_commands(app)  # 注册shell命令
-    register_template_filter(app)  # 注册模板filter
 
     return app
 
@@ -54,6 +71,17 @@ def register_extensions(app):
     login_manager.init_app(app)
     csrf.init_app(app)
     moment.init_app(app)
+    site_cache.init_app(app)
+    page_cache.init_app(app)
+    auto_exporter.init_app(app)
+    profiler.init_app(app)
+    search_index.init_app(app)
+    outbox.init_app(app)
+    image_store.init_app(app)
+    assets.init_app(app)
+    feeds.init_app(app)
+    sitemaps.init_app(app)
+    compress.init_app(app)
 
 
 def register_shell_context(app):
@@ -63,43 +91,24 @@ def register_shell_context(app):
 
 
 def register_template_context(app):
+    app.add_template_global(stream_flush)
+
     @app.context_processor
     def make_context_template():
-        admin = Admin.query.first()
-        categories = Category.query.order_by(Category.name).all()
-        links = Link.query.order_by(Link.name).all()
+        context = site_cache.get(app)
 
         if current_user.is_authenticated:
-            unread_comments = Comment.query.filter_by(reviewed=False).count()
+            unread_comments = current_user.unread_comment_count
         else:
             unread_comments = None
         return dict(
-            admin=admin,
-            categories=categories,
-            links=links,
+            admin=context['admin'],
+            categories=context['categories'],
+            links=context['links'],
             unread_comments=unread_comments
         )
 
 
-def register_template_filter(app):
-    @app.template_filter()
-    def _replies(comment):
-        replies = Reply.query.with_parent(comment).filter_by(reviewed=True).all()
-        return replies
-
-    @app.template_filter()
-    def reviewed(comments):
-        num = 0
-        for comment in comments:
-            if comment.reviewed:
-                num += 1
-        return num
-
-    @app.template_filter()
-    def reply_sort(replies):
-        return sorted(replies, key=lambda x: x.timestamp, reverse=False)
-
-
 def register_errors(app):
     @app.errorhandler(400)
     def bad_request(e):
@@ -127,7 +136,9 @@ def register_commands(app):
             click.confirm('This operation will delete the database, do you want to continue?', abort=True)
             db.drop_all()
             click.echo('Drop tables.')
-        db.create_all()
+        upgrade(echo=click.echo)
+        site_changed.send(app)
+        site_info_changed.send(app)
         click.echo('Initialized database.')
 
     @app.cli.command()
@@ -137,7 +148,7 @@ def register_commands(app):
     def init(username, password):
         """Building Bluelog just for you."""
         click.echo('Initializing the database...')
-        db.create_all()
+        upgrade(echo=click.echo)
 
         admin = Admin.query.first()
         if admin is not None:
@@ -162,6 +173,8 @@ def register_commands(app):
             db.session.add(category)
 
         db.session.commit()
+        site_changed.send(app)
+        site_info_changed.send(app)
         click.echo('Done.')
 
     @app.cli.command()
@@ -169,28 +182,157 @@ def register_commands(app):
     @click.option('--post', default=50, help='Quantity of posts, default is 50.')
     @click.option('--comment', default=500, help='Quantity of comments, default is 500.')
     @click.option('--reply', default=200, help='Quantity of reply, default is 200')
-    def forge(category, post, comment, reply):
+    @click.option('--seed', type=int, help='Random seed, the same seed generates the same data.')
+    @click.option('--workers', type=int, help='Run Faker in this many processes.')
+    def forge(category, post, comment, reply, seed, workers):
         """Generates the fake categories, posts, and comments."""
-        from bluelog.fakes import fake_categories, fake_posts, fake_comments, fake_reply, fake_admin, fake_link
+        from bluelog.fakes import fake_all
 
-        db.drop_all()
-        db.create_all()
+        fake_all(category, post, comment, reply, echo=click.echo, seed=seed, workers=workers)
+        site_changed.send(app)
+        site_info_changed.send(app)
 
-        click.echo('Generating the administrator')
-        fake_admin()
+        click.echo('Done.')
 
-        click.echo('Generating %d categories...' % category)
-        fake_categories(category)
+    @app.cli.command()
+    def recount():
+        """Rebuild the comment, reply and post counters and the post summaries."""
+        rebuild_counters()
+        rebuild_post_summaries()
+        site_changed.send(app)
+        site_info_changed.send(app)
+        click.echo('Done.')
 
-        click.echo('Generating %d posts...' % post)
-        fake_posts(post)
-        click.echo('Generating %d comments... '% comment)
-        fake_comments(comment)
-        click.echo('Generating %d reply...' % reply)
-        fake_reply(reply)
+    @app.cli.command()
+    @click.option('--list', 'show', is_flag=True, help='Only list the pending migrations.')
+    def migrate(show):
+        """Create missing tables and apply the pending migrations."""
+        if show:
+            for version, func in pending():
+                click.echo('%s: %s' % (version, func.__doc__))
+            return
+        versions = upgrade(echo=click.echo)
+        click.echo('Applied %d migrations.' % len(versions))
 
-        click.echo('Generating the links')
-        fake_link()
+    @app.cli.command()
+    @click.option('--verbose', is_flag=True, help='Print the plan of every query.')
+    def explain(verbose):
+        """Check that the hot queries use indexes (SQLite only)."""
+        failed = False
+        for name, plan, scans in check_query_plans():
+            click.echo('%-22s %s' % (name, 'FULL SCAN' if scans else 'ok'))
+            for step in plan if verbose else scans:
+                click.echo('    %s' % step)
+            failed = failed or bool(scans)
+        if failed:
+            raise SystemExit(1)
+
+    @app.cli.command('send-mail')
+    @click.option('--flush', is_flag=True, help='Also send the digests still waiting for their window.')
+    def send_mail(flush):
+        """Send the due messages in the mail outbox."""
+        sent = outbox.flush(app) if flush else outbox.send_all(app)
+        click.echo('Sent %d messages.' % sent)
 
+    @app.cli.command()
+    def reindex():
+        """Rebuild the full-text search index."""
+        # 旧数据库里还没有索引表
+        db.create_all()
+        search_index.reindex(app, echo=click.echo)
         click.echo('Done.')
 
+    @app.cli.command()
+    @click.option('--output', help='Output directory, default is BLUELOG_EXPORT_PATH.')
+    @click.option('--theme', multiple=True, help='Theme to export, default is every theme in THEME.')
+    @click.option('--workers', type=int, help='Render processes, default is the number of CPUs.')
+    @click.option('--incremental', is_flag=True, help='Only render pages changed since the last export.')
+    def export(output, theme, workers, incremental):
+        """Export the public pages as static HTML."""
+        output = output or app.config['BLUELOG_EXPORT_PATH']
+        exporter = SiteExporter(app, output, themes=list(theme) or None, workers=workers)
+        rendered, skipped = exporter.export(incremental=incremental, echo=click.echo)
+        click.echo('Exported %d pages (%d unchanged) to %s.' % (rendered, skipped, output))
+
+    @app.cli.group('assets')
+    def assets_group():
+        """Build the static assets."""
+
+    @assets_group.command()
+    def build():
+        """Bundle, minify, fingerprint and precompress CSS and JS."""
+        files = assets.build(app, echo=click.echo)
+        click.echo('Built %d assets, manifest: %s' % (len(files), app.config['BLUELOG_ASSETS_MANIFEST']))
+
+    @app.cli.command()
+    @click.option('--base-url', help='Site URL used in the sitemaps, defaults to BLUELOG_SITE_URL.')
+    def sitemap(base_url):
+        """Rebuild sitemap.xml and all child sitemaps."""
+        try:
+            shards = sitemaps.rebuild(app, base_url)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        click.echo('Built %d sitemaps in %s.' % (len(shards), app.config['BLUELOG_SITEMAP_PATH']))
+
+    @app.cli.command()
+    @click.option('--tier', type=click.Choice(sorted(TIERS)), default='10k', help='Dataset size, default is 10k.')
+    @click.option('--requests', 'total', default=2000, help='Scenarios to run, default is 2000.')
+    @click.option('--warmup', default=100, help='Scenarios to run before measuring, default is 100.')
+    @click.option('--seed', default=42, help='Random seed of the dataset and the request mix.')
+    @click.option('--database', help='Database URI, default is bench-<tier>.db in the project directory.')
+    @click.option('--reuse', is_flag=True, help='Reuse the forged database if it has data.')
+    @click.option('--workers', type=int, help='Processes used to forge the dataset.')
+    @click.option('--page-cache', type=click.Choice(['memory', 'filesystem']), help='Enable the page cache.')
+    @click.option('--output', help='Write the JSON result to this file.')
+    @click.option('--baseline', help='Compare with a previous JSON result.')
+    @click.option('--tolerance', default=0.2, help='Allowed p95/throughput regression, default is 0.2.')
+    @click.option('--concurrency', type=int, multiple=True,
+                  help='Also compare WSGI and ASGI read throughput at this many concurrent clients.')
+    @click.option('--threads', default=4, help='Server threads of both modes in the concurrency comparison.')
+    def bench(tier, total, warmup, seed, database, reuse, workers, page_cache, output, baseline, tolerance,
+              concurrency, threads):
+        """Benchmark the app on a forged dataset."""
+        benchmark = Benchmark(tier, database=database, seed=seed, page_cache=page_cache)
+        click.echo('Preparing the %s dataset...' % tier, err=True)
+        benchmark.prepare(reuse=reuse, workers=workers, echo=lambda message: click.echo(message, err=True))
+        result = benchmark.run(total, warmup=warmup, echo=lambda message: click.echo(message, err=True))
+        if concurrency:
+            click.echo('Comparing WSGI and ASGI at %s concurrent clients...' % ', '.join(map(str, concurrency)),
+                       err=True)
+            result['concurrency'] = ConcurrencyBenchmark(benchmark.app, benchmark.dataset, threads, seed).run(
+                concurrency, total)
+
+        data = json.dumps(result, indent=2, sort_keys=True)
+        if output:
+            with open(output, 'w') as f:
+                f.write(data + '\n')
+        else:
+            click.echo(data)
+
+        if baseline:
+            with open(baseline) as f:
+                regressions = compare(result, json.load(f), tolerance)
+            for regression in regressions:
+                click.echo('Regression: %s' % regression, err=True)
+            if regressions:
+                raise SystemExit(1)
+            click.echo('No regressions against %s.' % baseline, err=True)
+
+    @app.cli.command('profile-report')
+    @click.option('--log', help='Profile log file, default is BLUELOG_PROFILE_LOG.')
+    @click.option('--json', 'as_json', is_flag=True, help='Print the report as JSON.')
+    def profile_report(log, as_json):
+        """Summarize the recorded request profiles per endpoint."""
+        log = log or app.config['BLUELOG_PROFILE_LOG']
+        if not log:
+            raise click.UsageError('Set BLUELOG_PROFILE_LOG or pass --log.')
+        summary = summarize(load_records(log))
+        if as_json:
+            click.echo(json.dumps(summary, indent=2))
+            return
+        click.echo('%-28s %7s %9s %9s %9s %9s' % ('endpoint', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+        for endpoint, item in sorted(summary.items()):
+            click.echo('%-28s %7d %9.1f %9.1f %9.1f %9.1f' % (
+                endpoint, item['requests'], item['p50'], item['p95'], item['p99'], item['queries_avg']))
+            for statement in item['repeated']:
+                click.echo('    N+1? x%d %s' % (statement['count'], statement['statement'][:100]))
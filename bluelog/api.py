@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import json
+
+from flask import request, current_app, url_for, abort
+
+from bluelog.extensions import db
+from bluelog.models import Post, Category, Comment, Reply
+from bluelog.pagination import KeysetPagination
+
+# 只读 JSON 接口: 查询只取需要的列, 不构造 ORM 对象, 结果直接序列化为紧凑的 JSON
+
+COMMENT_COLUMNS = (Comment.id, Comment.author, Comment.site, Comment.body, Comment.timestamp, Comment.from_admin)
+REPLY_COLUMNS = (Reply.id, Reply.comment_id, Reply.author, Reply.site, Reply.body, Reply.timestamp,
+                 Reply.from_admin)
+POST_COLUMNS = (Post.id, Post.title, Post.excerpt, Post.timestamp, Post.category_id, Category.name.label('category'),
+                Post.reviewed_comment_count, Post.reply_count)
+
+
+def _time(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ') if value else None
+
+
+def _limit(default):
+    limit = request.args.get('limit', current_app.config[default], type=int)
+    return max(1, min(limit, current_app.config['BLUELOG_API_MAX_PAGE_SIZE']))
+
+
+def _page(pagination, serialize):
+    return dict(items=[serialize(row) for row in pagination.items],
+                prev=pagination.prev_url, next=pagination.next_url)
+
+
+def _comment(row):
+    return dict(id=row.id, author=row.author, site=row.site, body=row.body,
+                timestamp=_time(row.timestamp), from_admin=row.from_admin)
+
+
+def _post(row):
+    return dict(id=row.id, title=row.title, excerpt=row.excerpt, timestamp=_time(row.timestamp),
+                category=dict(id=row.category_id, name=row.category),
+                comments=row.reviewed_comment_count, replies=row.reply_count,
+                url=url_for('blog.show_post', post_id=row.id))
+
+
+def comment_page(post):
+    """文章已审核的评论, 按时间正序的游标分页 (?after= / ?before=)"""
+    query = db.session.query(*COMMENT_COLUMNS).filter(Comment.post_id == post.id, Comment.reviewed == True)
+    pagination = KeysetPagination(query, Comment.timestamp, Comment.id, _limit('BLUELOG_COMMENT_PRE_PAGE'),
+                                  after=request.args.get('after'), before=request.args.get('before'),
+                                  descending=False)
+    return _page(pagination, _comment)
+
+
+def reply_ids():
+    """?ids=1,2,3 中的评论 id, 数量超过 BLUELOG_API_MAX_PAGE_SIZE 或格式不对时返回 400"""
+    try:
+        ids = sorted(set(int(ident) for ident in request.args.get('ids', '').split(',') if ident.strip()))
+    except ValueError:
+        abort(400)
+    if not ids or len(ids) > current_app.config['BLUELOG_API_MAX_PAGE_SIZE']:
+        abort(400)
+    return ids
+
+
+def reply_map(ids):
+    """{评论 id: [回复]}, 只包含已审核评论的已审核回复"""
+    replies = {}
+    rows = db.session.query(*REPLY_COLUMNS).join(Comment, Comment.id == Reply.comment_id).filter(
+        Reply.comment_id.in_(ids), Reply.reviewed == True, Comment.reviewed == True).order_by(
+        Reply.timestamp.asc(), Reply.id.asc())
+    for row in rows:
+        replies.setdefault(str(row.comment_id), []).append(_comment(row))
+    return dict(replies=replies)
+
+
+def post_page(category=None):
+    """文章列表, 按时间倒序的游标分页; category 为 None 时是全部文章"""
+    query = db.session.query(*POST_COLUMNS).outerjoin(Category, Category.id == Post.category_id)
+    if category is not None:
+        query = query.filter(Post.category_id == category.id)
+    pagination = KeysetPagination(query, Post.timestamp, Post.id, _limit('BLUELOG_POST_PER_PAGE'),
+                                  after=request.args.get('after'), before=request.args.get('before'))
+    return _page(pagination, _post)
+
+
+def json_response(data):
+    return current_app.response_class(json.dumps(data, ensure_ascii=False, separators=(',', ':')),
+                                      mimetype='application/json')
@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import io
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import jinja2.asyncsupport  # noqa: 为模板加上 render_async
+
+from flask import request, g
+from flask.signals import before_render_template, template_rendered, request_started, request_finished
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Request
+
+from bluelog.extensions import db
+from bluelog.models import Post, Comment, Reply, Category
+from bluelog.caching import site_cache
+from bluelog.compression import CompressMiddleware
+from bluelog.pagination import paginate
+from bluelog.conditional import not_modified, with_validators, post_validators, listing_validators, \
+    site_validators
+from bluelog.forms import anonymous_comment_form
+
+
+def build_environ(scope, body):
+    """ASGI 的 HTTP scope 转换成 WSGI environ"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('127.0.0.1', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    # 请求体已经完整读出 (分块传输时没有 Content-Length)
+    if body:
+        environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+# environ 中保存请求开始时 g 上的值 (例如 Profiler 的记录), 之后推入的每个上下文都恢复它们
+_G_KEY = 'bluelog.asgi.g'
+
+
+class AsyncBlog(object):
+    """可选的 ASGI 部署入口, 例如: uvicorn --factory bluelog.asgi:create_asgi_app
+
+    匿名读者对 index / show_post / show_category / about 的 GET 请求走异步读路径:
+    互不依赖的查询 (文章、评论页、侧边栏上下文) 同时提交给数据库线程池, 模板使用 Jinja 的异步渲染.
+    其他请求 (表单提交、后台、带登录状态或闪现消息的请求) 以及开启了整页缓存时, 通过同一个线程池交给原来的 WSGI 应用处理.
+
+    Flask 1.1 的请求上下文按线程区分, 所以每次查询都在线程池里推入自己的上下文, 查询完即关闭会话,
+    返回已加载好的对象 (模板用到的关系都用 joinedload 预先加载); 事件循环线程只在渲染时短暂推入上下文, 渲染期间不会让出.
+    异步路径出错 (包括访问未加载的属性时的 DetachedInstanceError) 时记录日志, 再交给 WSGI 应用重新处理.
+    请求开始时发送 request_started, 响应经过 process_response (after_request 钩子、保存会话) 后发送
+    request_finished, 所以 Profiler 同样会记录异步路径的请求 (包括线程池中的查询); 开启 BLUELOG_COMPRESS 时
+    响应与 WSGI 路径一样经过 CompressMiddleware. before_request 钩子只有整页缓存使用, 开启整页缓存时全部走 WSGI.
+    SQLAlchemy 1.3 没有 asyncio 接口, 查询本身仍在线程中同步执行.
+    """
+
+    def __init__(self, app, workers=None):
+        self.app = app
+        self.executor = ThreadPoolExecutor(workers or app.config.get('BLUELOG_ASGI_WORKERS', 4))
+        # Jinja 2.11 的 overlay() 不接受 enable_async, 使用独立的模板缓存并打开异步模式
+        self.jinja_env = app.jinja_env.overlay(cache_size=400)
+        self.jinja_env.is_async = True
+        self.handlers = {
+            'blog.index': self.index,
+            'blog.show_post': self.show_post,
+            'blog.show_category': self.show_category,
+            'blog.about': self.about,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise RuntimeError('Unsupported ASGI scope: %s' % scope['type'])
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        environ = build_environ(scope, body)
+
+        response = None
+        route = self._match(environ)
+        if route is not None:
+            handler, view_args = route
+            environ[_G_KEY] = self._start(environ)
+            try:
+                response = await handler(environ, **view_args)
+            except HTTPException:
+                # 404 等错误页交给 WSGI 应用渲染
+                response = None
+            except Exception:
+                self.app.logger.exception('Async view failed, falling back to WSGI: %s', environ['PATH_INFO'])
+                response = None
+        if response is None:
+            status, headers, data = await self._run(self._wsgi, environ)
+        else:
+            # 响应对象本身就是 WSGI 应用, 与 WSGI 路径一样交给压缩中间件
+            wsgi_app = CompressMiddleware(response, self.app.config) if self.app.config['BLUELOG_COMPRESS'] else response
+            status, headers, data = self._wsgi(environ, wsgi_app)
+
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+        await send({'type': 'http.response.body', 'body': data if scope['method'] != 'HEAD' else b''})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _match(self, environ):
+        app = self.app
+        if environ['REQUEST_METHOD'] != 'GET' or 'page_cache' in app.extensions:
+            return None
+        req = Request(environ)
+        # 与整页缓存相同: 已登录、记住登录或有待显示闪现消息的请求走 WSGI
+        if app.config.get('REMEMBER_COOKIE_NAME', 'remember_token') in req.cookies:
+            return None
+        if app.session_cookie_name in req.cookies:
+            session = app.session_interface.open_session(app, req)
+            if session is not None and ('_user_id' in session or '_flashes' in session):
+                return None
+        try:
+            endpoint, view_args = app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+        if endpoint not in self.handlers:
+            return None
+        return self.handlers[endpoint], view_args
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _wsgi(self, environ, wsgi_app=None):
+        result = {}
+
+        def start_response(status, headers, exc_info=None):
+            result['status'] = int(status.split(' ', 1)[0])
+            result['headers'] = headers
+
+        iterable = (wsgi_app or self.app)(environ, start_response)
+        try:
+            data = b''.join(iterable)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        return result['status'], result['headers'], data
+
+    def _query(self, environ, func, *args):
+        """在线程池中带着请求上下文执行 func, 返回前关闭会话 (已加载的属性仍然可用)"""
+        def call():
+            # 每个上下文使用自己的 environ 副本, Request 会往 environ 里写入缓存
+            with self.app.request_context(dict(environ)):
+                _restore_g(environ)
+                try:
+                    return func(*args)
+                finally:
+                    db.session.remove()
+        return self._run(call)
+
+    async def _render(self, environ, validators, template_name, make_form=None, **context):
+        """渲染模板; make_form 在渲染用的上下文中创建表单, 表单生成的 CSRF 令牌随这个上下文的会话一起保存"""
+        app = self.app
+        with app.request_context(dict(environ)):
+            _restore_g(environ)
+            response = not_modified(validators)
+            if response is not None:
+                return self._finish(response)
+            if make_form is not None:
+                context['form'] = make_form()
+            template = self.jinja_env.get_template(template_name)
+            app.update_template_context(context)
+            before_render_template.send(app, template=template, context=context)
+            html = await template.render_async(context)
+            template_rendered.send(app, template=template, context=context)
+            return self._finish(with_validators(html, validators))
+
+    def _start(self, environ):
+        """发送 request_started, 返回此时 g 上的值"""
+        with self.app.request_context(dict(environ)):
+            request_started.send(self.app)
+            return dict(vars(g))
+
+    def _finish(self, response):
+        # 与 Flask.full_dispatch_request 相同: 执行 after_request 钩子并保存会话, 再发送 request_finished
+        response = self.app.process_response(response)
+        request_finished.send(self.app, response=response)
+        return response
+
+    # ---- 各个读视图: 先并发查询, 再渲染 ----
+
+    def _listing(self, category_id=None):
+        query = Post.listing()
+        if category_id is not None:
+            query = query.filter(Post.category_id == category_id)
+        pagination = paginate(query, Post.timestamp, Post.id, self.app.config['BLUELOG_POST_PER_PAGE'])
+        if getattr(pagination, 'keyset', False):
+            # 翻页链接需要请求上下文, 在这里先生成
+            pagination.prev_url, pagination.next_url
+        return pagination
+
+    async def index(self, environ):
+        validators, pagination, _ = await asyncio.gather(
+            self._query(environ, listing_validators),
+            self._query(environ, self._listing),
+            self._query(environ, site_cache.get, self.app))
+        return await self._render(environ, validators, 'blog/index.html',
+                                  pagination=pagination, posts=pagination.items)
+
+    async def about(self, environ):
+        validators = await self._query(environ, site_validators)
+        return await self._render(environ, validators, 'blog/about.html')
+
+    async def show_category(self, environ, category_id):
+        def load_category():
+            category = Category.query.get_or_404(category_id)
+            return category, listing_validators(category)
+
+        (category, validators), pagination, _ = await asyncio.gather(
+            self._query(environ, load_category),
+            self._query(environ, self._listing, category_id),
+            self._query(environ, site_cache.get, self.app))
+        return await self._render(environ, validators, 'blog/category.html',
+                                  category=category, pagination=pagination, posts=pagination.items)
+
+    async def show_post(self, environ, post_id):
+        def load_post():
+            post = Post.query.options(db.joinedload(Post.category)).get(post_id)
+            if post is None:
+                return None, None
+            return post, post_validators(post)
+
+        def load_comments():
+            page = request.args.get('page', 1, type=int)
+            pagination = Comment.query.filter_by(post_id=post_id, reviewed=True).order_by(
+                Comment.timestamp.asc()).paginate(page=page, per_page=self.app.config['BLUELOG_COMMENT_PRE_PAGE'])
+            replies = {}
+            if pagination.items:
+                for reply in Reply.query.filter(
+                        Reply.comment_id.in_([comment.id for comment in pagination.items]),
+                        Reply.reviewed == True).order_by(Reply.timestamp.asc()):
+                    replies.setdefault(reply.comment_id, []).append(reply)
+            return pagination, replies
+
+        # 文章不存在时交给 WSGI 渲染 404, 不必再查询评论和侧边栏
+        post, validators = await self._query(environ, load_post)
+        if post is None:
+            return None
+        (pagination, replies), _ = await asyncio.gather(
+            self._query(environ, load_comments),
+            self._query(environ, site_cache.get, self.app))
+        return await self._render(environ, validators, 'blog/post.html', make_form=anonymous_comment_form,
+                                  post=post, comments=pagination.items, replies=replies, pagination=pagination)
+
+
+def _restore_g(environ):
+    for name, value in environ.get(_G_KEY, {}).items():
+        setattr(g, name, value)
+
+
+def create_asgi_app(config_name=None, workers=None):
+    from bluelog import create_app
+    return AsyncBlog(create_app(config_name), workers)
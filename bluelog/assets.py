@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import io
+import os
+import re
+import gzip
+import json
+import hashlib
+import mimetypes
+
+from flask import current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # 没有 brotli 时只生成 .gz
+    brotli = None
+
+# 没有 theme cookie 时使用的主题
+DEFAULT_THEME = 'perfect_blue'
+
+# 打包后的文件 -> 源文件, {theme} 对每个主题展开
+BUNDLES = {
+    'css/bundle-{theme}.css': ['css/{theme}.min.css', 'css/styles.css', 'css/animate.min.css', 'css/hover-min.css'],
+    'js/bundle.js': ['js/jquery-3.2.1.slim.min.js', 'js/popper.min.js', 'js/bootstrap.min.js', 'js/scripts.js',
+                     'js/typed.js@2.0.11'],
+}
+# 不打包、只加上哈希的文件 (ckeditor.js 按自己的文件名定位插件目录, 不能改名)
+FILES = ['logo.jpg', 'js/moment-with-locales.js']
+# 值得预压缩的类型
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_css_comment_re = re.compile(r'/\*(?!!).*?\*/', re.S)
+_css_space_re = re.compile(r'\s+')
+_css_punct_re = re.compile(r'\s*([{};,])\s*')
+
+
+def current_theme():
+    """theme cookie 中的主题, 不在 THEME 里时使用默认主题"""
+    theme = request.cookies.get('theme')
+    return theme if theme in current_app.config['THEME'].values() else DEFAULT_THEME
+
+
+def minify_css(text):
+    """保守的 CSS 压缩: 去掉注释 (保留 /*! */ 版权注释) 和多余的空白"""
+    text = _css_comment_re.sub('', text)
+    text = _css_space_re.sub(' ', text)
+    return _css_punct_re.sub(r'\1', text).strip()
+
+
+def _gzip(data):
+    # 固定 mtime, 同样的内容每次构建得到同样的 .gz
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def _hashed_name(name, data):
+    base, ext = os.path.splitext(name)
+    return '%s.%s%s' % (base, hashlib.sha256(data).hexdigest()[:12], ext)
+
+
+class Assets(object):
+    """静态资源: flask assets build 生成打包、压缩、带内容哈希的文件和 manifest.json
+
+    url_for('static', filename=...) 通过 manifest 换成带哈希的文件名; 这些文件永不变化, 返回 immutable 缓存头,
+    并按 Accept-Encoding 返回预压缩的 .br/.gz. 没有构建时退回到原始文件.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_ASSETS_MANIFEST', os.path.join(app.static_folder, 'manifest.json'))
+        self._activate(app, self.load(app))
+        app.url_defaults(self._url_defaults)
+        app.view_functions['static'] = self._send_static
+        app.add_template_global(current_theme)
+        app.add_template_global(self.bundle)
+
+    @staticmethod
+    def load(app):
+        """manifest.json: {"files": {源文件名: 带哈希的文件名}, "previous": [上一次构建的文件]}"""
+        try:
+            with open(app.config['BLUELOG_ASSETS_MANIFEST']) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    @staticmethod
+    def _activate(app, manifest):
+        files = manifest.get('files', {})
+        app.extensions['assets'] = dict(files=files, hashed=set(files.values()) | set(manifest.get('previous', ())))
+
+    # ---- 使用 ----
+
+    @staticmethod
+    def _url_defaults(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            files = current_app.extensions['assets']['files']
+            values['filename'] = files.get(values['filename'], values['filename'])
+
+    def bundle(self, name, theme=None):
+        """模板中使用: 已构建时返回打包文件, 否则返回各个源文件 (交给 url_for('static', ...))"""
+        target = name.replace('{theme}', theme) if theme else name
+        if target in current_app.extensions['assets']['files']:
+            return [target]
+        return [self._source(current_app, source.replace('{theme}', theme) if theme else source)
+                for source in BUNDLES[name]]
+
+    @staticmethod
+    def _source(app, name):
+        # 主题文件名的大小写不统一 (Journal.min.css)
+        directory, filename = os.path.split(name)
+        if not os.path.exists(os.path.join(app.static_folder, name)):
+            for candidate in os.listdir(os.path.join(app.static_folder, directory)):
+                if candidate.lower() == filename.lower():
+                    return '%s/%s' % (directory, candidate)
+        return name
+
+    @staticmethod
+    def _send_static(filename):
+        app = current_app._get_current_object()
+        if filename not in app.extensions['assets']['hashed']:
+            return app.send_static_file(filename)
+        accepted = request.accept_encodings
+        response = None
+        for encoding, suffix in ENCODINGS:
+            if accepted[encoding] and os.path.exists(os.path.join(app.static_folder, filename + suffix)):
+                response = send_from_directory(app.static_folder, filename + suffix)
+                response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                response.content_encoding = encoding
+                break
+        if response is None:
+            response = app.send_static_file(filename)
+        if os.path.splitext(filename)[1] in COMPRESSIBLE:
+            response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+        return response
+
+    # ---- 构建 ----
+
+    def build(self, app, echo=print):
+        """生成带哈希的文件及其 .gz/.br 并写入 manifest, 返回 {源文件名: 带哈希的文件名}
+
+        上一次构建的文件保留下来 (缓存中的旧页面还在引用它们), 更早的删除.
+        """
+        static = app.static_folder
+        outputs = {}
+        for name, sources in BUNDLES.items():
+            themes = sorted(set(app.config['THEME'].values())) if '{theme}' in name else [None]
+            for theme in themes:
+                target = name.replace('{theme}', theme) if theme else name
+                parts = []
+                for source in sources:
+                    source = self._source(app, source.replace('{theme}', theme) if theme else source)
+                    with open(os.path.join(static, source), encoding='utf-8') as f:
+                        parts.append(f.read())
+                if target.endswith('.css'):
+                    data = '\n'.join(minify_css(part) for part in parts)
+                else:
+                    # 源文件大多已经压缩过; 用 ; 分隔, 防止上一个文件没有以分号结尾
+                    data = '\n;'.join(part.strip() for part in parts)
+                outputs[target] = data.encode('utf-8')
+        for name in FILES:
+            with open(os.path.join(static, name), 'rb') as f:
+                outputs[name] = f.read()
+
+        old = self.load(app)
+        files = {}
+        for name, data in sorted(outputs.items()):
+            hashed = _hashed_name(name, data)
+            files[name] = hashed
+            self._write(os.path.join(static, hashed), data)
+            if os.path.splitext(name)[1] in COMPRESSIBLE:
+                self._write(os.path.join(static, hashed + '.gz'), _gzip(data))
+                if brotli is not None:
+                    self._write(os.path.join(static, hashed + '.br'), brotli.compress(data))
+            if echo:
+                echo('%s -> %s (%d bytes)' % (name, hashed, len(data)))
+        if brotli is None and echo:
+            echo('brotli is not installed, skipped the .br files.')
+
+        previous = set(old.get('files', {}).values())
+        current = set(files.values())
+        for hashed in set(old.get('previous', ())) - previous - current:
+            for suffix in ('', '.gz', '.br'):
+                path = os.path.join(static, hashed + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+        manifest = dict(files=files, previous=sorted(previous - current))
+        self._write(app.config['BLUELOG_ASSETS_MANIFEST'], json.dumps(manifest, indent=2, sort_keys=True).encode())
+        self._activate(app, manifest)
+        return files
+
+    @staticmethod
+    def _write(path, data):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+assets = Assets()
@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import os
+import re
+import sys
+import html
+import time
+import random
+import asyncio
+import platform
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from bluelog.extensions import db
+from bluelog.models import Category, Post, Comment, Reply
+from bluelog.migrations import upgrade
+from bluelog.profiler import Profiler, summarize, percentile
+from bluelog.settings import basedir, prefix
+
+# 数据规模: 按评论数命名
+TIERS = {
+    '10k': dict(category=20, post=1000, comment=10000, reply=2000),
+    '100k': dict(category=50, post=10000, comment=100000, reply=20000),
+    '1m': dict(category=100, post=100000, comment=1000000, reply=200000),
+}
+
+# 请求组合及权重
+SCENARIOS = (
+    ('index', 30),
+    ('category', 15),
+    ('post', 35),
+    ('comment', 10),
+    ('moderation', 10),
+)
+
+# 下一页链接: 游标分页的 ?after=, 或者评论分页 (?page=N) 中文字为 &raquo; 的链接
+_next_re = re.compile(r'href="([^"#]*[?&](?:amp;)?after=[^"#]*)|'
+                      r'href="\s*([^"#]*[?&](?:amp;)?page=\d+[^"#]*)(?:#[^"]*)?">(?:&raquo;|\xbb)</a>')
+_approve_re = re.compile(r'action="(/admin/manage/approve/\d+)[^"]*"')
+
+
+def database_uri(tier):
+    return prefix + os.path.join(basedir, 'bench-%s.db' % tier)
+
+
+def _next_url(response):
+    match = _next_re.search(response.get_data(as_text=True))
+    if match:
+        return html.unescape(match.group(1) or match.group(2))
+
+
+class Benchmark(object):
+    """在固定规模的数据集上压测真实的 WSGI 应用
+
+    数据由 fake_all 按种子生成, 请求通过测试客户端发出, 每个请求的耗时和查询次数来自 Profiler.
+    同一个种子在新生成的数据库上得到完全相同的请求序列; 使用 reuse 时, 上一次运行提交的评论会留在库里.
+    """
+
+    def __init__(self, tier='10k', database=None, seed=42, page_cache=None, config_name='production'):
+        from bluelog import create_app
+
+        self.tier = tier
+        self.seed = seed
+        self.config_name = config_name
+        self.app = create_app(config_name, dict(
+            SQLALCHEMY_DATABASE_URI=database or database_uri(tier),
+            BLUELOG_PROFILE=True,
+            BLUELOG_PROFILE_BUFFER=None,
+            BLUELOG_PROFILE_LOG=None,
+            BLUELOG_PAGE_CACHE=page_cache,
+            BLUELOG_SITE_STAMP=None,
+            BLUELOG_EXPORT_ON_WRITE=False,
+            WTF_CSRF_ENABLED=False,
+            MAIL_SUPPRESS_SEND=True,
+            BLUELOG_MAIL_WORKERS=0,
+        ))
+        self.dataset = {}
+
+    def prepare(self, reuse=False, workers=None, echo=print):
+        """生成数据集; reuse 时已有数据的库直接使用"""
+        from bluelog.fakes import fake_all
+
+        with self.app.app_context():
+            if not (reuse and db.engine.has_table('post') and Post.query.first() is not None):
+                fake_all(echo=echo, seed=self.seed, workers=workers, **TIERS[self.tier])
+            else:
+                # 旧的数据库可能缺少后来新增的表和索引
+                upgrade(echo=echo)
+            self.dataset = dict(
+                category=Category.query.count(),
+                post=Post.query.count(),
+                comment=Comment.query.count(),
+                reply=Reply.query.count(),
+            )
+        return self.dataset
+
+    def run(self, total=2000, warmup=100, echo=print):
+        """发出 warmup + total 个场景的请求, 只统计 total 部分"""
+        app = self.app
+        rng = random.Random(self.seed)
+        guest = app.test_client()
+        admin = app.test_client()
+        admin.post('/auth/login', data=dict(username='admin', password='helloflask'))
+
+        names = [name for name, _ in SCENARIOS]
+        weights = [weight for _, weight in SCENARIOS]
+        for i in range(warmup):
+            self._scenario(rng.choices(names, weights)[0], rng, guest, admin)
+        app.extensions['profiler']['records'].clear()
+
+        start = time.perf_counter()
+        for i in range(total):
+            self._scenario(rng.choices(names, weights)[0], rng, guest, admin)
+            if echo and (i + 1) % 500 == 0:
+                echo('%d/%d scenarios' % (i + 1, total))
+        elapsed = time.perf_counter() - start
+
+        records = Profiler.records(app)
+        endpoints = summarize(records)
+        errors = defaultdict(int)
+        for record in records:
+            if record['status'] >= 400:
+                errors[record['endpoint']] += 1
+        for endpoint, item in endpoints.items():
+            item['errors'] = errors[endpoint]
+            item['repeated'] = len(item['repeated'])
+
+        return dict(
+            tier=self.tier,
+            seed=self.seed,
+            config=self.config_name,
+            page_cache=app.config['BLUELOG_PAGE_CACHE'],
+            dataset=self.dataset,
+            scenarios=total,
+            requests=len(records),
+            elapsed=round(elapsed, 3),
+            throughput=round(len(records) / elapsed, 2) if elapsed else None,
+            endpoints=endpoints,
+            environment=dict(python=platform.python_version(), platform=sys.platform,
+                             database=db.get_engine(app).dialect.name),
+        )
+
+    def _hot(self, rng, count):
+        # 访问集中在少数热门文章上
+        return 1 + int(count * rng.random() ** 3)
+
+    def _scenario(self, name, rng, guest, admin):
+        dataset = self.dataset
+        if name == 'index':
+            response = guest.get('/')
+            # 翻页深度 0~3
+            for i in range(rng.randint(0, 3)):
+                url = _next_url(response)
+                if url is None:
+                    break
+                response = guest.get(url)
+        elif name == 'category':
+            response = guest.get('/show/category/%d' % rng.randint(1, dataset['category']))
+            for i in range(rng.randint(0, 2)):
+                url = _next_url(response)
+                if url is None:
+                    break
+                response = guest.get(url)
+        elif name == 'post':
+            response = guest.get('/show/post/%d' % self._hot(rng, dataset['post']))
+            if rng.random() < 0.2:
+                url = _next_url(response)
+                if url is not None:
+                    guest.get(url)
+        elif name == 'comment':
+            post_id = self._hot(rng, dataset['post'])
+            guest.post('/show/post/%d' % post_id, data=dict(
+                name='Bench %d' % rng.randint(1, 1000),
+                email='bench@example.com',
+                comment='Benchmark comment %d' % rng.randint(1, 10 ** 6),
+            ))
+        elif name == 'moderation':
+            response = admin.get('/admin/manage/comment?filter=unread')
+            match = _approve_re.search(response.get_data(as_text=True))
+            if match:
+                admin.post(match.group(1))
+
+
+def _max_rss():
+    # 进程的峰值常驻内存 (KB), 只在 Unix 上可用
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+async def _asgi_get(asgi, url):
+    path, _, query = url.partition('?')
+    scope = dict(type='http', method='GET', path=path, query_string=query.encode('latin-1'), headers=[],
+                 server=('localhost', 80), scheme='http', http_version='1.1', root_path='')
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi(scope, receive, send)
+    return messages[0]['status']
+
+
+def _stats(latencies, elapsed, errors):
+    stats = dict(
+        requests=len(latencies),
+        errors=errors,
+        elapsed=round(elapsed, 3),
+        throughput=round(len(latencies) / elapsed, 2) if elapsed else None,
+    )
+    for percent in (50, 95, 99):
+        stats['p%d' % percent] = round(percentile(latencies, percent), 2) if latencies else None
+    return stats
+
+
+class ConcurrencyBenchmark(object):
+    """在相同的线程数 (也就是大致相同的内存) 下比较 WSGI 和 ASGI 两种部署方式
+
+    WSGI: 同时有 concurrency 个客户端, 但最多 threads 个请求在处理 (相当于 threads 个线程的 WSGI 服务器).
+    ASGI: concurrency 个协程直接调用 bluelog.asgi.AsyncBlog, 它的线程池同样只有 threads 个线程.
+    只发出匿名读者的 GET 请求, 延迟在客户端一侧统计.
+    """
+
+    def __init__(self, app, dataset, threads=4, seed=42):
+        self.app = app
+        self.dataset = dataset
+        self.threads = threads
+        self.seed = seed
+
+    def urls(self, count):
+        rng = random.Random(self.seed)
+        dataset = self.dataset
+        urls = []
+        for i in range(count):
+            choice = rng.random()
+            if choice < 0.3:
+                urls.append('/')
+            elif choice < 0.45:
+                urls.append('/show/category/%d' % rng.randint(1, dataset['category']))
+            elif choice < 0.95:
+                urls.append('/show/post/%d' % (1 + int(dataset['post'] * rng.random() ** 3)))
+            else:
+                urls.append('/about')
+        return urls
+
+    def run(self, levels, total=1000):
+        urls = self.urls(total)
+        result = dict(threads=self.threads, wsgi={}, asgi={})
+        for concurrency in levels:
+            result['wsgi'][concurrency] = self._wsgi(urls, concurrency)
+            result['asgi'][concurrency] = self._asgi(urls, concurrency)
+        result['max_rss_kb'] = _max_rss()
+        return result
+
+    def _wsgi(self, urls, concurrency):
+        app = self.app
+        slots = threading.BoundedSemaphore(self.threads)
+        latencies = []
+        errors = []
+        pending = iter(urls)
+        lock = threading.Lock()
+
+        def client():
+            http = app.test_client()
+            while True:
+                with lock:
+                    url = next(pending, None)
+                if url is None:
+                    return
+                start = time.perf_counter()
+                with slots:
+                    status = http.get(url).status_code
+                with lock:
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    if status >= 400:
+                        errors.append(url)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            for i in range(concurrency):
+                executor.submit(client)
+        return _stats(latencies, time.perf_counter() - start, len(errors))
+
+    def _asgi(self, urls, concurrency):
+        from bluelog.asgi import AsyncBlog
+
+        asgi = AsyncBlog(self.app, self.threads)
+        latencies = []
+        errors = []
+        pending = iter(urls)
+
+        async def client():
+            for url in pending:
+                start = time.perf_counter()
+                status = await _asgi_get(asgi, url)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if status >= 400:
+                    errors.append(url)
+
+        async def main():
+            await asyncio.gather(*[client() for i in range(concurrency)])
+
+        start = time.perf_counter()
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(main())
+        finally:
+            loop.close()
+            asgi.executor.shutdown()
+        return _stats(latencies, time.perf_counter() - start, len(errors))
+
+
+def compare(result, baseline, tolerance=0.2, min_ms=1.0):
+    """与基线结果比较, 返回回归描述列表
+
+    p95 变慢超过 tolerance 比例 (且至少 min_ms 毫秒)、平均查询数增加超过 0.5 或吞吐量下降超过 tolerance 时视为回归.
+    """
+    regressions = []
+    for endpoint, base in sorted(baseline['endpoints'].items()):
+        current = result['endpoints'].get(endpoint)
+        if current is None:
+            continue
+        if current['p95'] > base['p95'] * (1 + tolerance) and current['p95'] - base['p95'] >= min_ms:
+            regressions.append('%s: p95 %.1fms -> %.1fms' % (endpoint, base['p95'], current['p95']))
+        if current['queries_avg'] > base['queries_avg'] + 0.5:
+            regressions.append('%s: queries %.1f -> %.1f' % (endpoint, base['queries_avg'], current['queries_avg']))
+    if baseline.get('throughput') and result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append('throughput %.1f/s -> %.1f/s' % (baseline['throughput'], result['throughput']))
+    return regressions
@@ -8,14 +8,18 @@
     @Software: PyCharm
 """
 
-from flask import Blueprint, url_for, flash, request, redirect, current_app, render_template, send_from_directory
+from flask import Blueprint, url_for, flash, request, redirect, current_app, render_template, jsonify, abort
 from bluelog.utils import redirect_back, allowed_file
+from bluelog.pagination import paginate
 from flask_login import login_required
 from bluelog.forms import PostForm, CategoryFrom, LinkFrom, AdminForm
-from bluelog.models import Category, Post, Link, Comment, Admin, Reply
+from bluelog.models import Category, Post, Link, Comment, Admin, Reply, bump_counter, DEFAULT_CATEGORY_ID
 from flask_ckeditor import upload_success, upload_fail
-import os
+from datetime import datetime
 from bluelog.extensions import db
+from bluelog.signals import site_changed, site_info_changed, post_changed, comment_changed
+from bluelog.profiler import Profiler, summarize
+from bluelog.uploads import image_store
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -27,14 +31,17 @@ def new_post():
     if form.validate_on_submit():
         title = form.title.data
         category = Category.query.get(form.category.data)
-        body = form.body.data
+        body = image_store.rewrite(form.body.data)
         post = Post(
             title=title,
             category=category,
             body=body
         )
         db.session.add(post)
+        bump_counter(Category, category.id, post_count=1)
         db.session.commit()
+        site_changed.send(current_app._get_current_object())
+        post_changed.send(current_app._get_current_object(), post_id=post.id, category_ids=[category.id])
         flash('恭喜您完成了一篇新文章!', 'success')
         return redirect(url_for('blog.show_post', post_id=post.id))
     return render_template('admin/new_post.html', form=form)
@@ -42,17 +49,17 @@ def new_post():
 
 @admin_bp.route('/uploads/<path:filename>')
 def get_image(filename):
-    return send_from_directory(
-        current_app.config['BLUELOG_UPLOAD_PATH'], filename)
+    return image_store.send(filename)
 
 
 @admin_bp.route('/upload/image', methods=['POST'])
+@login_required
 def upload_image():
     f = request.files.get('upload')
-    if not allowed_file(f.filename):
+    if f is None or not allowed_file(f.filename):
         return upload_fail('只能是图片格式!')
-    f.save(os.path.join(current_app.config['BLUELOG_UPLOAD_PATH'], f.filename))
-    url = url_for('.get_image', filename=f.filename)
+    filename = image_store.save(f)
+    url = url_for('.get_image', filename=filename)
     return upload_success(url, f.filename)
 
 
@@ -65,6 +72,7 @@ def new_category():
         category = Category(name=name)
         db.session.add(category)
         db.session.commit()
+        site_changed.send(current_app._get_current_object())
         flash('您成功新建一个分类!', 'success')
         return redirect(url_for('.manage_category'))
     return render_template('admin/new_category.html', form=form)
@@ -80,6 +88,7 @@ def new_link():
         link = Link(name=name, url=url)
         db.session.add(link)
         db.session.commit()
+        site_changed.send(current_app._get_current_object())
         flash('您成功新建一条链接!', 'success')
         return redirect(url_for('.manage_link'))
 
@@ -89,12 +98,8 @@ def new_link():
 @admin_bp.route('/manage/post')
 @login_required
 def manage_post():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLUELOG_MANAGE_POST_PAGE']
-    pagination = Post.query.order_by(
-        Post.timestamp.desc()).paginate(
-        page=page,
-        per_page=per_page)
+    pagination = paginate(Post.listing(), Post.timestamp, Post.id, per_page)
     posts = pagination.items
     return render_template(
         'admin/manage_post.html',
@@ -112,7 +117,9 @@ def change_comment(post_id):
     else:
         post.can_comment = True
         flash('该文章的评论已开启', 'success')
+    post.updated_at = datetime.utcnow()
     db.session.commit()
+    comment_changed.send(current_app._get_current_object(), post_id=post.id, category_id=post.category_id)
     return redirect_back()
 
 
@@ -123,9 +130,18 @@ def edit_post(post_id):
     form = PostForm()
     if form.validate_on_submit():
         post.title = form.title.data
+        old_category_id = post.category_id
+        if old_category_id != form.category.data:
+            bump_counter(Category, old_category_id, post_count=-1)
+            bump_counter(Category, form.category.data, post_count=1)
         post.category = Category.query.get(form.category.data)
-        post.body = form.body.data
+        post.body = image_store.rewrite(form.body.data)
+        post.updated_at = datetime.utcnow()
         db.session.commit()
+        if old_category_id != post.category_id:
+            site_changed.send(current_app._get_current_object())
+        post_changed.send(current_app._get_current_object(), post_id=post.id,
+                          category_ids=[old_category_id, post.category_id])
         flash('该文章已经修改成功', 'success')
         return redirect_back()
     form.title.data = post.title
@@ -138,8 +154,11 @@ def edit_post(post_id):
 @login_required
 def delete_post(post_id):
     post = Post.query.get_or_404(post_id)
-    db.session.delete(post)
+    category_id = post.category_id
+    post.delete()
     db.session.commit()
+    site_changed.send(current_app._get_current_object())
+    post_changed.send(current_app._get_current_object(), post_id=post_id, category_ids=[category_id])
     flash('您成功删除该篇文章', 'success')
     return redirect_back()
 
@@ -148,8 +167,11 @@ def delete_post(post_id):
 @login_required
 def delete_comment(comment_id):
     comment = Comment.query.get_or_404(comment_id)
-    db.session.delete(comment)
+    post, reviewed = comment.post, comment.reviewed
+    comment.delete()
     db.session.commit()
+    if reviewed:
+        comment_changed.send(current_app._get_current_object(), post_id=post.id, category_id=post.category_id)
     flash('已删除该条评论', 'success')
     return redirect_back()
 
@@ -158,8 +180,8 @@ def delete_comment(comment_id):
 @login_required
 def manage_category():
     categories = Category.query.filter(
-        Category.id != 1).all()
-    default = Category.query.get(1)
+        Category.id != DEFAULT_CATEGORY_ID).all()
+    default = Category.query.get(DEFAULT_CATEGORY_ID)
     return render_template(
         'admin/manage_category.html',
         categories=categories,
@@ -174,6 +196,8 @@ def edit_category(category_id):
     if form.validate_on_submit():
         category.name = form.name.data
         db.session.commit()
+        site_changed.send(current_app._get_current_object())
+        site_info_changed.send(current_app._get_current_object())
         flash('文章类别修改成功!', 'success')
         return redirect(url_for('.manage_category'))
     form.name.data = category.name
@@ -184,42 +208,110 @@ def edit_category(category_id):
 @login_required
 def delete_category(category_id):
     category = Category.query.get_or_404(category_id)
+    if category.id == DEFAULT_CATEGORY_ID:
+        flash('不能删除默认分类', 'warning')
+        return redirect_back()
     category.delete()
     db.session.commit()
+    site_changed.send(current_app._get_current_object())
+    site_info_changed.send(current_app._get_current_object())
     flash('已成功删除该分类,分类下的文章自带添加到 Default 默认分类里!', 'info')
     return redirect_back()
 
 
+@admin_bp.route('/merge/category/<int:category_id>', methods=['POST'])
+@login_required
+def merge_category(category_id):
+    category = Category.query.get_or_404(category_id)
+    target = Category.query.get_or_404(request.form.get('target', type=int))
+    if category.id == DEFAULT_CATEGORY_ID or target.id == category.id:
+        flash('不能合并到这个分类', 'warning')
+        return redirect_back()
+    moved = category.merge_into(target.id)
+    db.session.commit()
+    site_changed.send(current_app._get_current_object())
+    site_info_changed.send(current_app._get_current_object())
+    flash('已将 %d 篇文章合并到 %s' % (moved, target.name), 'info')
+    return redirect_back()
+
+
+def _comment_criteria(args, filter_rule='all'):
+    """评论列表和批量操作共用的筛选条件: 状态, 以及可选的文章和邮箱"""
+    criteria = []
+    if filter_rule == 'unread':
+        criteria += [Comment.reviewed == False, Comment.spam == False]
+    elif filter_rule == 'spam':
+        criteria.append(Comment.spam == True)
+    elif filter_rule == 'admin':
+        criteria.append(Comment.from_admin == True)
+    post_id = args.get('post_id', type=int)
+    if post_id:
+        criteria.append(Comment.post_id == post_id)
+    if args.get('email'):
+        criteria.append(Comment.email == args['email'])
+    return criteria
+
+
 @admin_bp.route('/manage/comment')
 @login_required
 def manage_comment():
-    if request.args.get('filter', 'all') == 'all':
-        comment_data = Comment.query
-    elif request.args.get('filter') == 'unread':
-        comment_data = Comment.query.filter_by(reviewed=False)
-    else:
-        comment_data = Comment.query.filter_by(from_admin=True)
-    page = request.args.get('page', 1, type=int)
+    comment_data = Comment.query.filter(*_comment_criteria(request.args, request.args.get('filter', 'all')))
     per_page = current_app.config['BLUELOG_COMMENT_PRE_PAGE']
-    pagination = comment_data.order_by(
-        Comment.timestamp.desc()).paginate(
-        page=page, per_page=per_page)
+    pagination = paginate(comment_data, Comment.timestamp, Comment.id, per_page)
     comments = pagination.items
-    unread_comment = Comment.query.filter_by(reviewed=False).all()
     return render_template(
         'admin/manage_comment.html',
         comments=comments,
-        pagination=pagination,
-        unread_comment=unread_comment)
+        pagination=pagination)
+
+
+@admin_bp.route('/manage/comment/bulk', methods=['POST'])
+@login_required
+def bulk_comment():
+    """批量通过/标记垃圾/删除: 勾选的评论 (ids), 或者某篇文章、某个邮箱下符合状态的全部评论"""
+    action = request.form.get('action')
+    ids = request.form.getlist('ids', type=int)
+    if ids:
+        criteria = [Comment.id.in_(ids)]
+    elif request.form.get('post_id', type=int) or request.form.get('email'):
+        criteria = _comment_criteria(request.form, request.form.get('filter', 'all'))
+    else:
+        flash('请先选择评论', 'warning')
+        return redirect_back()
+
+    if action == 'approve':
+        affected = Comment.approve_all(criteria)
+        message = '已通过 %d 条评论'
+    elif action == 'spam':
+        affected = Comment.mark_spam_all(criteria)
+        message = '已将 %d 条评论标记为垃圾评论'
+    elif action == 'delete':
+        affected = Comment.delete_all(criteria)
+        message = '已删除 %d 条评论'
+    else:
+        abort(400)
+    db.session.commit()
+
+    # 只有公开的评论区发生变化的文章需要通知缓存和搜索索引
+    changed = [post_id for post_id, (total, reviewed, unread) in affected.items() if action == 'approve' or reviewed]
+    if changed:
+        app = current_app._get_current_object()
+        for post_id, category_id in db.session.query(Post.id, Post.category_id).filter(Post.id.in_(changed)):
+            comment_changed.send(app, post_id=post_id, category_id=category_id)
+    flash(message % sum(item[0] for item in affected.values()), 'success')
+    return redirect_back()
 
 
 @admin_bp.route('/manage/approve/<int:comment_id>', methods=['POST'])
 @login_required
 def approve(comment_id):
     comment = Comment.query.get_or_404(comment_id)
-    if not comment.reviewed:
-        comment.reviewed = True
+    reviewed = comment.reviewed
+    comment.approve()
     db.session.commit()
+    if not reviewed:
+        comment_changed.send(current_app._get_current_object(), post_id=comment.post_id,
+                             category_id=comment.post.category_id)
     flash('该评论已通过审核', 'success')
     return redirect_back()
 
@@ -240,6 +332,7 @@ def edit_link(link_id):
         link.name = form.name.data
         link.url = form.url.data
         db.session.commit()
+        site_changed.send(current_app._get_current_object())
         flash('已成功修改一条link', 'success')
         return redirect_back()
     form.name.data = link.name
@@ -253,6 +346,7 @@ def delete_link(link_id):
     link = Link.query.get_or_404(link_id)
     db.session.delete(link)
     db.session.commit()
+    site_changed.send(current_app._get_current_object())
     flash('已成功删除一条link', 'success')
     return redirect_back()
 
@@ -268,6 +362,8 @@ def settings():
         admin.bluelog_sub_title = form.blog_sub_title.data
         admin.about = form.about.data
         db.session.commit()
+        site_changed.send(current_app._get_current_object())
+        site_info_changed.send(current_app._get_current_object())
         flash('已成功修改个人资料', 'success')
         return redirect(url_for('blog.index'))
     form.name.data = admin.name
@@ -281,7 +377,21 @@ def settings():
 @login_required
 def delete_reply(reply_id):
     reply = Reply.query.get_or_404(reply_id)
+    post = reply.comment.post
+    bump_counter(Post, post.id, reply_count=-1)
+    Post.touch_comments(post.id)
     db.session.delete(reply)
     db.session.commit()
+    comment_changed.send(current_app._get_current_object(), post_id=post.id, category_id=post.category_id)
     flash('已成功删除该回复', 'success')
-    return redirect_back()
\ No newline at end of file
+    return redirect_back()
+
+
+@admin_bp.route('/profile')
+@login_required
+def profile():
+    records = Profiler.records(current_app)
+    endpoint = request.args.get('endpoint')
+    if endpoint:
+        records = [record for record in records if record['endpoint'] == endpoint]
+    return jsonify(summary=summarize(records), records=records)
@@ -9,55 +9,97 @@
 """
 
 from flask import Blueprint, render_template, flash, redirect, url_for, request, make_response
-from flask import current_app
-from bluelog.models import Post, Comment, Reply, Category
+from flask import current_app, abort, g
+from bluelog.models import Post, Comment, Reply, Category, bump_counter
 from bluelog.utils import redirect_back
-from bluelog.forms import CommentForm, AdminCommentForm
+from bluelog.pagination import paginate
+from bluelog.conditional import not_modified, with_validators, post_validators, listing_validators, \
+    site_validators, replies_validators
+from bluelog.api import json_response, comment_page, reply_ids, reply_map, post_page
+from bluelog.forms import AdminCommentForm, anonymous_comment_form
 from flask_login import current_user
-from bluelog.extensions import db
+from bluelog.extensions import db, csrf
 from bluelog.emails import send_new_comment_email, send_new_reply_email
+from bluelog.signals import comment_changed
+from bluelog.search import search_index
+from bluelog.streaming import stream_template
+from bluelog.feeds import feeds
+from bluelog.sitemaps import sitemaps
 
 blog_bp = Blueprint('blog', __name__)
 
 
+# 评论视图自己做 CSRF 校验: 默认都校验; 打开 BLUELOG_COMMENT_CSRF_EXEMPT 后 (静态导出的页面里的评论表单
+# 没有有效的令牌) 只校验管理员的评论
+def protect_comment():
+    if request.method != 'POST' or not current_app.config.get('WTF_CSRF_ENABLED', True):
+        return
+    if current_user.is_authenticated or not current_app.config['BLUELOG_COMMENT_CSRF_EXEMPT']:
+        csrf.protect()
+
+
 @blog_bp.route('/')
 def index():
-    page = request.args.get('page', 1, type=int)
+    validators = listing_validators()
+    response = not_modified(validators)
+    if response is not None:
+        return response
     per_page = current_app.config['BLUELOG_POST_PER_PAGE']
-    pagination = Post.query.order_by(
-        Post.timestamp.desc()).paginate(
-        page, per_page)
+    pagination = paginate(Post.listing(), Post.timestamp, Post.id, per_page)
     posts = pagination.items
-    return render_template(
+    return with_validators(render_template(
         'blog/index.html',
         pagination=pagination,
-        posts=posts)
+        posts=posts), validators)
 
 
 @blog_bp.route('/about')
 def about():
-    return render_template('blog/about.html')
+    validators = site_validators()
+    response = not_modified(validators)
+    if response is not None:
+        return response
+    return with_validators(render_template('blog/about.html'), validators)
 
 
 @blog_bp.route('/change/<path:theme>')
 def change_theme(theme):
+    if theme not in current_app.config['THEME'].values():
+        abort(404)
     response = make_response(redirect_back())
     response.set_cookie('theme', theme, max_age=30 * 24 * 60 * 60)
     return response
 
 
 @blog_bp.route('/show/post/<int:post_id>', methods=['GET', 'POST'])
+@csrf.exempt
 def show_post(post_id):
     post = Post.query.get_or_404(post_id)
-    page = request.args.get('page', 1, type=int)
-    per_page = current_app.config['BLUELOG_COMMENT_PRE_PAGE']
-    pagination = Comment.query.with_parent(post).filter_by(
-        reviewed=True) .order_by(
-        Comment.timestamp.asc()).paginate(
-            page=page,
-        per_page=per_page)
-    comments = pagination.items
+    validators = post_validators(post)
+    response = not_modified(validators)
+    if response is not None:
+        return response
 
+    def load_comments():
+        page = request.args.get('page', 1, type=int)
+        per_page = current_app.config['BLUELOG_COMMENT_PRE_PAGE']
+        pagination = Comment.query.with_parent(post).filter_by(
+            reviewed=True) .order_by(
+            Comment.timestamp.asc()).paginate(
+                page=page,
+            per_page=per_page)
+        comments = pagination.items
+
+        # 当前页所有评论的回复一次性查出, 按评论分组后交给模板
+        replies = {}
+        if comments:
+            for reply in Reply.query.filter(
+                    Reply.comment_id.in_([comment.id for comment in comments]),
+                    Reply.reviewed == True).order_by(Reply.timestamp.asc()):
+                replies.setdefault(reply.comment_id, []).append(reply)
+        return pagination, comments, replies
+
+    protect_comment()
     if current_user.is_authenticated:
         form = AdminCommentForm()
         form.name.data = current_user.name
@@ -66,7 +108,7 @@ def show_post(post_id):
         reviewed = True
         from_admin = True
     else:
-        form = CommentForm()
+        form = anonymous_comment_form()
         reviewed = False
         from_admin = False
 
@@ -85,7 +127,10 @@ def show_post(post_id):
             from_admin=from_admin,
             post=post)
         db.session.add(comment)
+        comment.count()
         db.session.commit()
+        if reviewed:
+            comment_changed.send(current_app._get_current_object(), post_id=post.id, category_id=post.category_id)
         if current_user.is_authenticated:
             flash('您的评论已发送', 'success')
         else:
@@ -94,17 +139,27 @@ def show_post(post_id):
 
         return redirect(url_for('.show_post', post_id=post.id))
 
-    return render_template(
+    # 流式渲染: 先发出页头和正文, 评论在模板渲染到评论区时才查询.
+    # 会被整页缓存保存的请求仍然整页渲染
+    if current_app.config['BLUELOG_STREAM_POST'] and request.method == 'GET' and 'page_cache_generation' not in g:
+        return with_validators(stream_template('blog/post.html', post=post, form=form,
+                                               load_comments=load_comments), validators)
+
+    pagination, comments, replies = load_comments()
+    return with_validators(render_template(
         'blog/post.html',
         post=post,
         comments=comments,
+        replies=replies,
         pagination=pagination,
-        form=form)
+        form=form), validators)
 
 
 @blog_bp.route('/reply/form/<int:comment_id>', methods=['POST'])
+@csrf.exempt
 def reply_form(comment_id):
     comment = Comment.query.get_or_404(comment_id)
+    protect_comment()
     if current_user.is_authenticated:
         form = AdminCommentForm()
         form.name.data = current_user.name
@@ -113,7 +168,7 @@ def reply_form(comment_id):
         # reviewed = True
         from_admin = True
     else:
-        form = CommentForm()
+        form = anonymous_comment_form()
         # reviewed = False
         from_admin = False
 
@@ -125,7 +180,11 @@ def reply_form(comment_id):
         reply = Reply(author=author, email=email, site=site, body=body, from_admin=from_admin,
                       comment=comment)
         db.session.add(reply)
+        bump_counter(Post, comment.post_id, reply_count=1)
+        Post.touch_comments(comment.post_id)
         db.session.commit()
+        comment_changed.send(current_app._get_current_object(), post_id=comment.post_id,
+                             category_id=comment.post.category_id)
         flash('您的评论已发送', 'success')
         send_new_reply_email(comment)  # 发送提醒邮件给评论人
         return redirect(url_for('.show_post', post_id=comment.post_id))
@@ -135,17 +194,85 @@ def reply_form(comment_id):
 @blog_bp.route('/show/category/<int:category_id>')
 def show_category(category_id):
     category = Category.query.get_or_404(category_id)
-    page = request.args.get('page', 1, type=int)
+    validators = listing_validators(category)
+    response = not_modified(validators)
+    if response is not None:
+        return response
     per_page = current_app.config['BLUELOG_POST_PER_PAGE']
-    pagination = Post.query.with_parent(category).order_by(
-        Post.timestamp.desc()).paginate(
-        page=page, per_page=per_page)
+    pagination = paginate(Post.listing().with_parent(category), Post.timestamp, Post.id, per_page)
     posts = pagination.items
-    return render_template(
+    return with_validators(render_template(
         'blog/category.html',
         category=category,
         pagination=pagination,
-        posts=posts)
+        posts=posts), validators)
+
+
+@blog_bp.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        flash('请输入要搜索的关键词', 'warning')
+        return redirect_back()
+    per_page = current_app.config['BLUELOG_SEARCH_RESULT_PER_PAGE']
+    pagination = search_index.search(current_app._get_current_object(), q, per_page,
+                                     after=request.args.get('after'), before=request.args.get('before'))
+    return render_template('blog/search.html', q=q, pagination=pagination, results=pagination.items)
+
+
+# Atom 订阅: 读取 FeedStore 生成好的文件, 只在文件不存在时查询
+@blog_bp.route('/feed.atom')
+def feed():
+    return feeds.send()
+
+
+@blog_bp.route('/show/category/<int:category_id>/feed.atom')
+def category_feed(category_id):
+    return feeds.send(category_id)
+
+
+# sitemap 索引和子 sitemap, 由 SitemapStore 生成并保存在磁盘上
+@blog_bp.route('/sitemap.xml')
+def sitemap():
+    return sitemaps.send()
+
+
+@blog_bp.route('/sitemaps/<name>.xml')
+def sitemap_shard(name):
+    return sitemaps.send(name)
+
+
+# ---- 只读 JSON 接口: 游标分页, 带 ETag, 内容没有变化时返回 304 ----
+
+@blog_bp.route('/api/post/<int:post_id>/comments')
+def api_comments(post_id):
+    post = Post.query.get_or_404(post_id)
+    validators = post_validators(post)
+    response = not_modified(validators)
+    if response is not None:
+        return response
+    return with_validators(json_response(comment_page(post)), validators)
+
+
+@blog_bp.route('/api/replies')
+def api_replies():
+    ids = reply_ids()
+    validators = replies_validators(ids)
+    response = not_modified(validators)
+    if response is not None:
+        return response
+    return with_validators(json_response(reply_map(ids)), validators)
+
+
+@blog_bp.route('/api/posts', defaults={'category_id': None})
+@blog_bp.route('/api/category/<int:category_id>/posts')
+def api_posts(category_id):
+    category = Category.query.get_or_404(category_id) if category_id is not None else None
+    validators = listing_validators(category)
+    response = not_modified(validators)
+    if response is not None:
+        return response
+    return with_validators(json_response(post_page(category)), validators)
 
 
 @blog_bp.route('/reply/comment/<int:comment_id>')
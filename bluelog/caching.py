@@ -0,0 +1,367 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import os
+import time
+import pickle
+import shutil
+import hashlib
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+
+from flask import request, session, g, current_app
+from flask_wtf.csrf import generate_csrf
+
+from bluelog.extensions import db
+from bluelog.models import Admin, Category, Link
+from bluelog.signals import site_changed, post_changed, comment_changed
+from bluelog.assets import current_theme
+
+
+class SiteContextCache(object):
+    """进程级的站点上下文缓存 (admin / categories / links)
+
+    数据只在第一次渲染时查询一次, 之后直到管理员修改相关数据前都直接复用.
+    缓存保存的是查询得到的行 (tuple), 不是 ORM 对象, 因此可以安全地跨线程、跨请求使用.
+    多进程部署时, 各 worker 通过一个时间戳文件 (BLUELOG_SITE_STAMP) 感知其他进程的失效操作.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_SITE_STAMP', None)
+        app.extensions['site_cache'] = _SiteContextState(app.config['BLUELOG_SITE_STAMP'])
+        site_changed.connect(self._on_site_changed, app)
+
+    @staticmethod
+    def _state(app):
+        return app.extensions['site_cache']
+
+    def get(self, app):
+        state = self._state(app)
+        version = state.read_stamp()
+        data = state.data
+        if data is not None and state.version == version:
+            return data
+
+        with state.lock:
+            # 拿到锁之后再检查一次, 避免多个线程同时重复查询
+            if state.data is None or state.version != version:
+                state.data = _load_site_context()
+                state.version = version
+            return state.data
+
+    def version(self, app):
+        """站点上下文的版本号 (纳秒时间戳), 每次失效都会变大"""
+        return self._state(app).read_stamp()
+
+    def invalidate(self, app):
+        state = self._state(app)
+        with state.lock:
+            state.data = None
+            state.touch_stamp()
+
+    def _on_site_changed(self, sender, **extra):
+        self.invalidate(sender)
+
+
+class _SiteContextState(object):
+
+    def __init__(self, stamp_path):
+        self.lock = Lock()
+        self.data = None
+        self.version = None
+        self.stamp = _Stamp(stamp_path)
+
+    def read_stamp(self):
+        return self.stamp.read()
+
+    def touch_stamp(self):
+        return self.stamp.touch()
+
+
+class _Stamp(object):
+    """多进程共享的版本号: 时间戳文件的 mtime (纳秒); path 为 None 时只在本进程内递增"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = 0
+
+    def read(self):
+        if self.path is None:
+            return self._local
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def touch(self):
+        stamp = max(time.time_ns(), self.read() + 1)
+        self._local = stamp
+        if self.path is None:
+            return stamp
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a'):
+            pass
+        os.utime(self.path, ns=(stamp, stamp))
+        return stamp
+
+
+def _load_site_context():
+    admin = db.session.query(
+        Admin.name, Admin.bluelog_title, Admin.bluelog_sub_title, Admin.about).first()
+    categories = db.session.query(
+        Category.id, Category.name, Category.post_count).order_by(Category.name).all()
+    links = db.session.query(Link.id, Link.name, Link.url).order_by(Link.name).all()
+    return dict(admin=admin, categories=categories, links=links)
+
+
+class MemoryPageStore(object):
+    """进程内的 LRU 页面缓存, 每个 worker 各自一份
+
+    失效时更新时间戳文件 (BLUELOG_PAGE_CACHE_STAMP); 其他 worker 读写缓存前发现时间戳变了,
+    不知道删除了哪些标签, 就清空自己的全部缓存. 没有时间戳文件时只适合单进程部署.
+    """
+
+    def __init__(self, max_entries=500, stamp_path=None):
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.tags = {}
+        self._stamp = _Stamp(stamp_path)
+        self._generation = self._stamp.read()
+
+    def generation(self):
+        return self._stamp.read()
+
+    def _sync(self):
+        generation = self._stamp.read()
+        if generation != self._generation:
+            self.entries.clear()
+            self.tags.clear()
+            self._generation = generation
+
+    def get(self, tag, key):
+        with self.lock:
+            self._sync()
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry and entry[1]
+
+    def set(self, tag, key, value, generation):
+        with self.lock:
+            self._sync()
+            if generation != self._generation:
+                return
+            self.entries[key] = (tag, value)
+            self.entries.move_to_end(key)
+            self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                old_key, (old_tag, _) = self.entries.popitem(last=False)
+                self.tags.get(old_tag, set()).discard(old_key)
+
+    def delete_tags(self, tags):
+        with self.lock:
+            self._sync()
+            self._generation = self._stamp.touch()
+            for tag in tags:
+                for key in self.tags.pop(tag, ()):
+                    self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self._generation = self._stamp.touch()
+            self.entries.clear()
+            self.tags.clear()
+
+
+class FileSystemPageStore(object):
+    """文件系统页面缓存, 同一台机器上的所有 worker 共享
+
+    每个标签一个目录, 失效时整个目录删除; 写入先写临时文件再改名, 读取不需要加锁.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = os.path.join(path, '.generation')
+        os.makedirs(path, exist_ok=True)
+
+    def generation(self):
+        try:
+            return os.stat(self.stamp).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def _touch(self):
+        stamp = max(time.time_ns(), self.generation() + 1)
+        with open(self.stamp, 'a'):
+            pass
+        os.utime(self.stamp, ns=(stamp, stamp))
+
+    def _filename(self, tag, key):
+        return os.path.join(self.path, tag.replace(':', '-'),
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, tag, key):
+        try:
+            with open(self._filename(tag, key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, tag, key, value, generation):
+        if generation != self.generation():
+            return
+        self._write(self._filename(tag, key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def _write(filename, data):
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, filename)
+
+    def _remove(self, dirname):
+        # 先改名再删除, 其他进程不会读到删了一半的目录
+        if not os.path.isdir(dirname):
+            return
+        trash = tempfile.mkdtemp(dir=self.path, prefix='.trash-')
+        try:
+            os.rename(dirname, os.path.join(trash, 'data'))
+        except OSError:
+            pass
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def delete_tags(self, tags):
+        self._touch()
+        for tag in tags:
+            self._remove(os.path.join(self.path, tag.replace(':', '-')))
+
+    def clear(self):
+        self._touch()
+        for name in os.listdir(self.path):
+            if not name.startswith('.'):
+                self._remove(os.path.join(self.path, name))
+
+
+class PageCache(object):
+    """匿名读者的整页缓存
+
+    只缓存未登录用户对 CACHED_ENDPOINTS 的 GET 请求, 缓存键包含完整 URL 和 theme cookie.
+    页面按标签 (index / post:<id> / category:<id> / about) 归类,
+    文章或评论变化时只删除受影响的标签, 侧边栏数据变化 (site_changed) 时清空全部.
+    表单里的 CSRF 令牌在存入前替换为占位符, 命中时再换成当前会话的令牌.
+    """
+
+    CACHED_ENDPOINTS = ('blog.index', 'blog.show_post', 'blog.show_category', 'blog.about')
+    CSRF_PLACEHOLDER = b'\x00bluelog-csrf-token\x00'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_PAGE_CACHE', None)
+        app.config.setdefault('BLUELOG_PAGE_CACHE_SIZE', 500)
+        app.config.setdefault('BLUELOG_PAGE_CACHE_PATH', None)
+        app.config.setdefault('BLUELOG_PAGE_CACHE_STAMP', None)
+
+        backend = app.config['BLUELOG_PAGE_CACHE']
+        if not backend:
+            return
+        if backend == 'memory':
+            store = MemoryPageStore(app.config['BLUELOG_PAGE_CACHE_SIZE'], app.config['BLUELOG_PAGE_CACHE_STAMP'])
+        elif backend == 'filesystem':
+            store = FileSystemPageStore(app.config['BLUELOG_PAGE_CACHE_PATH'])
+        else:
+            raise ValueError('Unknown page cache backend: %s' % backend)
+        app.extensions['page_cache'] = store
+
+        app.before_request(self._load_page)
+        app.after_request(self._save_page)
+        site_changed.connect(self._on_site_changed, app)
+        post_changed.connect(self._on_post_changed, app)
+        comment_changed.connect(self._on_comment_changed, app)
+
+    @staticmethod
+    def _store(app):
+        return app.extensions.get('page_cache')
+
+    def _tag(self):
+        if request.method != 'GET' or request.endpoint not in self.CACHED_ENDPOINTS:
+            return None
+        # 已登录的管理员和有待显示闪现消息的请求不走缓存
+        if '_user_id' in session or '_flashes' in session or \
+                current_app.config.get('REMEMBER_COOKIE_NAME', 'remember_token') in request.cookies:
+            return None
+        if request.endpoint == 'blog.show_post':
+            return 'post:%d' % request.view_args['post_id']
+        if request.endpoint == 'blog.show_category':
+            return 'category:%d' % request.view_args['category_id']
+        return request.endpoint.split('.')[-1]
+
+    @staticmethod
+    def _key():
+        args = '&'.join('%s=%s' % item for item in sorted(request.args.items(multi=True)))
+        return '%s?%s|%s' % (request.path, args, current_theme())
+
+    def _load_page(self):
+        store = self._store(current_app)
+        tag = self._tag()
+        if tag is None:
+            return None
+        g.page_cache_generation = store.generation()
+        cached = store.get(tag, self._key())
+        if cached is None:
+            return None
+        body, headers = cached
+        if self.CSRF_PLACEHOLDER in body:
+            body = body.replace(self.CSRF_PLACEHOLDER, generate_csrf().encode('utf-8'))
+        response = current_app.response_class(body, headers=headers)
+        g.page_cache_hit = True
+        return response.make_conditional(request)
+
+    def _save_page(self, response):
+        if g.get('page_cache_hit') or 'page_cache_generation' not in g:
+            return response
+        if response.status_code != 200 or response.is_streamed or response.mimetype != 'text/html':
+            return response
+        tag = self._tag()
+        if tag is None:
+            return response
+        body = response.get_data()
+        token = g.get('csrf_token')
+        if token:
+            body = body.replace(token.encode('utf-8'), self.CSRF_PLACEHOLDER)
+        headers = [(name, value) for name, value in response.headers
+                   if name.lower() not in ('set-cookie', 'content-length')]
+        self._store(current_app).set(tag, self._key(), (body, headers), g.page_cache_generation)
+        return response
+
+    def _on_site_changed(self, sender, **extra):
+        self._store(sender).clear()
+
+    def _on_post_changed(self, sender, post_id, category_ids=(), **extra):
+        tags = ['index', 'post:%d' % post_id]
+        tags.extend('category:%d' % category_id for category_id in category_ids if category_id)
+        self._store(sender).delete_tags(tags)
+
+    def _on_comment_changed(self, sender, post_id, category_id=None, **extra):
+        self._on_post_changed(sender, post_id, [category_id])
+
+
+site_cache = SiteContextCache()
+page_cache = PageCache()
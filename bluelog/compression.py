@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_options_header
+from werkzeug.wsgi import ClosingIterator, FileWrapper
+
+try:
+    import brotli
+except ImportError:  # 没有 brotli 时只使用 gzip
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('text/html', 'text/css', 'text/plain', 'text/xml', 'text/javascript',
+                          'application/javascript', 'application/json', 'application/xml',
+                          'application/atom+xml', 'application/rss+xml', 'image/svg+xml')
+
+
+class _Encoder(object):
+    """gzip 或 brotli 的流式压缩, 每一段都立即 flush, 流式响应的内容不会积压在压缩器里"""
+
+    def __init__(self, encoding, level, quality):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=quality)
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class CompressMiddleware(object):
+    """按 Accept-Encoding 用 brotli (已安装时) 或 gzip 压缩响应的 WSGI 中间件
+
+    放在最外层, 整页缓存命中的页面和模板流式渲染的页面同样会被压缩; 已经带有 Content-Encoding 的响应
+    (预压缩的静态文件)、交给前端服务器发送的文件 (X-Sendfile / X-Accel-Redirect)、send_file 返回的文件对象
+    和不在 COMPRESSIBLE_MIMETYPES 中的类型原样返回.
+    长度已知的响应整体压缩并给出新的 Content-Length, 流式响应逐段压缩.
+    """
+
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.config = config
+
+    def _encoding(self, environ):
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return None
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        if brotli is not None and accepted['br']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+
+    def _compressible(self, status, headers):
+        code = int(status.split(' ', 1)[0])
+        if code < 200 or code in (204, 206, 304) or 'Content-Encoding' in headers:
+            return False
+        if 'X-Sendfile' in headers or 'X-Accel-Redirect' in headers:
+            # 正文由前端服务器读取文件发送, 这里的正文是空的
+            return False
+        mimetype = parse_options_header(headers.get('Content-Type', ''))[0]
+        if mimetype not in COMPRESSIBLE_MIMETYPES:
+            return False
+        length = headers.get('Content-Length', type=int)
+        return length is None or length >= self.config['BLUELOG_COMPRESS_MIN_SIZE']
+
+    def __call__(self, environ, start_response):
+        encoding = self._encoding(environ)
+        if encoding is None:
+            return self.wsgi_app(environ, start_response)
+
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return _write
+
+        app_iter = self.wsgi_app(environ, capture)
+        chunks = iter(app_iter)
+        first = []
+        if not captured:
+            # 有的应用在第一次迭代时才调用 start_response
+            first = [next(chunks, b'')]
+        status, headers, exc_info = captured
+        headers = Headers(headers)
+        if not self._compressible(status, headers) or _is_file(environ, app_iter):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            if not first:
+                # 原样返回, 服务器仍然可以用 sendfile 发送文件
+                return app_iter
+            return ClosingIterator(_chain(first, chunks), getattr(app_iter, 'close', None))
+
+        encoder = _Encoder(encoding, self.config['BLUELOG_COMPRESS_LEVEL'],
+                           self.config['BLUELOG_COMPRESS_BROTLI_QUALITY'])
+        headers['Content-Encoding'] = encoding
+        _add_vary(headers)
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            # 压缩后的表示与原来的字节不同, 改为弱 ETag
+            headers['ETag'] = 'W/' + etag
+
+        if 'Content-Length' in headers:
+            try:
+                body = b''.join(_chain(first, chunks))
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            data = encoder.compress(body) + encoder.finish()
+            headers['Content-Length'] = str(len(data))
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return [data]
+
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return ClosingIterator(_stream(encoder, _chain(first, chunks)), getattr(app_iter, 'close', None))
+
+
+def _write(data):
+    raise RuntimeError('CompressMiddleware does not support the write() callable.')
+
+
+def _is_file(environ, app_iter):
+    """send_file 返回的文件对象 (wsgi.file_wrapper), 不把整个文件读入内存压缩"""
+    if isinstance(app_iter, FileWrapper):
+        return True
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    return isinstance(file_wrapper, type) and isinstance(app_iter, file_wrapper)
+
+
+def _chain(first, chunks):
+    for chunk in first:
+        yield chunk
+    for chunk in chunks:
+        yield chunk
+
+
+def _stream(encoder, chunks):
+    for chunk in chunks:
+        if chunk:
+            yield encoder.compress(chunk)
+    yield encoder.finish()
+
+
+def _add_vary(headers):
+    vary = [item.strip() for item in headers.get('Vary', '').split(',') if item.strip()]
+    if 'accept-encoding' not in [item.lower() for item in vary]:
+        vary.append('Accept-Encoding')
+    headers['Vary'] = ', '.join(vary)
+
+
+class Compress(object):
+    """BLUELOG_COMPRESS 打开时用 CompressMiddleware 包装 app.wsgi_app"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_COMPRESS', False)
+        app.config.setdefault('BLUELOG_COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('BLUELOG_COMPRESS_LEVEL', 6)
+        app.config.setdefault('BLUELOG_COMPRESS_BROTLI_QUALITY', 4)
+        if app.config['BLUELOG_COMPRESS']:
+            app.wsgi_app = CompressMiddleware(app.wsgi_app, app.config)
+
+
+compress = Compress()
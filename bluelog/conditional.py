@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import hashlib
+from collections import namedtuple
+from datetime import datetime
+
+from flask import request, session, current_app, make_response
+
+from bluelog.extensions import db
+from bluelog.models import Post, Comment
+from bluelog.caching import site_cache
+
+Validators = namedtuple('Validators', ['etag', 'last_modified'])
+
+
+def _site_validators():
+    version = site_cache.version(current_app._get_current_object())
+    modified = datetime.utcfromtimestamp(version / 1e9) if version else None
+    return version, modified
+
+
+def _make_validators(parts, times):
+    # 页面还取决于主题 cookie, 一并计入 ETag
+    parts = list(parts) + [request.cookies.get('theme', '')]
+    etag = hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    times = [time for time in times if time is not None]
+    return Validators(etag, max(times) if times else None)
+
+
+def post_validators(post):
+    """文章页的版本: 文章修改时间、评论区变化时间和计数器, 不需要再查询评论表
+
+    页面里的评论表单带有当前会话的 CSRF 令牌, 令牌也计入 ETag, 换了会话不会拿到别人的令牌.
+    """
+    version, modified = _site_validators()
+    csrf_token = session.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'), '')
+    return _make_validators(
+        ('post', post.id, post.updated_at, post.commented_at, post.reviewed_comment_count,
+         post.reply_count, post.can_comment, version, csrf_token),
+        (post.timestamp, post.updated_at, post.commented_at, modified))
+
+
+def listing_validators(category=None):
+    """文章列表的版本: 用一条聚合查询取得文章数、最新修改时间和评论数之和"""
+    query = db.session.query(
+        db.func.count(Post.id), db.func.max(Post.updated_at),
+        db.func.max(Post.commented_at), db.func.sum(Post.reviewed_comment_count))
+    if category is not None:
+        query = query.filter(Post.category_id == category.id)
+    count, updated_at, commented_at, comments = query.one()
+    version, modified = _site_validators()
+    return _make_validators(
+        ('listing', category.id if category is not None else '', count, updated_at,
+         commented_at, comments, version),
+        (updated_at, commented_at, modified))
+
+
+def replies_validators(comment_ids):
+    """一批评论的回复的版本: 回复变化时都会更新所在文章的 commented_at 和 reply_count, 不需要先查回复表"""
+    posts = db.session.query(Post.id, Post.commented_at, Post.reply_count).join(
+        Comment, Comment.post_id == Post.id).filter(Comment.id.in_(comment_ids)).distinct().order_by(Post.id).all()
+    version, modified = _site_validators()
+    return _make_validators(['replies', version] + [tuple(post) for post in posts],
+                            [post.commented_at for post in posts] + [modified])
+
+
+def site_validators():
+    """只依赖站点上下文的页面 (about)"""
+    version, modified = _site_validators()
+    return _make_validators(('site', version), (modified,))
+
+
+def _conditional_enabled():
+    # 管理员看到的页面和带闪现消息的页面都因人而异, 不做条件请求
+    return request.method in ('GET', 'HEAD') and \
+        '_user_id' not in session and '_flashes' not in session
+
+
+def not_modified(validators):
+    """客户端缓存仍然有效时返回 304 响应, 否则返回 None, 应在渲染模板之前调用"""
+    if not _conditional_enabled():
+        return None
+    if request.if_none_match:
+        # 弱比较: 压缩后的响应带的是弱 ETag
+        modified = not request.if_none_match.contains_weak(validators.etag)
+    elif request.if_modified_since and validators.last_modified:
+        modified = validators.last_modified.replace(microsecond=0) > request.if_modified_since.replace(tzinfo=None)
+    else:
+        modified = True
+    if modified:
+        return None
+    response = current_app.response_class(status=304)
+    return _set_headers(response, validators)
+
+
+def with_validators(response, validators):
+    response = make_response(response)
+    if _conditional_enabled():
+        _set_headers(response, validators)
+    return response
+
+
+def _set_headers(response, validators):
+    response.set_etag(validators.etag)
+    if validators.last_modified:
+        response.last_modified = validators.last_modified
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+from flask import request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import Select, CompoundSelect, TextClause
+
+# 只读副本在 SQLALCHEMY_BINDS 中的键
+REPLICA = 'replica'
+
+
+def _set_pragmas(pragmas):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    return on_connect
+
+
+class RoutingSession(SignallingSession):
+    """blog 蓝本的 GET/HEAD 请求中的读操作使用只读副本, 写入 (flush 和 execute 的 DML/DDL) 和其他请求仍然使用主库"""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and _is_read(clause) and self._use_replica(mapper):
+            return self.db.get_engine(self.app, bind=REPLICA)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _use_replica(self, mapper):
+        if not self.app.config.get('BLUELOG_DATABASE_REPLICA_URI') or not has_request_context():
+            return False
+        if request.blueprint != 'blog' or request.method not in ('GET', 'HEAD'):
+            return False
+        # 指定了其他 bind 的模型不参与路由
+        return mapper is None or mapper.persist_selectable.info.get('bind_key') is None
+
+
+def _is_read(clause):
+    # 查询 (Query) 传入的是 SELECT; session.execute() 的语句可能是 INSERT/UPDATE/DELETE 或建表语句
+    if clause is None or isinstance(clause, (Select, CompoundSelect)):
+        return True
+    return isinstance(clause, TextClause) and clause.text.lstrip().upper().startswith('SELECT')
+
+
+class Database(SQLAlchemy):
+    """按 BLUELOG_DATABASE_* 配置创建引擎
+
+    SQLite 文件数据库使用连接池 (而不是每次取连接都重新打开), 每个新连接执行 BLUELOG_SQLITE_PRAGMAS;
+    其他数据库使用 BLUELOG_DATABASE_POOL 中的连接池参数.
+    配置了 BLUELOG_DATABASE_REPLICA_URI 时, 它作为 'replica' bind 供 RoutingSession 使用.
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_SQLITE_PRAGMAS', {})
+        app.config.setdefault('BLUELOG_DATABASE_POOL', {})
+        app.config.setdefault('BLUELOG_DATABASE_REPLICA_URI', None)
+        replica = app.config['BLUELOG_DATABASE_REPLICA_URI']
+        if replica:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds[REPLICA] = replica
+            app.config['SQLALCHEMY_BINDS'] = binds
+        super(Database, self).init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(Database, self).apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite'):
+            pragmas = dict(app.config['BLUELOG_SQLITE_PRAGMAS'])
+            if sa_url.database not in (None, '', ':memory:'):
+                # 连接会在线程之间复用, 但同一时间只被一个线程使用
+                options['poolclass'] = QueuePool
+                options.setdefault('connect_args', {})['check_same_thread'] = False
+                for key, value in app.config['BLUELOG_DATABASE_POOL'].items():
+                    if key != 'pool_pre_ping':
+                        options.setdefault(key, value)
+            options['_sqlite_pragmas'] = pragmas
+        else:
+            for key, value in app.config['BLUELOG_DATABASE_POOL'].items():
+                options.setdefault(key, value)
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('_sqlite_pragmas', None)
+        engine = super(Database, self).create_engine(sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, 'connect', _set_pragmas(pragmas))
+        return engine
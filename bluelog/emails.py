@@ -8,40 +8,213 @@
     @Software: PyCharm
 """
 
-from threading import Thread
+import os
+import uuid
+import smtplib
+from datetime import datetime, timedelta
+from threading import Thread, Lock, Event
 
 from flask import url_for, current_app
 from flask_mail import Message
 
-from bluelog.extensions import mail
+from bluelog.extensions import mail, db
+from bluelog.models import OutboxMessage
 
 
-def _send_async_mail(app, message):
-    with app.app_context():
-        mail.send(message)
+def _pending(digest_key, to):
+    # 还没有被发送线程领取的同类通知
+    return OutboxMessage.query.filter(
+        OutboxMessage.digest_key == digest_key, OutboxMessage.recipient == to,
+        OutboxMessage.sent_at == None, OutboxMessage.failed == False,
+        OutboxMessage.claimed_until == None).first()
 
 
-def send_mail(subject, to, html):
+def send_mail(subject, to, html, digest_key=None):
+    """把邮件放进发件箱, 由后台线程发送
+
+    带 digest_key 时, 同一个键和收件人在 BLUELOG_MAIL_DIGEST_WINDOW 分钟内最多发出一封,
+    期间的新通知合并到还没发出的那一封里 (count 加一, 标题和内容替换为最新的).
+    """
+    if not to:
+        return None
     app = current_app._get_current_object()
-    message = Message(subject, recipients=[to], html=html)
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    thr.start()
-    return thr
+    now = datetime.utcnow()
+    message = _pending(digest_key, to) if digest_key else None
+    if message is not None:
+        message.count += 1
+        message.subject = subject
+        message.html = html
+    else:
+        send_after = now
+        if digest_key:
+            # 上一封已发出或正在发送的同类邮件
+            last_sent = db.session.query(db.func.max(db.func.coalesce(
+                OutboxMessage.sent_at, OutboxMessage.send_after))).filter(
+                OutboxMessage.digest_key == digest_key, OutboxMessage.recipient == to,
+                OutboxMessage.failed == False).scalar()
+            if last_sent is not None:
+                send_after = max(now, last_sent + timedelta(minutes=app.config['BLUELOG_MAIL_DIGEST_WINDOW']))
+        message = OutboxMessage(recipient=to, subject=subject, html=html, digest_key=digest_key,
+                                created_at=now, send_after=send_after)
+        db.session.add(message)
+    db.session.commit()
+    outbox.wake(app)
+    return message
 
 
 def send_new_comment_email(post):
+    to = current_app.config['BLUELOG_EMAIL']
+    key = 'comment:%d' % post.id
+    pending = _pending(key, to)
+    count = pending.count + 1 if pending is not None else 1
     post_url = url_for('blog.show_post', post_id=post.id, _external=True) + '#comment'
-    send_mail(subject='博客有新评论', to=current_app.config['BLUELOG_EMAIL'],
-              html='<p>New comment in post <i>%s</i>, click the link below to check:</p>'
+    if count == 1:
+        subject = '博客有新评论'
+        summary = 'New comment in post <i>%s</i>' % post.title
+    else:
+        subject = '博客有 %d 条新评论' % count
+        summary = '%d new comments in post <i>%s</i>' % (count, post.title)
+    send_mail(subject=subject, to=to, digest_key=key,
+              html='<p>%s, click the link below to check:</p>'
                    '<p><a href="%s">%s</a></P>'
                    '<p><small style="color: #868e96">Do not reply this email.</small></p>'
-                   % (post.title, post_url, post_url))
+                   % (summary, post_url, post_url))
 
 
 def send_new_reply_email(comment):
+    key = 'reply:%d' % comment.id
+    pending = _pending(key, comment.email)
+    count = pending.count + 1 if pending is not None else 1
     post_url = url_for('blog.show_post', post_id=comment.post_id, _external=True) + '#comment'
-    send_mail(subject='New reply', to=comment.email,
-              html='<p>New reply for the comment you left in post <i>%s</i>, click the link below to check: </p>'
+    if count == 1:
+        subject = 'New reply'
+        summary = 'New reply'
+    else:
+        subject = '%d new replies' % count
+        summary = '%d new replies' % count
+    send_mail(subject=subject, to=comment.email, digest_key=key,
+              html='<p>%s for the comment you left in post <i>%s</i>, click the link below to check: </p>'
                    '<p><a href="%s">%s</a></p>'
                    '<p><small style="color: #868e96">Do not reply this email.</small></p>'
-                   % (comment.post.title, post_url, post_url))
+                   % (summary, comment.post.title, post_url, post_url))
+
+
+class MailOutbox(object):
+    """发件箱的发送线程
+
+    每个进程最多启动 BLUELOG_MAIL_WORKERS 个线程 (为 0 时不启动, 由 flask send-mail 发送).
+    线程每次领取最多 BLUELOG_MAIL_BATCH_SIZE 封到期的邮件, 通过同一个 SMTP 连接 (mail.connect()) 发出;
+    失败的邮件按 BLUELOG_MAIL_RETRY_DELAY * 2^(n-1) 秒后重试, 超过 BLUELOG_MAIL_MAX_ATTEMPTS 次后标记为失败.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_MAIL_WORKERS', 1)
+        app.config.setdefault('BLUELOG_MAIL_BATCH_SIZE', 20)
+        app.config.setdefault('BLUELOG_MAIL_DIGEST_WINDOW', 10)
+        app.config.setdefault('BLUELOG_MAIL_RETRY_DELAY', 60)
+        app.config.setdefault('BLUELOG_MAIL_MAX_ATTEMPTS', 5)
+        app.config.setdefault('BLUELOG_MAIL_POLL_INTERVAL', 30)
+        app.extensions['mail_outbox'] = dict(lock=Lock(), event=Event(), pid=None)
+
+    def wake(self, app):
+        """通知发送线程有新邮件, 线程在本进程第一次调用时启动"""
+        workers = app.config['BLUELOG_MAIL_WORKERS']
+        if not workers:
+            return
+        state = app.extensions['mail_outbox']
+        with state['lock']:
+            # fork 出来的子进程需要重新启动自己的线程
+            if state['pid'] != os.getpid():
+                state['pid'] = os.getpid()
+                for i in range(workers):
+                    thread = Thread(target=self._run, args=(app, state), name='bluelog-mail-%d' % i)
+                    thread.daemon = True
+                    thread.start()
+        state['event'].set()
+
+    def _run(self, app, state):
+        with app.app_context():
+            while True:
+                try:
+                    while self.send_batch(app):
+                        pass
+                except Exception:
+                    app.logger.exception('Failed to send the mail outbox')
+                finally:
+                    db.session.remove()
+                state['event'].wait(app.config['BLUELOG_MAIL_POLL_INTERVAL'])
+                state['event'].clear()
+
+    @staticmethod
+    def _claim(app):
+        now = datetime.utcnow()
+        unclaimed = db.or_(OutboxMessage.claimed_until == None, OutboxMessage.claimed_until < now)
+        ids = [ident for ident, in db.session.query(OutboxMessage.id).filter(
+            OutboxMessage.sent_at == None, OutboxMessage.failed == False, OutboxMessage.send_after <= now,
+            unclaimed).order_by(OutboxMessage.send_after).limit(app.config['BLUELOG_MAIL_BATCH_SIZE'])]
+        if not ids:
+            return []
+        token = uuid.uuid4().hex
+        # 条件更新, 其他线程或进程已经领取的邮件不会被重复领取
+        OutboxMessage.query.filter(OutboxMessage.id.in_(ids), unclaimed).update(
+            {OutboxMessage.claimed_by: token, OutboxMessage.claimed_until: now + timedelta(minutes=5)},
+            synchronize_session=False)
+        db.session.commit()
+        return OutboxMessage.query.filter_by(claimed_by=token).filter(OutboxMessage.sent_at == None).all()
+
+    @staticmethod
+    def _retry(app, message, error):
+        message.attempts += 1
+        message.last_error = '%s: %s' % (type(error).__name__, error)
+        message.claimed_until = None
+        if message.attempts >= app.config['BLUELOG_MAIL_MAX_ATTEMPTS']:
+            message.failed = True
+        else:
+            delay = app.config['BLUELOG_MAIL_RETRY_DELAY'] * 2 ** (message.attempts - 1)
+            message.send_after = datetime.utcnow() + timedelta(seconds=delay)
+
+    def send_batch(self, app):
+        """领取并发送一批到期的邮件, 返回领取的数量"""
+        messages = self._claim(app)
+        if not messages:
+            return 0
+        try:
+            with mail.connect() as connection:
+                for message in messages:
+                    try:
+                        connection.send(Message(message.subject, recipients=[message.recipient], html=message.html))
+                    except Exception as e:
+                        self._retry(app, message, e)
+                    else:
+                        message.sent_at = datetime.utcnow()
+                        message.claimed_until = None
+                    # 每封单独提交, 进程中途退出时已发出的邮件不会重发
+                    db.session.commit()
+        except (smtplib.SMTPException, OSError) as e:
+            # 连接失败或者中途断开
+            for message in messages:
+                if message.sent_at is None and message.claimed_until is not None:
+                    self._retry(app, message, e)
+            db.session.commit()
+        return len(messages)
+
+    def flush(self, app):
+        """不再等待合并窗口, 立即发送所有到期和待合并的邮件, 返回发出的数量"""
+        OutboxMessage.query.filter(OutboxMessage.sent_at == None, OutboxMessage.failed == False,
+                                   OutboxMessage.attempts == 0).update(
+            {OutboxMessage.send_after: datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        return self.send_all(app)
+
+    def send_all(self, app):
+        sent = OutboxMessage.query.filter(OutboxMessage.sent_at != None).count()
+        while self.send_batch(app):
+            pass
+        return OutboxMessage.query.filter(OutboxMessage.sent_at != None).count() - sent
+
+
+outbox = MailOutbox()
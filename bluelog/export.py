@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import os
+import re
+import json
+import html
+import tempfile
+from threading import Thread, Lock
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+
+from bluelog.extensions import db
+from bluelog.models import Post, Category
+from bluelog.conditional import post_validators, listing_validators, site_validators
+from bluelog.signals import site_changed, post_changed, comment_changed
+
+# 需要导出的公开页面
+EXPORT_ENDPOINTS = ('blog.index', 'blog.show_post', 'blog.show_category', 'blog.about')
+
+_href_re = re.compile(r'href="([^"]+)"')
+
+
+def page_filename(url):
+    """URL 对应的文件: /show/post/1?page=2 -> show/post/1/index.html?page=2
+
+    nginx 可以这样直接提供导出的页面:
+        try_files /$theme$uri/index.html$is_args$args @bluelog;
+    """
+    parts = urlsplit(url)
+    filename = os.path.join(parts.path.strip('/'), 'index.html')
+    if parts.query:
+        filename += '?' + parts.query
+    return filename
+
+
+def _write(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+
+# ---- 渲染 (可能运行在子进程中) ----
+
+_worker_app = None
+
+
+def _init_worker(config_name, overrides):
+    global _worker_app
+    from bluelog import create_app
+    _worker_app = create_app(config_name, overrides)
+
+
+def _render(app, output, url, theme):
+    client = app.test_client()
+    response = client.get(url, headers={'Cookie': 'theme=%s' % theme})
+    if response.status_code != 200:
+        return url, theme, response.status_code, None
+    body = response.get_data()
+    _write(os.path.join(output, theme, page_filename(url)), body)
+    return url, theme, 200, body.decode('utf-8')
+
+
+def _render_in_worker(args):
+    return _render(_worker_app, *args)
+
+
+class SiteExporter(object):
+    """把公开页面渲染成静态 HTML, 每个主题一个目录
+
+    从首页、关于页、所有文章页和分类页出发, 沿着页面中的链接 (分页、评论页) 逐层抓取.
+    每个页面记录版本指纹 (与 ETag 相同) 到 manifest.json, 增量导出时只重新渲染指纹变化的页面.
+    """
+
+    def __init__(self, app, output, themes=None, workers=None):
+        self.app = app
+        self.output = output
+        self.themes = themes or sorted(set(app.config['THEME'].values()))
+        self.workers = os.cpu_count() if workers is None else workers
+        self.manifest_file = os.path.join(output, 'manifest.json')
+        self._fingerprints = {}
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _match(self, url):
+        parts = urlsplit(url)
+        if parts.scheme or parts.netloc or not parts.path.startswith('/'):
+            return None
+        adapter = self.app.url_map.bind('localhost')
+        try:
+            endpoint, args = adapter.match(parts.path, method='GET')
+        except HTTPException:
+            return None
+        if endpoint not in EXPORT_ENDPOINTS:
+            return None
+        return endpoint, args
+
+    def fingerprint(self, url):
+        endpoint, args = self._match(url)
+        key = (endpoint, tuple(sorted(args.items())))
+        if key not in self._fingerprints:
+            if endpoint == 'blog.show_post':
+                post = Post.query.get(args['post_id'])
+                validators = post_validators(post) if post else None
+            elif endpoint == 'blog.show_category':
+                category = Category.query.get(args['category_id'])
+                validators = listing_validators(category) if category else None
+            elif endpoint == 'blog.index':
+                validators = listing_validators()
+            else:
+                validators = site_validators()
+            self._fingerprints[key] = validators.etag if validators else None
+        return self._fingerprints[key]
+
+    def links(self, body):
+        links = set()
+        for href in _href_re.findall(body):
+            url = html.unescape(href).split('#')[0]
+            if url and self._match(url):
+                links.add(url)
+        return links
+
+    def seeds(self):
+        urls = ['/', self._url('blog.about')]
+        urls.extend(self._url('blog.show_post', post_id=post_id) for post_id, in db.session.query(Post.id))
+        urls.extend(self._url('blog.show_category', category_id=category_id)
+                    for category_id, in db.session.query(Category.id))
+        return urls
+
+    def _url(self, endpoint, **values):
+        return self.app.url_map.bind('localhost').build(endpoint, values)
+
+    def export(self, incremental=False, echo=None):
+        """导出全部页面, 返回 (渲染的页面数, 跳过的页面数)"""
+        echo = echo or (lambda message: None)
+        old = self._load_manifest() if incremental else {}
+        old_pages = old.get('pages', {}) if old.get('themes') == self.themes else {}
+        pages = {}
+        rendered = skipped = 0
+
+        # 指纹依赖请求中的主题 cookie, 这里固定不带 cookie, 主题由目录区分
+        with self.app.test_request_context('/'):
+            pending = self.seeds()
+            seen = set(pending)
+            pool = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                       initargs=self._worker_args()) if self.workers > 1 else None
+            try:
+                while pending:
+                    jobs = []
+                    for url in pending:
+                        fingerprint = self.fingerprint(url)
+                        if url in old_pages and old_pages[url]['fingerprint'] == fingerprint:
+                            pages[url] = old_pages[url]
+                            skipped += 1
+                        else:
+                            pages[url] = dict(fingerprint=fingerprint, links=[])
+                            jobs.extend((self.output, url, theme) for theme in self.themes)
+                    if pool is not None:
+                        results = pool.map(_render_in_worker, jobs, chunksize=8)
+                    else:
+                        results = (_render(self.app, *job) for job in jobs)
+                    for url, theme, status, body in results:
+                        if status != 200:
+                            echo('Skip %s (%s): HTTP %d' % (url, theme, status))
+                            pages.pop(url, None)
+                        elif theme == self.themes[0]:
+                            pages[url]['links'] = sorted(self.links(body))
+                            rendered += 1
+
+                    pending = []
+                    for url in list(pages):
+                        for link in pages[url]['links']:
+                            if link not in seen:
+                                seen.add(link)
+                                pending.append(link)
+                    echo('Rendered %d pages, %d unchanged, %d queued...' % (rendered, skipped, len(pending)))
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+
+        # 删除已经不存在的页面
+        for url in set(old_pages) - set(pages):
+            for theme in self.themes:
+                try:
+                    os.remove(os.path.join(self.output, theme, page_filename(url)))
+                except OSError:
+                    pass
+        _write(self.manifest_file, json.dumps(dict(themes=self.themes, pages=pages)).encode('utf-8'))
+        return rendered, skipped
+
+    def _worker_args(self):
+        overrides = dict(SQLALCHEMY_DATABASE_URI=self.app.config['SQLALCHEMY_DATABASE_URI'],
+                         BLUELOG_PAGE_CACHE=None)
+        return self.app.config['BLUELOG_CONFIG_NAME'], overrides
+
+
+class AutoExporter(object):
+    """管理员修改内容后在后台线程里做一次增量导出 (需要设置 BLUELOG_EXPORT_PATH)"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_EXPORT_ON_WRITE', False)
+        app.config.setdefault('BLUELOG_EXPORT_WORKERS', None)
+        if not app.config['BLUELOG_EXPORT_ON_WRITE']:
+            return
+        app.extensions['auto_export'] = dict(lock=Lock(), pending=False)
+        for signal in (site_changed, post_changed, comment_changed):
+            signal.connect(self._schedule, app)
+
+    def _schedule(self, sender, **extra):
+        state = sender.extensions['auto_export']
+        state['pending'] = True
+        if state['lock'].acquire(blocking=False):
+            Thread(target=self._run, args=(sender, state), daemon=True).start()
+
+    @staticmethod
+    def _run(app, state):
+        # 导出期间又有修改时, 结束后再导出一次
+        while True:
+            try:
+                while state['pending']:
+                    state['pending'] = False
+                    with app.app_context():
+                        exporter = SiteExporter(app, app.config['BLUELOG_EXPORT_PATH'],
+                                                workers=app.config['BLUELOG_EXPORT_WORKERS'])
+                        exporter.export(incremental=True)
+                        db.session.remove()
+            finally:
+                state['lock'].release()
+            if not state['pending'] or not state['lock'].acquire(blocking=False):
+                return
+
+
+auto_exporter = AutoExporter()
@@ -13,15 +13,16 @@ from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import CSRFProtect
 
+from bluelog.database import Database
+
 
 bootstrap = Bootstrap()
 ckeditor = CKEditor()
 mail = Mail()
 moment = Moment()
-db = SQLAlchemy()
+db = Database()
 login_manager = LoginManager()
 csrf = CSRFProtect()
 
@@ -9,10 +9,13 @@
 """
 
 from faker import Faker
+from flask import current_app
 import random
-from sqlalchemy.exc import IntegrityError
-from bluelog.models import Admin, Category, Post, Comment, Reply, Link
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from bluelog.models import Admin, Category, Post, Comment, Reply, Link, rebuild_counters, post_summary
 from bluelog.extensions import db
+from bluelog.search import search_index
 
 fake = Faker('zh_CN')  # 无参数，默认英文，zh_CN指定为中文
 
@@ -30,114 +33,152 @@ def fake_admin():
     db.session.commit()
 
 
-def fake_categories(count=10):
+# 每批生成/插入的行数
+CHUNK_SIZE = 5000
 
-    category = Category(name='Default')
-    db.session.add(category)
+ADMIN_AUTHOR = dict(author='刘伯温', email='mima@example.com', site='example.com')
+
+# 时间在固定的范围内生成, 同一个种子无论哪天运行都得到同样的数据
+DATE_START = datetime(2020, 1, 1)
+DATE_END = datetime(2020, 12, 31, 23, 59, 59)
+
+
+def _seeded(seed):
+    """按种子重置 Faker 并返回独立的 random 实例, 每一批数据只由自己的种子决定"""
+    fake.seed_instance(seed)
+    return random.Random(seed)
+
+
+def _timestamp():
+    return fake.date_time_between_dates(DATE_START, DATE_END)
 
-    for i in range(count):
-        category = Category(name=fake.word())
-        db.session.add(category)
-        try:
-            db.session.commit()
-        except IntegrityError:
-            db.session.rollback()
 
+def _text(rng, paragraphs, max_chars=2000):
+    """从本批预先生成的段落里拼出正文, 比逐篇调用 fake.text() 快得多"""
+    parts = [rng.choice(paragraphs)]
+    size = len(parts[0])
+    while True:
+        paragraph = rng.choice(paragraphs)
+        size += len(paragraph) + 1
+        if size > max_chars:
+            return '\n'.join(parts)
+        parts.append(paragraph)
 
-def fake_posts(count=50):
+
+def _post_rows(seed, count, category_ids):
+    rng = _seeded(seed)
+    paragraphs = [fake.paragraph(10) for i in range(200)]
+    rows = []
+    for i in range(count):
+        body = _text(rng, paragraphs)
+        timestamp = _timestamp()
+        row = dict(title=fake.sentence(), body=body, timestamp=timestamp, updated_at=timestamp,
+                   category_id=rng.randint(*category_ids))
+        # Core 批量插入不会触发 Post.body 的事件, 摘要在这里生成
+        row.update(post_summary(body))
+        rows.append(row)
+    return rows
+
+
+def _comment_rows(seed, count, post_ids, reviewed=True, from_admin=False):
+    rng = _seeded(seed)
+    rows = []
+    for i in range(count):
+        timestamp = _timestamp()
+        if from_admin:
+            row = dict(ADMIN_AUTHOR)
+        else:
+            row = dict(author=fake.name(), email=fake.email(), site=fake.url())
+        row.update(body=fake.sentence(), timestamp=timestamp, updated_at=timestamp,
+                   reviewed=reviewed, from_admin=from_admin, post_id=rng.randint(*post_ids))
+        rows.append(row)
+    return rows
+
+
+def _reply_rows(seed, count, comment_ids, from_admin=False):
+    rng = _seeded(seed)
+    rows = []
     for i in range(count):
-        post = Post(
-            title=fake.sentence(),
-            body=fake.text(2000),
-            category=Category.query.get(random.randint(1, Category.query.count())),
-            timestamp=fake.date_time_this_year()
-        )
-        db.session.add(post)
+        timestamp = _timestamp()
+        if from_admin:
+            row = dict(ADMIN_AUTHOR)
+        else:
+            row = dict(author=fake.name(), email=fake.email(), site=fake.url())
+        row.update(body=fake.sentence(), timestamp=timestamp, updated_at=timestamp,
+                   reviewed=True, from_admin=from_admin, comment_id=rng.randint(*comment_ids))
+        rows.append(row)
+    return rows
+
+
+def _call(job):
+    func, args = job
+    return func(*args)
+
+
+def _id_range(model):
+    """一次取出 id 范围, 生成外键时不再逐行查询"""
+    return tuple(db.session.query(db.func.min(model.id), db.func.max(model.id)).one())
+
+
+def _bulk_insert(model, func, count, seed, name, args=(), workers=None):
+    """分批生成数据并用 Core insert() executemany 写入, 整张表在一个事务里提交
+
+    每一批的种子由 seed、name 和批号决定, 所以结果与 workers 数量无关.
+    workers 大于 1 时由子进程并行运行 Faker, 主进程按批号顺序插入.
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    jobs = []
+    for index, offset in enumerate(range(0, count, CHUNK_SIZE)):
+        size = min(CHUNK_SIZE, count - offset)
+        jobs.append((func, ('%s-%s-%d' % (seed, name, index), size) + tuple(args)))
+
+    statement = model.__table__.insert()
+    if workers and workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            for rows in executor.map(_call, jobs):
+                db.session.execute(statement, rows)
+    else:
+        for job in jobs:
+            db.session.execute(statement, _call(job))
     db.session.commit()
 
 
-def fake_comments(count=500):
+def fake_categories(count=10, seed=None):
+    if seed is not None:
+        _seeded('%s-category' % seed)
+    names = ['Default']
     for i in range(count):
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
+        name = fake.word()
+        # 重复的名字直接跳过
+        if name not in names:
+            names.append(name)
+    db.session.execute(Category.__table__.insert(), [dict(name=name) for name in names])
+    db.session.commit()
+
+
+def fake_posts(count=50, seed=None, workers=None):
+    _bulk_insert(Post, _post_rows, count, seed, 'post', (_id_range(Category),), workers)
+
+
+def fake_comments(count=500, seed=None, workers=None):
+    post_ids = _id_range(Post)
+    _bulk_insert(Comment, _comment_rows, count, seed, 'comment', (post_ids,), workers)
 
     salt = int(count * 0.1)
-    for i in range(salt):
-        # 未审核评论
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=False,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-
-        # 管理员发表的评论
-        comment = Comment(
-            author='刘伯温',
-            email='mima@example.com',
-            site='example.com',
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            from_admin=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-    db.session.commit()
+    # 未审核评论
+    _bulk_insert(Comment, _comment_rows, salt, seed, 'unread', (post_ids, False), workers)
+    # 管理员发表的评论
+    _bulk_insert(Comment, _comment_rows, salt, seed, 'admin-comment', (post_ids, True, True), workers)
 
 
-def fake_reply(count=200):
-    for i in range(count):
-        reply = Reply(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            comment=Comment.query.get(random.randint(1, Comment.query.count()))
-        )
-        db.session.add(reply)
+def fake_reply(count=200, seed=None, workers=None):
+    comment_ids = _id_range(Comment)
+    _bulk_insert(Reply, _reply_rows, count, seed, 'reply', (comment_ids,), workers)
 
     salt = int(count * 0.5)
-    for i in range(salt):
-        # # 未审核评论
-        # reply = Reply(
-        #     author=fake.name(),
-        #     email=fake.email(),
-        #     site=fake.url(),
-        #     body=fake.sentence(),
-        #     timestamp=fake.date_time_this_year(),
-        #     reviewed=False,
-        #     comment=Comment.query.get(random.randint(1, Comment.query.count()))
-        # )
-        # db.session.add(reply)
-
-        # 管理员发表的评论
-        reply = Reply(
-            author='刘伯温',
-            email='mima@example.com',
-            site='example.com',
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            from_admin=True,
-            comment=Comment.query.get(random.randint(1, Comment.query.count()))
-        )
-        db.session.add(reply)
-    db.session.commit()
+    # 管理员发表的回复
+    _bulk_insert(Reply, _reply_rows, salt, seed, 'admin-reply', (comment_ids, True), workers)
 
 
 def fake_link():
@@ -148,3 +189,32 @@ def fake_link():
     db.session.add_all([twitter, facebook, linkedin, google])
     db.session.commit()
 
+
+# 重建数据库并生成全部假数据 (flask forge 和 flask bench 使用)
+def fake_all(category=10, post=50, comment=500, reply=200, echo=print, seed=None, workers=None):
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    db.drop_all()
+    db.create_all()
+
+    echo('Generating the administrator')
+    fake_admin()
+
+    echo('Generating %d categories...' % category)
+    fake_categories(category, seed)
+
+    echo('Generating %d posts...' % post)
+    fake_posts(post, seed, workers)
+    echo('Generating %d comments... ' % comment)
+    fake_comments(comment, seed, workers)
+    echo('Generating %d reply...' % reply)
+    fake_reply(reply, seed, workers)
+
+    echo('Generating the links')
+    fake_link()
+
+    echo('Counting...')
+    rebuild_counters()
+
+    echo('Indexing...')
+    search_index.reindex(current_app._get_current_object())
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import os
+import glob
+import tempfile
+from datetime import datetime
+
+from flask import current_app, render_template, send_file, has_request_context, abort
+
+from bluelog.extensions import db
+from bluelog.models import Post, Category
+from bluelog.signals import site_info_changed, post_changed
+from bluelog.utils import site_url_context
+
+
+class FeedStore(object):
+    """Atom 订阅: 全站一个 (index.atom), 每个分类一个 (category-<id>.atom), 生成后保存在 BLUELOG_FEED_PATH
+
+    请求只读取文件 (send_file 负责 ETag/Last-Modified 和 304), 文件不存在时才查询并渲染.
+    文章增删改 (post_changed) 时立即重新生成全站和相关分类的订阅; 博客标题或分类名称变化 (site_info_changed)
+    时删除全部, 下次请求时再生成. 内容没有变化时不改写文件, ETag 保持不变.
+    配置了 BLUELOG_SITE_URL 时订阅中的绝对 URL 以它为根, 否则取自当前请求.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_FEED_PATH', os.path.join(app.instance_path, 'feeds'))
+        app.config.setdefault('BLUELOG_FEED_SIZE', 20)
+        app.config.setdefault('BLUELOG_FEED_MAX_AGE', 300)
+        app.config.setdefault('BLUELOG_SITE_URL', None)
+        site_info_changed.connect(self._on_site_info_changed, app)
+        post_changed.connect(self._on_post_changed, app)
+
+    @staticmethod
+    def filename(app, category_id=None):
+        name = 'index' if category_id is None else 'category-%d' % category_id
+        return os.path.join(app.config['BLUELOG_FEED_PATH'], name + '.atom')
+
+    def build(self, category_id=None):
+        """查询最近的文章并渲染订阅, 返回文件名; 分类不存在时删除旧文件并返回 None"""
+        app = current_app._get_current_object()
+        filename = self.filename(app, category_id)
+        category = None
+        if category_id is not None:
+            category = Category.query.get(category_id)
+            if category is None:
+                self._remove(filename)
+                return None
+        query = Post.query.options(db.joinedload(Post.category))
+        if category is not None:
+            query = query.filter(Post.category_id == category.id)
+        posts = query.order_by(Post.timestamp.desc(), Post.id.desc()).limit(app.config['BLUELOG_FEED_SIZE']).all()
+        # 没有文章时使用固定的时间, 同样的内容总是生成同样的文件
+        updated = max([post.updated_at or post.timestamp for post in posts] or [datetime.utcfromtimestamp(0)])
+        with site_url_context(app):
+            data = render_template('blog/feed.xml', category=category, posts=posts, updated=updated).encode('utf-8')
+        self._write(filename, data)
+        return filename
+
+    def send(self, category_id=None):
+        app = current_app._get_current_object()
+        filename = self.filename(app, category_id)
+        if not os.path.exists(filename):
+            filename = self.build(category_id)
+            if filename is None:
+                abort(404)
+        return send_file(filename, mimetype='application/atom+xml', conditional=True,
+                         cache_timeout=app.config['BLUELOG_FEED_MAX_AGE'])
+
+    @staticmethod
+    def _write(filename, data):
+        try:
+            with open(filename, 'rb') as f:
+                if f.read() == data:
+                    return
+        except IOError:
+            pass
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, filename)
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+    def _on_site_info_changed(self, sender, **extra):
+        for filename in glob.glob(os.path.join(sender.config['BLUELOG_FEED_PATH'], '*.atom')):
+            self._remove(filename)
+
+    def _on_post_changed(self, sender, post_id, category_ids=(), **extra):
+        category_ids = [None] + sorted(set(category_id for category_id in category_ids if category_id))
+        for category_id in category_ids:
+            if sender.config['BLUELOG_SITE_URL']:
+                with site_url_context(sender):
+                    self.build(category_id)
+            elif has_request_context():
+                self.build(category_id)
+            else:
+                # 生成订阅需要用请求的域名拼出绝对 URL, 没有请求时留到下次访问
+                self._remove(self.filename(sender, category_id))
+
+
+feeds = FeedStore()
@@ -8,6 +8,7 @@
     @Software: PyCharm
 """
 
+from flask import current_app
 from flask_wtf import FlaskForm
 from wtforms import SubmitField, StringField, TextAreaField, HiddenField, PasswordField, BooleanField, SelectField
 from flask_ckeditor import CKEditorField
@@ -23,6 +24,13 @@ class CommentForm(FlaskForm):
     submit = SubmitField()
 
 
+def anonymous_comment_form():
+    """匿名访客的评论表单; 打开 BLUELOG_COMMENT_CSRF_EXEMPT 时不带 CSRF 令牌 (静态导出的页面里没有有效的令牌)"""
+    if current_app.config['BLUELOG_COMMENT_CSRF_EXEMPT']:
+        return CommentForm(meta={'csrf': False})
+    return CommentForm()
+
+
 class AdminCommentForm(CommentForm):
     name = HiddenField()
     email = HiddenField()
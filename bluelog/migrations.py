@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+from flask import current_app
+from sqlalchemy import inspect, text, orm
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateColumn
+
+from bluelog.extensions import db
+from bluelog.models import Admin, Category, Post, Comment, Reply, SchemaMigration, rebuild_counters, \
+    rebuild_post_summaries
+from bluelog.search import search_index
+
+# (版本, 函数), 按版本顺序执行
+MIGRATIONS = []
+
+
+def migration(version):
+    def decorator(func):
+        MIGRATIONS.append((version, func))
+        return func
+    return decorator
+
+
+def _create_index(connection, table, name):
+    """索引不存在时创建, 新建的库里 create_all 已经建好了"""
+    if name in [index['name'] for index in inspect(connection).get_indexes(table.name)]:
+        return False
+    index = [index for index in table.indexes if index.name == name][0]
+    index.create(connection)
+    return True
+
+
+def _add_column(connection, table, name, value):
+    """列不存在时添加, 并把已有的行设为 value"""
+    if name in [column['name'] for column in inspect(connection).get_columns(table.name)]:
+        return False
+    column = table.c[name]
+    connection.execute('ALTER TABLE %s ADD COLUMN %s' % (table.name, CreateColumn(column).compile(connection)))
+    connection.execute(table.update().values({column: value}))
+    return True
+
+
+@migration('0001')
+def hot_query_indexes(connection):
+    """评论、回复和分类文章列表的组合索引"""
+    _create_index(connection, Post.__table__, 'ix_post_category_timestamp')
+    _create_index(connection, Comment.__table__, 'ix_comment_post_reviewed_timestamp')
+    _create_index(connection, Comment.__table__, 'ix_comment_reviewed_timestamp')
+    _create_index(connection, Reply.__table__, 'ix_reply_comment_reviewed_timestamp')
+
+
+@migration('0002')
+def comment_spam(connection):
+    """评论的垃圾标记和按邮箱批量审核的索引"""
+    _add_column(connection, Comment.__table__, 'spam', False)
+    _create_index(connection, Comment.__table__, 'ix_comment_email')
+
+
+@migration('0003')
+def counters(connection):
+    """文章、分类和管理员的计数器列"""
+    added = [
+        _add_column(connection, Post.__table__, 'comment_count', 0),
+        _add_column(connection, Post.__table__, 'reviewed_comment_count', 0),
+        _add_column(connection, Post.__table__, 'reply_count', 0),
+        _add_column(connection, Category.__table__, 'post_count', 0),
+        _add_column(connection, Admin.__table__, 'unread_comment_count', 0),
+    ]
+    if any(added):
+        # 在迁移的事务里重新统计, 会话绑定到迁移的连接
+        rebuild_counters(orm.Session(bind=connection))
+
+
+@migration('0004')
+def timestamps(connection):
+    """文章、评论和回复的修改时间, 文章的最近评论时间; 已有的行取发布时间"""
+    post = Post.__table__
+    _add_column(connection, post, 'updated_at', post.c.timestamp)
+    _add_column(connection, Comment.__table__, 'updated_at', Comment.__table__.c.timestamp)
+    _add_column(connection, Reply.__table__, 'updated_at', Reply.__table__.c.timestamp)
+    comment = Comment.__table__
+    latest = db.select([db.func.max(comment.c.timestamp)]).where(comment.c.post_id == post.c.id).as_scalar()
+    _add_column(connection, post, 'commented_at', latest)
+
+
+@migration('0005')
+def post_summaries(connection):
+    """文章摘要和字数统计"""
+    added = [
+        _add_column(connection, Post.__table__, 'excerpt', None),
+        _add_column(connection, Post.__table__, 'word_count', 0),
+        _add_column(connection, Post.__table__, 'char_count', 0),
+    ]
+    if any(added):
+        rebuild_post_summaries(orm.Session(bind=connection))
+
+
+def pending():
+    if not db.engine.has_table(SchemaMigration.__tablename__):
+        return list(MIGRATIONS)
+    applied = set(version for version, in db.session.query(SchemaMigration.version))
+    return [(version, func) for version, func in MIGRATIONS if version not in applied]
+
+
+def upgrade(echo=print):
+    """创建缺少的表, 执行还没有执行过的迁移并准备搜索索引, 返回执行的版本列表"""
+    db.create_all()
+    versions = []
+    for version, func in pending():
+        if echo:
+            echo('Applying %s: %s' % (version, func.__doc__))
+        with db.engine.begin() as connection:
+            func(connection)
+            connection.execute(SchemaMigration.__table__.insert(),
+                               version=version, description=func.__doc__)
+        versions.append(version)
+    # 全文搜索的 FTS5 表在这里 (主库上) 创建, 而不是等到第一次搜索
+    search_index.backend(current_app._get_current_object())
+    return versions
+
+
+# ---- 热点查询的执行计划检查 ----
+
+# (名称, 生成查询的函数), 参数取任意存在或不存在的 id 都可以, 只看执行计划.
+# 带条件的查询都应该是 SEARCH; 只有不带条件的首页列表允许按索引顺序 SCAN (配合 LIMIT)
+HOT_QUERIES = (
+    ('post comments', lambda: Comment.query.filter_by(post_id=1, reviewed=True).order_by(Comment.timestamp.asc())),
+    ('post comment count', lambda: Comment.query.filter_by(post_id=1, reviewed=True).order_by(None)
+        .with_entities(db.func.count(Comment.id))),
+    ('unread comments', lambda: Comment.query.filter_by(reviewed=False, spam=False).order_by(
+        Comment.timestamp.desc(), Comment.id.desc()).limit(15)),
+    ('comment replies', lambda: Reply.query.filter_by(comment_id=1, reviewed=True).order_by(Reply.timestamp.asc())),
+    ('category posts', lambda: Post.listing().filter(Post.category_id == 1).order_by(
+        Post.timestamp.desc(), Post.id.desc()).limit(10)),
+    ('category post count', lambda: Post.query.filter_by(category_id=1).with_entities(db.func.count(Post.id))),
+    ('posts', lambda: Post.listing().order_by(Post.timestamp.desc(), Post.id.desc()).limit(10), True),
+)
+
+
+def explain(query):
+    """SQLite 的 EXPLAIN QUERY PLAN, 返回每一步的说明"""
+    # 使用命名参数编译, 以便交给 text() 执行
+    compiled = query.statement.compile(dialect=sqlite.dialect(paramstyle='named'))
+    rows = db.session.execute(text('EXPLAIN QUERY PLAN ' + str(compiled)), compiled.params)
+    return [row[-1] for row in rows]
+
+
+def full_scans(plan, index_scan=False):
+    """全表 (或整个索引) 扫描和为排序建立的临时 B 树, index_scan 时允许按索引扫描"""
+    return [step for step in plan if (step.startswith('SCAN') and not (index_scan and 'USING' in step))
+            or 'TEMP B-TREE' in step]
+
+
+def check_query_plans():
+    """返回 [(名称, 执行计划, 问题步骤)], 只支持 SQLite"""
+    if db.engine.dialect.name != 'sqlite':
+        raise RuntimeError('EXPLAIN QUERY PLAN is only supported on SQLite.')
+    results = []
+    for item in HOT_QUERIES:
+        name, factory, index_scan = (item + (False,))[:3]
+        plan = explain(factory())
+        results.append((name, plan, full_scans(plan, index_scan)))
+    return results
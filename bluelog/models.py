@@ -9,6 +9,8 @@
 """
 
 from bluelog.extensions import db
+from bluelog.utils import html_to_text, count_words, make_excerpt
+from sqlalchemy import event
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from datetime import datetime
@@ -22,6 +24,8 @@ class Admin(db.Model, UserMixin):
     bluelog_title = db.Column(db.String(60))
     bluelog_sub_title = db.Column(db.String(100))
     about = db.Column(db.Text)
+    # 全站未审核评论数
+    unread_comment_count = db.Column(db.Integer, default=0)
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -30,58 +34,195 @@ class Admin(db.Model, UserMixin):
         return check_password_hash(self.password_hash, password)
 
 
+# 不能删除的默认分类, 被删除分类下的文章移到这里
+DEFAULT_CATEGORY_ID = 1
+
+
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30), unique=True)
+    post_count = db.Column(db.Integer, default=0)
 
     posts = db.relationship('Post', back_populates='category')
 
+    def move_posts(self, target_id):
+        """用一条 UPDATE 把本分类的文章移到 target_id 分类, 返回移动的篇数; 随调用方的事务一起提交"""
+        moved = Post.query.filter(Post.category_id == self.id).update(
+            {Post.category_id: target_id}, synchronize_session=False)
+        bump_counter(Category, target_id, post_count=moved)
+        bump_counter(Category, self.id, post_count=-moved)
+        return moved
+
+    def merge_into(self, target_id):
+        """合并到另一个分类: 移动文章后删除本分类"""
+        moved = self.move_posts(target_id)
+        Category.query.filter(Category.id == self.id).delete(synchronize_session=False)
+        return moved
+
     def delete(self):
-        default_category = Category.query.get(1)
-        posts = self.posts[:]
-        for post in posts:
-            post.category = default_category
-        db.session.delete(self)
-        db.session.commit()
+        """删除分类, 文章移到默认分类"""
+        return self.merge_into(DEFAULT_CATEGORY_ID)
 
 
 class Post(db.Model):
+    # 分类页: WHERE category_id = ? ORDER BY timestamp DESC, id DESC (id 即 rowid, 已经在索引末尾)
+    __table_args__ = (db.Index('ix_post_category_timestamp', 'category_id', 'timestamp'),)
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255))
     body = db.Column(db.Text)
+    # 保存正文时生成的纯文本摘要和字数统计, 列表页不需要读取正文
+    excerpt = db.Column(db.Text)
+    word_count = db.Column(db.Integer, default=0)
+    char_count = db.Column(db.Integer, default=0)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     can_comment = db.Column(db.Boolean, default=True)
+    # 文章本身最后修改的时间, 以及公开评论区最后变化 (新评论/审核/删除/回复) 的时间
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    commented_at = db.Column(db.DateTime)
+
+    # 计数器, 由写操作维护, 可以通过 flask recount 重新统计
+    comment_count = db.Column(db.Integer, default=0)
+    reviewed_comment_count = db.Column(db.Integer, default=0)
+    reply_count = db.Column(db.Integer, default=0)
 
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
     category = db.relationship('Category', back_populates='posts')
 
     comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan')
 
+    @classmethod
+    def listing(cls):
+        """文章列表使用的查询: 同时取出分类, 避免模板里逐篇懒加载; 不读取正文"""
+        return cls.query.options(db.joinedload(cls.category), db.defer(cls.body))
+
+    @staticmethod
+    def touch_comments(post_id):
+        Post.query.filter(Post.id == post_id).update(
+            {Post.commented_at: datetime.utcnow()}, synchronize_session=False)
+
+    def delete(self):
+        bump_counter(Category, self.category_id, post_count=-1)
+        bump_counter(Admin, None, unread_comment_count=-Comment.query.with_parent(self).filter_by(
+            reviewed=False, spam=False).count())
+        db.session.delete(self)
+
 
 class Comment(db.Model):
+    __table_args__ = (
+        # 文章页的评论: WHERE post_id = ? AND reviewed = 1 ORDER BY timestamp, 也用于按文章计数
+        db.Index('ix_comment_post_reviewed_timestamp', 'post_id', 'reviewed', 'timestamp'),
+        # 后台的未审核评论: WHERE reviewed = 0 ORDER BY timestamp DESC, id DESC
+        db.Index('ix_comment_reviewed_timestamp', 'reviewed', 'timestamp'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     author = db.Column(db.String(30))
-    email = db.Column(db.String(255))
+    email = db.Column(db.String(255), index=True)
     site = db.Column(db.String(255))
     body = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     from_admin = db.Column(db.Boolean, default=False)
     reviewed = db.Column(db.Boolean, default=False)
+    # 标记为垃圾评论: 不公开, 也不计入未审核数
+    spam = db.Column(db.Boolean, default=False)
 
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
     post = db.relationship('Post', back_populates='comments')
 
     replies = db.relationship('Reply', back_populates='comment', cascade='all, delete-orphan')
 
+    def count(self, sign=1):
+        """新增 (sign=1) 或删除 (sign=-1) 评论时, 更新文章和站点的计数器"""
+        bump_counter(Post, self.post.id, comment_count=sign,
+                     reviewed_comment_count=sign if self.reviewed else 0)
+        if self.reviewed:
+            Post.touch_comments(self.post.id)
+        elif not self.spam:
+            bump_counter(Admin, None, unread_comment_count=sign)
+
+    def approve(self):
+        if not self.reviewed:
+            if not self.spam:
+                bump_counter(Admin, None, unread_comment_count=-1)
+            self.reviewed = True
+            self.spam = False
+            self.updated_at = datetime.utcnow()
+            bump_counter(Post, self.post_id, reviewed_comment_count=1)
+            Post.touch_comments(self.post_id)
+
+    def delete(self):
+        self.count(-1)
+        bump_counter(Post, self.post_id, reply_count=-Reply.query.with_parent(self).count())
+        db.session.delete(self)
+
+    # ---- 批量审核: criteria 是筛选评论的条件列表, 每个操作只执行一条 UPDATE/DELETE ----
+
+    @staticmethod
+    def _affected(criteria):
+        """按文章聚合符合条件的评论: {post_id: (总数, 已审核数, 未审核数)}"""
+        reviewed = db.func.sum(db.case([(Comment.reviewed == True, 1)], else_=0))
+        unread = db.func.sum(db.case([(db.and_(Comment.reviewed == False, Comment.spam == False), 1)], else_=0))
+        return dict((post_id, (total, reviewed_total or 0, unread_total or 0)) for post_id, total, reviewed_total,
+                    unread_total in db.session.query(Comment.post_id, db.func.count(Comment.id), reviewed, unread)
+                    .filter(*criteria).group_by(Comment.post_id))
+
+    @staticmethod
+    def approve_all(criteria):
+        """批量通过审核, 返回受影响的评论按文章的聚合 (见 _affected)"""
+        criteria = list(criteria) + [Comment.reviewed == False]
+        affected = Comment._affected(criteria)
+        if affected:
+            Comment.query.filter(*criteria).update(
+                {Comment.reviewed: True, Comment.spam: False, Comment.updated_at: datetime.utcnow()},
+                synchronize_session=False)
+            _bump_posts(affected, reviewed_comment_count=lambda total, reviewed, unread: total)
+            bump_counter(Admin, None, unread_comment_count=-sum(item[2] for item in affected.values()))
+        return affected
+
+    @staticmethod
+    def mark_spam_all(criteria):
+        """批量标记为垃圾评论, 已公开的会被撤下"""
+        criteria = list(criteria) + [Comment.spam == False]
+        affected = Comment._affected(criteria)
+        if affected:
+            Comment.query.filter(*criteria).update(
+                {Comment.reviewed: False, Comment.spam: True, Comment.updated_at: datetime.utcnow()},
+                synchronize_session=False)
+            _bump_posts(affected, reviewed_comment_count=lambda total, reviewed, unread: -reviewed)
+            bump_counter(Admin, None, unread_comment_count=-sum(item[2] for item in affected.values()))
+        return affected
+
+    @staticmethod
+    def delete_all(criteria):
+        """批量删除评论及其回复"""
+        affected = Comment._affected(criteria)
+        if affected:
+            ids = db.session.query(Comment.id).filter(*criteria)
+            replies = dict(db.session.query(Comment.post_id, db.func.count(Reply.id)).join(
+                Reply, Reply.comment_id == Comment.id).filter(*criteria).group_by(Comment.post_id))
+            Reply.query.filter(Reply.comment_id.in_(ids)).delete(synchronize_session=False)
+            Comment.query.filter(*criteria).delete(synchronize_session=False)
+            _bump_posts(affected, comment_count=lambda total, reviewed, unread: -total,
+                        reviewed_comment_count=lambda total, reviewed, unread: -reviewed,
+                        replies=replies)
+            bump_counter(Admin, None, unread_comment_count=-sum(item[2] for item in affected.values()))
+        return affected
+
 
 class Reply(db.Model):
+    # 评论下的回复: WHERE comment_id = ? AND reviewed = 1 ORDER BY timestamp
+    __table_args__ = (db.Index('ix_reply_comment_reviewed_timestamp', 'comment_id', 'reviewed', 'timestamp'),)
+
     id = db.Column(db.Integer, primary_key=True)
     author = db.Column(db.String(30))
     email = db.Column(db.String(255))
     site = db.Column(db.String(255))
     body = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     from_admin = db.Column(db.Boolean, default=False)
     reviewed = db.Column(db.Boolean, default=True)
@@ -94,3 +235,166 @@ class Link(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30))
     url = db.Column(db.String(255))
+
+
+class SearchDocument(db.Model):
+    """搜索索引里的一篇文档 (文章或已审核的评论), id 同时是 FTS5 表的 rowid"""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    kind = db.Column(db.String(10))
+    ref_id = db.Column(db.Integer)
+    post_id = db.Column(db.Integer, index=True)
+    # 加权后的词数, 纯 Python 索引计算 BM25 时使用
+    length = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime)
+
+
+class SearchPosting(db.Model):
+    """纯 Python 倒排索引的一条记录: 词在文档中的 (加权) 出现次数, 只在没有 FTS5 时使用"""
+    term = db.Column(db.String(64), primary_key=True)
+    document_id = db.Column(db.Integer, primary_key=True, index=True)
+    frequency = db.Column(db.Integer)
+
+
+class OutboxMessage(db.Model):
+    """发件箱里的一封邮件, 由 emails.MailOutbox 批量发送, 失败时按退避时间重试"""
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(255))
+    subject = db.Column(db.String(255))
+    html = db.Column(db.Text)
+    # 合并通知的键 (如 comment:<post_id>), 同一个键还没发出的通知合并为一封
+    digest_key = db.Column(db.String(64), index=True)
+    count = db.Column(db.Integer, default=1)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    send_after = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    sent_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text)
+    failed = db.Column(db.Boolean, default=False)
+    # 发送线程领取的批次, 超时后其他线程可以重新领取
+    claimed_by = db.Column(db.String(32))
+    claimed_until = db.Column(db.DateTime)
+
+
+class SchemaMigration(db.Model):
+    """已经执行过的迁移, 见 bluelog.migrations"""
+    version = db.Column(db.String(20), primary_key=True)
+    description = db.Column(db.String(255))
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+def post_summary(body):
+    """正文对应的摘要和字数统计, 批量插入 (绕过 ORM 事件) 时直接调用"""
+    text = html_to_text(body)
+    return dict(excerpt=make_excerpt(text), word_count=count_words(text), char_count=len(text))
+
+
+@event.listens_for(Post.body, 'set')
+def update_post_summary(target, value, oldvalue, initiator):
+    for key, value in post_summary(value).items():
+        setattr(target, key, value)
+
+
+def bump_counter(model, ident, **deltas):
+    """以 UPDATE ... SET col = col + n 的方式增减计数器, 随调用方的事务一起提交
+
+    ident 为 None 时更新整张表 (用于只有一行的 Admin).
+    """
+    values = dict((getattr(model, name), getattr(model, name) + delta)
+                  for name, delta in deltas.items() if delta)
+    if not values:
+        return
+    query = model.query
+    if ident is not None:
+        query = query.filter(model.id == ident)
+    query.update(values, synchronize_session=False)
+
+
+def _bump_posts(affected, replies=None, **counters):
+    """按 Comment._affected 的结果用一条 executemany 更新各文章的计数器, 并刷新评论区的修改时间"""
+    post = Post.__table__
+    names = sorted(counters)
+    values = dict((name, post.c[name] + db.bindparam('_' + name)) for name in names)
+    values['commented_at'] = db.bindparam('_now')
+    if replies is not None:
+        values['reply_count'] = post.c.reply_count - db.bindparam('_replies')
+    now = datetime.utcnow()
+    rows = []
+    for post_id, item in affected.items():
+        row = dict(('_' + name, counters[name](*item)) for name in names)
+        row.update(_id=post_id, _now=now)
+        if replies is not None:
+            row['_replies'] = replies.get(post_id, 0)
+        rows.append(row)
+    db.session.execute(post.update().where(post.c.id == db.bindparam('_id')).values(**values), rows)
+
+
+def rebuild_counters(session=None):
+    """根据评论/回复/文章表重新统计所有计数器
+
+    按外键分组聚合一次, 再用 executemany 写回; 避免对每一行执行相关子查询.
+    文章的 commented_at 取评论和回复的最新时间, 已经更晚的值 (例如之后删除过评论) 保持不变.
+    session 默认为 db.session, 迁移中传入绑定到迁移连接的会话.
+    """
+    session = session or db.session
+    counters = {}
+    reviewed = db.func.sum(db.case([(Comment.reviewed == True, 1)], else_=0))
+    for post_id, total, reviewed_total, latest in session.query(
+            Comment.post_id, db.func.count(Comment.id), reviewed, db.func.max(Comment.timestamp)).group_by(
+            Comment.post_id):
+        counters[post_id] = dict(_id=post_id, _comments=total, _reviewed=reviewed_total or 0, _replies=0,
+                                 _commented=latest)
+    for post_id, total, latest in session.query(
+            Comment.post_id, db.func.count(Reply.id), db.func.max(Reply.timestamp)).join(
+            Reply, Reply.comment_id == Comment.id).group_by(Comment.post_id):
+        counters[post_id]['_replies'] = total
+        counters[post_id]['_commented'] = max([time for time in (counters[post_id]['_commented'], latest) if time],
+                                              default=None)
+
+    post = Post.__table__
+    session.query(Post).update({Post.comment_count: 0, Post.reviewed_comment_count: 0, Post.reply_count: 0},
+                               synchronize_session=False)
+    if counters:
+        session.execute(post.update().where(post.c.id == db.bindparam('_id')).values(
+            comment_count=db.bindparam('_comments'),
+            reviewed_comment_count=db.bindparam('_reviewed'),
+            reply_count=db.bindparam('_replies'),
+            commented_at=db.case([(db.or_(post.c.commented_at == None,
+                                          post.c.commented_at < db.bindparam('_commented')),
+                                   db.bindparam('_commented'))], else_=post.c.commented_at),
+        ), list(counters.values()))
+
+    category = Category.__table__
+    session.query(Category).update({Category.post_count: 0}, synchronize_session=False)
+    rows = [dict(_id=category_id, _posts=total) for category_id, total in
+            session.query(Post.category_id, db.func.count(Post.id)).group_by(Post.category_id)
+            if category_id is not None]
+    if rows:
+        session.execute(category.update().where(category.c.id == db.bindparam('_id')).values(
+            post_count=db.bindparam('_posts')), rows)
+
+    session.query(Admin).update({
+        Admin.unread_comment_count: session.query(db.func.count(Comment.id)).filter(
+            Comment.reviewed == False, Comment.spam == False).scalar(),
+    }, synchronize_session=False)
+    session.commit()
+
+
+def rebuild_post_summaries(session=None, batch_size=500):
+    """按 id 分批为所有文章重新生成摘要和字数统计 (这些列出现之前保存的文章没有值)"""
+    session = session or db.session
+    post = Post.__table__
+    last_id = 0
+    while True:
+        rows = session.query(Post.id, Post.body).filter(Post.id > last_id).order_by(Post.id).limit(batch_size).all()
+        if not rows:
+            break
+        session.execute(post.update().where(post.c.id == db.bindparam('_id')).values(
+            excerpt=db.bindparam('_excerpt'), word_count=db.bindparam('_words'), char_count=db.bindparam('_chars')),
+            [dict(_id=post_id, **_summary_params(body)) for post_id, body in rows])
+        last_id = rows[-1][0]
+    session.commit()
+
+
+def _summary_params(body):
+    summary = post_summary(body)
+    return dict(_excerpt=summary['excerpt'], _words=summary['word_count'], _chars=summary['char_count'])
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+from datetime import datetime
+
+from flask import request, abort, url_for
+from werkzeug.utils import cached_property
+
+from bluelog.extensions import db
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(timestamp, ident):
+    return '%s_%d' % (timestamp.strftime(CURSOR_FORMAT), ident)
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, ident = cursor.split('_')
+        return datetime.strptime(timestamp, CURSOR_FORMAT), int(ident)
+    except (ValueError, AttributeError):
+        abort(400)
+
+
+def paginate(query, timestamp, ident, per_page, descending=True):
+    """列表分页
+
+    带有 ?page=N 参数时沿用原来的 OFFSET 分页, 保证旧链接可用;
+    否则使用 (timestamp, id) 游标分页, 直接在 timestamp 索引上定位, 不需要 OFFSET 和 COUNT(*).
+    """
+    page = request.args.get('page', type=int)
+    if page is not None:
+        if descending:
+            order = (timestamp.desc(), ident.desc())
+        else:
+            order = (timestamp.asc(), ident.asc())
+        return query.order_by(*order).paginate(page=page, per_page=per_page)
+    return KeysetPagination(query, timestamp, ident, per_page,
+                            after=request.args.get('after'),
+                            before=request.args.get('before'),
+                            descending=descending)
+
+
+class KeysetPagination(object):
+    """基于 (timestamp, id) 游标的分页
+
+    after 取当前排序下游标之后的一页, before 取游标之前的一页.
+    总数只有在模板访问 total 时才会统计.
+    """
+
+    keyset = True
+
+    def __init__(self, query, timestamp, ident, per_page, after=None, before=None, descending=True):
+        self.query = query
+        self.timestamp = timestamp
+        self.ident = ident
+        self.per_page = per_page
+        self.descending = descending
+
+        if after:
+            items = self._fetch(decode_cursor(after), forward=True)
+            self.has_prev = True
+            self.has_next = len(items) > per_page
+            items = items[:per_page]
+        elif before:
+            items = self._fetch(decode_cursor(before), forward=False)
+            self.has_prev = len(items) > per_page
+            self.has_next = True
+            items = items[:per_page][::-1]
+        else:
+            items = self._fetch(None, forward=True)
+            self.has_prev = False
+            self.has_next = len(items) > per_page
+            items = items[:per_page]
+        self.items = items
+
+    def _fetch(self, cursor, forward):
+        timestamp, ident = self.timestamp, self.ident
+        # forward 表示沿着列表的显示顺序往后翻
+        ascending = forward != self.descending
+        query = self.query
+        if cursor is not None:
+            if ascending:
+                query = query.filter(db.or_(timestamp > cursor[0],
+                                            db.and_(timestamp == cursor[0], ident > cursor[1])))
+            else:
+                query = query.filter(db.or_(timestamp < cursor[0],
+                                            db.and_(timestamp == cursor[0], ident < cursor[1])))
+        if ascending:
+            query = query.order_by(timestamp.asc(), ident.asc())
+        else:
+            query = query.order_by(timestamp.desc(), ident.desc())
+        return query.limit(self.per_page + 1).all()
+
+    def _cursor(self, item):
+        return encode_cursor(getattr(item, self.timestamp.key), getattr(item, self.ident.key))
+
+    def _url(self, **cursor):
+        args = request.args.to_dict()
+        for key in ('page', 'after', 'before'):
+            args.pop(key, None)
+        args.update(request.view_args or {})
+        args.update(cursor)
+        return url_for(request.endpoint, **args)
+
+    @cached_property
+    def prev_url(self):
+        if self.has_prev and self.items:
+            return self._url(before=self._cursor(self.items[0]))
+
+    @cached_property
+    def next_url(self):
+        if self.has_next and self.items:
+            return self._url(after=self._cursor(self.items[-1]))
+
+    @cached_property
+    def total(self):
+        return self.query.order_by(None).count()
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import json
+import time
+from collections import deque, defaultdict
+from threading import Lock
+
+from flask import g, request, has_request_context
+from flask.signals import request_started, request_finished, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def percentile(values, percent):
+    """最近秩法计算百分位数"""
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, int(round(percent / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(records):
+    """按视图端点汇总: 请求数、耗时百分位、平均查询数以及出现过的 N+1 语句"""
+    endpoints = defaultdict(list)
+    for record in records:
+        endpoints[record['endpoint']].append(record)
+
+    summary = {}
+    for endpoint, items in endpoints.items():
+        times = [item['time'] for item in items]
+        repeated = {}
+        for item in items:
+            for statement in item['repeated']:
+                repeated[statement['statement']] = max(repeated.get(statement['statement'], 0), statement['count'])
+        summary[endpoint] = dict(
+            requests=len(items),
+            p50=percentile(times, 50),
+            p95=percentile(times, 95),
+            p99=percentile(times, 99),
+            template_p50=percentile([item['template_time'] for item in items], 50),
+            sql_p50=percentile([item['sql_time'] for item in items], 50),
+            queries_avg=round(sum(item['query_count'] for item in items) / float(len(items)), 2),
+            queries_max=max(item['query_count'] for item in items),
+            repeated=[dict(statement=statement, count=count) for statement, count in
+                      sorted(repeated.items(), key=lambda item: -item[1])],
+        )
+    return summary
+
+
+class Profiler(object):
+    """请求和 SQL 的性能记录 (BLUELOG_PROFILE 开启时生效)
+
+    每个请求记录视图端点、总耗时、模板渲染耗时、查询次数、SQL 总耗时、最慢的几条语句,
+    同一条语句在一次请求中执行次数达到 BLUELOG_PROFILE_REPEAT 时记为疑似 N+1.
+    记录保存在内存环形缓冲区中, 设置了 BLUELOG_PROFILE_LOG 时同时追加写入该 JSON Lines 文件,
+    供 flask profile-report 统计.
+    """
+
+    _engine_hooked = False
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_PROFILE', False)
+        app.config.setdefault('BLUELOG_PROFILE_BUFFER', 1000)
+        app.config.setdefault('BLUELOG_PROFILE_LOG', None)
+        app.config.setdefault('BLUELOG_PROFILE_SLOWEST', 3)
+        app.config.setdefault('BLUELOG_PROFILE_REPEAT', 5)
+        if not app.config['BLUELOG_PROFILE']:
+            return
+
+        app.extensions['profiler'] = dict(
+            records=deque(maxlen=app.config['BLUELOG_PROFILE_BUFFER']), lock=Lock())
+        request_started.connect(self._request_started, app)
+        request_finished.connect(self._request_finished, app)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+
+        # 引擎事件挂在 Engine 类上, 只记录正在被统计的请求里的查询
+        if not Profiler._engine_hooked:
+            event.listen(Engine, 'before_cursor_execute', self._before_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_execute)
+            Profiler._engine_hooked = True
+
+    @staticmethod
+    def records(app):
+        state = app.extensions.get('profiler')
+        if state is None:
+            return []
+        with state['lock']:
+            return list(state['records'])
+
+    @staticmethod
+    def _request_started(sender, **extra):
+        g.profile = dict(start=time.perf_counter(), queries=[], template_time=0.0, template_start=[])
+
+    @staticmethod
+    def _before_render(sender, template, context, **extra):
+        profile = g.get('profile')
+        if profile is not None:
+            profile['template_start'].append(time.perf_counter())
+
+    @staticmethod
+    def _after_render(sender, template, context, **extra):
+        profile = g.get('profile')
+        if profile is not None and profile['template_start']:
+            profile['template_time'] += time.perf_counter() - profile['template_start'].pop()
+
+    @staticmethod
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+    @staticmethod
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('profile_start')
+        if not starts:
+            return
+        start = starts.pop()
+        if not has_request_context():
+            return
+        profile = g.get('profile')
+        if profile is not None:
+            profile['queries'].append((statement, time.perf_counter() - start))
+
+    def _request_finished(self, sender, response, **extra):
+        profile = g.pop('profile', None)
+        if profile is None or request.endpoint in (None, 'static'):
+            return
+        config = sender.config
+        queries = profile['queries']
+        counts = defaultdict(int)
+        for statement, _ in queries:
+            counts[statement] += 1
+        slowest = sorted(queries, key=lambda query: -query[1])[:config['BLUELOG_PROFILE_SLOWEST']]
+
+        record = dict(
+            endpoint=request.endpoint,
+            method=request.method,
+            path=request.full_path.rstrip('?'),
+            status=response.status_code,
+            timestamp=time.time(),
+            time=_ms(time.perf_counter() - profile['start']),
+            template_time=_ms(profile['template_time']),
+            query_count=len(queries),
+            sql_time=_ms(sum(duration for _, duration in queries)),
+            slowest=[dict(time=_ms(duration), statement=statement) for statement, duration in slowest],
+            repeated=[dict(statement=statement, count=count) for statement, count in counts.items()
+                      if count >= config['BLUELOG_PROFILE_REPEAT']],
+        )
+        state = sender.extensions['profiler']
+        with state['lock']:
+            state['records'].append(record)
+            if config['BLUELOG_PROFILE_LOG']:
+                with open(config['BLUELOG_PROFILE_LOG'], 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def load_records(filename):
+    records = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+profiler = Profiler()
@@ -0,0 +1,419 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import re
+import math
+from collections import Counter, defaultdict
+
+from flask import request, abort, url_for
+from markupsafe import Markup, escape
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from werkzeug.utils import cached_property
+
+from bluelog.extensions import db
+from bluelog.models import Post, Comment, SearchDocument, SearchPosting
+from bluelog.signals import post_changed, comment_changed
+from bluelog.utils import html_to_text, _cjk
+
+# 标题中的词按这个权重计入
+TITLE_WEIGHT = 5
+# BM25 参数
+K1 = 1.2
+B = 0.75
+BATCH_SIZE = 1000
+
+_run_re = re.compile(r'[%s]+|[^\W_%s]+' % (_cjk, _cjk))
+_cjk_re = re.compile(r'[%s]' % _cjk)
+
+
+def words(text):
+    """拉丁文按单词切分并转为小写, 中日韩文字保持连续的一段"""
+    return [word.lower() for word in _run_re.findall(text or '')]
+
+
+def tokenize(text):
+    """索引和查询共用的切词: 中日韩文字切成相邻的二元组 (单字保持单字), 与 Lucene CJKAnalyzer 相同"""
+    tokens = []
+    for word in words(text):
+        if _cjk_re.match(word) and len(word) > 1:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word[:64])
+    return tokens
+
+
+def document_id(kind, ref_id):
+    # 文章和评论共用一个 id 空间: 文章为偶数, 评论为奇数
+    return ref_id * 2 + (kind == 'comment')
+
+
+def highlight(text, query_words, width=160):
+    """截取第一个命中词附近的一段文本, 命中词用 <mark> 标出"""
+    text = text or ''
+    pattern = None
+    if query_words:
+        pattern = re.compile('|'.join(re.escape(word) for word in
+                                      sorted(set(query_words), key=len, reverse=True)), re.I)
+    match = pattern.search(text) if pattern else None
+    start = max(0, match.start() - width // 3) if match else 0
+    fragment = text[start:start + width]
+
+    parts = [Markup('&hellip;')] if start else []
+    last = 0
+    for match in pattern.finditer(fragment) if pattern else ():
+        parts.append(escape(fragment[last:match.start()]))
+        parts.append(Markup('<mark>%s</mark>') % match.group())
+        last = match.end()
+    parts.append(escape(fragment[last:]))
+    if start + width < len(text):
+        parts.append(Markup('&hellip;'))
+    return Markup('').join(parts)
+
+
+CREATE_FTS = ("CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING "
+              "fts5(title, body, tokenize='unicode61 remove_diacritics 0')")
+
+
+# FTS5 表跟随 search_document 表一起创建和删除, 这样 db.drop_all() / db.create_all() 之后索引不会残留旧数据
+@event.listens_for(SearchDocument.__table__, 'after_create')
+def create_fts(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        try:
+            connection.execute(CREATE_FTS)
+        except OperationalError:
+            # SQLite 没有编译 FTS5 模块, 使用纯 Python 索引
+            pass
+
+
+@event.listens_for(SearchDocument.__table__, 'before_drop')
+def drop_fts(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS search_fts')
+
+
+def _chunks(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class FTS5Backend(object):
+    """SQLite FTS5 虚拟表, 存放预先切好词的标题和正文, 排名使用内置的 bm25()"""
+
+    name = 'fts5'
+
+    def create(self):
+        db.session.execute(CREATE_FTS)
+
+    def drop(self):
+        db.session.execute('DROP TABLE IF EXISTS search_fts')
+
+    def add(self, documents):
+        if documents:
+            db.session.execute('INSERT INTO search_fts (rowid, title, body) VALUES (:id, :title, :body)', [
+                dict(id=document['id'], title=' '.join(document['title']), body=' '.join(document['body']))
+                for document in documents])
+
+    def remove(self, ids):
+        for chunk in _chunks(ids):
+            db.session.execute('DELETE FROM search_fts WHERE rowid IN (%s)' % ','.join(str(int(i)) for i in chunk))
+
+    def query(self, tokens, limit, cursor=None, forward=True):
+        # bm25() 越小越相关
+        params = dict(match=' '.join('"%s"' % token for token in tokens), limit=limit)
+        where = ''
+        if cursor is not None:
+            params['score'], params['id'] = cursor
+            if forward:
+                where = 'WHERE score > :score OR (score = :score AND id > :id)'
+            else:
+                where = 'WHERE score < :score OR (score = :score AND id < :id)'
+        order = 'score, id' if forward else 'score DESC, id DESC'
+        rows = db.session.execute(
+            'SELECT id, score FROM (SELECT rowid AS id, bm25(search_fts, %d, 1) AS score FROM search_fts '
+            'WHERE search_fts MATCH :match) %s ORDER BY %s LIMIT :limit' % (TITLE_WEIGHT, where, order), params)
+        return [(row.id, row.score) for row in rows]
+
+
+class InvertedIndexBackend(object):
+    """纯 Python 实现的倒排索引, 词表存放在 search_posting 表中, 在 Python 里计算 BM25"""
+
+    name = 'python'
+
+    def create(self):
+        pass
+
+    def drop(self):
+        SearchPosting.query.delete(synchronize_session=False)
+
+    def add(self, documents):
+        rows = []
+        for document in documents:
+            counts = Counter(document['body'])
+            for token in document['title']:
+                counts[token] += TITLE_WEIGHT
+            rows.extend(dict(term=term, document_id=document['id'], frequency=frequency)
+                        for term, frequency in counts.items())
+        if rows:
+            db.session.execute(SearchPosting.__table__.insert(), rows)
+
+    def remove(self, ids):
+        for chunk in _chunks(ids):
+            SearchPosting.query.filter(SearchPosting.document_id.in_(chunk)).delete(synchronize_session=False)
+
+    def query(self, tokens, limit, cursor=None, forward=True):
+        total, average = db.session.query(db.func.count(SearchDocument.id),
+                                          db.func.avg(SearchDocument.length)).one()
+        if not total:
+            return []
+        postings = defaultdict(dict)
+        for term, ident, frequency in db.session.query(
+                SearchPosting.term, SearchPosting.document_id, SearchPosting.frequency).filter(
+                SearchPosting.term.in_(tokens)):
+            postings[term][ident] = frequency
+        if len(postings) < len(tokens):
+            return []
+        # 所有词都出现的文档
+        candidates = set.intersection(*(set(documents) for documents in postings.values()))
+        lengths = {}
+        for chunk in _chunks(candidates):
+            lengths.update(db.session.query(SearchDocument.id, SearchDocument.length).filter(
+                SearchDocument.id.in_(chunk)))
+
+        hits = []
+        for ident in candidates:
+            score = 0.0
+            length = lengths.get(ident, 0)
+            for term, documents in postings.items():
+                idf = math.log((total - len(documents) + 0.5) / (len(documents) + 0.5) + 1)
+                frequency = documents[ident]
+                score += idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / float(average)))
+            # 与 FTS5 的 bm25() 一致: 越小越相关
+            hits.append((-score, ident))
+
+        hits.sort(reverse=not forward)
+        if cursor is not None:
+            hits = [hit for hit in hits if (hit > cursor if forward else hit < cursor)]
+        return [(ident, score) for score, ident in hits[:limit]]
+
+
+class SearchResult(object):
+
+    def __init__(self, kind, post, comment, title, snippet, score):
+        self.kind = kind
+        self.post = post
+        self.comment = comment
+        self.title = title
+        self.snippet = snippet
+        self.score = score
+
+
+class SearchPagination(object):
+    """搜索结果的游标分页, 游标为 (相关度, 文档 id), 接口与 pagination.KeysetPagination 一致"""
+
+    keyset = True
+
+    def __init__(self, backend, q, per_page, after=None, before=None):
+        self.q = q
+        self.query_words = words(q)
+        tokens = sorted(set(tokenize(q)))
+        if not tokens:
+            hits = []
+        elif before:
+            hits = backend.query(tokens, per_page + 1, self._decode(before), forward=False)
+        else:
+            hits = backend.query(tokens, per_page + 1, self._decode(after) if after else None)
+
+        if before:
+            self.has_prev = len(hits) > per_page
+            self.has_next = True
+            hits = hits[:per_page][::-1]
+        else:
+            self.has_prev = bool(after)
+            self.has_next = len(hits) > per_page
+            hits = hits[:per_page]
+        self.hits = hits
+        self.items = self._load(hits)
+
+    @staticmethod
+    def _decode(cursor):
+        try:
+            score, ident = cursor.rsplit('_', 1)
+            return float(score), int(ident)
+        except ValueError:
+            abort(400)
+
+    def _load(self, hits):
+        post_ids = [ident // 2 for ident, _ in hits if ident % 2 == 0]
+        comment_ids = [ident // 2 for ident, _ in hits if ident % 2 == 1]
+        posts = dict((post.id, post) for post in Post.query.options(db.joinedload(Post.category)).filter(
+            Post.id.in_(post_ids))) if post_ids else {}
+        comments = dict((comment.id, comment) for comment in Comment.query.options(
+            db.joinedload(Comment.post)).filter(Comment.id.in_(comment_ids))) if comment_ids else {}
+
+        items = []
+        for ident, score in hits:
+            if ident % 2 == 0:
+                post = posts.get(ident // 2)
+                if post is None:
+                    continue
+                items.append(SearchResult('post', post, None, highlight(post.title, self.query_words),
+                                          highlight(html_to_text(post.body), self.query_words), score))
+            else:
+                comment = comments.get(ident // 2)
+                if comment is None:
+                    continue
+                items.append(SearchResult('comment', comment.post, comment,
+                                          highlight(comment.post.title, self.query_words),
+                                          highlight(comment.body, self.query_words), score))
+        return items
+
+    @cached_property
+    def prev_url(self):
+        if self.has_prev and self.hits:
+            return url_for(request.endpoint, q=self.q, before='%r_%d' % (self.hits[0][1], self.hits[0][0]))
+
+    @cached_property
+    def next_url(self):
+        if self.has_next and self.hits:
+            return url_for(request.endpoint, q=self.q, after='%r_%d' % (self.hits[-1][1], self.hits[-1][0]))
+
+
+class SearchIndex(object):
+    """文章和已审核评论的全文搜索
+
+    数据库为 SQLite 且支持 FTS5 时使用 FTS5, 否则使用纯 Python 倒排索引 (BLUELOG_SEARCH_BACKEND 可以强制指定).
+    索引通过 post_changed / comment_changed 信号增量更新, flask reindex 完整重建.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_SEARCH_BACKEND', None)
+        app.config.setdefault('BLUELOG_SEARCH_RESULT_PER_PAGE', 10)
+        app.extensions['search'] = dict(backend=None)
+        post_changed.connect(self._on_post_changed, app)
+        comment_changed.connect(self._on_comment_changed, app)
+
+    @staticmethod
+    def backend(app):
+        state = app.extensions['search']
+        if state['backend'] is None:
+            name = app.config['BLUELOG_SEARCH_BACKEND']
+            if name is None:
+                name = 'fts5' if db.get_engine(app).dialect.name == 'sqlite' else 'python'
+            backend = FTS5Backend() if name == 'fts5' else InvertedIndexBackend()
+            try:
+                backend.create()
+                db.session.commit()
+            except OperationalError:
+                # SQLite 没有编译 FTS5 模块
+                db.session.rollback()
+                backend = InvertedIndexBackend()
+            state['backend'] = backend
+        return state['backend']
+
+    def search(self, app, q, per_page, after=None, before=None):
+        return SearchPagination(self.backend(app), q, per_page, after=after, before=before)
+
+    @staticmethod
+    def _post_document(post_id, title, body, updated_at):
+        title = tokenize(title)
+        body = tokenize(html_to_text(body))
+        return dict(id=document_id('post', post_id), kind='post', ref_id=post_id, post_id=post_id,
+                    title=title, body=body, length=len(title) * TITLE_WEIGHT + len(body), updated_at=updated_at)
+
+    @staticmethod
+    def _comment_document(comment_id, post_id, body, updated_at):
+        body = tokenize(body)
+        return dict(id=document_id('comment', comment_id), kind='comment', ref_id=comment_id, post_id=post_id,
+                    title=[], body=body, length=len(body), updated_at=updated_at)
+
+    def _add(self, backend, documents):
+        if documents:
+            db.session.execute(SearchDocument.__table__.insert(), [
+                dict((key, document[key]) for key in ('id', 'kind', 'ref_id', 'post_id', 'length', 'updated_at'))
+                for document in documents])
+            backend.add(documents)
+
+    def _remove(self, backend, ids):
+        if ids:
+            backend.remove(ids)
+            for chunk in _chunks(ids):
+                SearchDocument.query.filter(SearchDocument.id.in_(chunk)).delete(synchronize_session=False)
+
+    def reindex(self, app, echo=None):
+        """清空并重建整个索引, 返回 (文章数, 评论数)"""
+        backend = self.backend(app)
+        backend.drop()
+        SearchDocument.query.delete(synchronize_session=False)
+        backend.create()
+
+        counts = []
+        for kind, query, make in (
+                ('posts', db.session.query(Post.id, Post.title, Post.body, Post.updated_at), self._post_document),
+                ('comments', db.session.query(Comment.id, Comment.post_id, Comment.body, Comment.updated_at).filter(
+                    Comment.reviewed == True), self._comment_document)):
+            count = 0
+            batch = []
+            for row in query.yield_per(BATCH_SIZE):
+                batch.append(make(*row))
+                if len(batch) == BATCH_SIZE:
+                    self._add(backend, batch)
+                    count += len(batch)
+                    batch = []
+            self._add(backend, batch)
+            count += len(batch)
+            if echo:
+                echo('Indexed %d %s.' % (count, kind))
+            counts.append(count)
+        db.session.commit()
+        return tuple(counts)
+
+    def index_post(self, app, post_id):
+        """重新索引一篇文章; 文章已删除时同时删除它的评论"""
+        backend = self.backend(app)
+        ident = document_id('post', post_id)
+        self._remove(backend, [ident])
+        row = db.session.query(Post.title, Post.body, Post.updated_at).filter(Post.id == post_id).first()
+        if row is not None:
+            self._add(backend, [self._post_document(post_id, *row)])
+        else:
+            self._remove(backend, [ident for ident, in db.session.query(SearchDocument.id).filter(
+                SearchDocument.post_id == post_id)])
+        db.session.commit()
+
+    def index_comments(self, app, post_id):
+        """按 updated_at 对比文章下已审核的评论, 只增删有变化的部分"""
+        backend = self.backend(app)
+        indexed = dict(db.session.query(SearchDocument.ref_id, SearchDocument.updated_at).filter(
+            SearchDocument.post_id == post_id, SearchDocument.kind == 'comment'))
+        current = dict(db.session.query(Comment.id, Comment.updated_at).filter(
+            Comment.post_id == post_id, Comment.reviewed == True))
+
+        stale = [comment_id for comment_id, updated_at in indexed.items() if current.get(comment_id) != updated_at]
+        fresh = [comment_id for comment_id, updated_at in current.items() if indexed.get(comment_id) != updated_at]
+        self._remove(backend, [document_id('comment', comment_id) for comment_id in stale])
+        for chunk in _chunks(fresh):
+            self._add(backend, [self._comment_document(*row) for row in db.session.query(
+                Comment.id, Comment.post_id, Comment.body, Comment.updated_at).filter(Comment.id.in_(chunk))])
+        db.session.commit()
+
+    def _on_post_changed(self, sender, post_id, **extra):
+        self.index_post(sender, post_id)
+
+    def _on_comment_changed(self, sender, post_id, **extra):
+        self.index_comments(sender, post_id)
+
+
+search_index = SearchIndex()
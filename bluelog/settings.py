@@ -27,25 +27,110 @@ class BaseConfig():
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # SQLite 每个新连接执行的 PRAGMA: WAL 让读写互不阻塞, mmap/cache 单位分别为字节和 KB (负数)
+    BLUELOG_SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,
+        'busy_timeout': 5000,
+        'foreign_keys': 'ON',
+    }
+    # 连接池参数 (SQLite 文件数据库忽略 pool_pre_ping)
+    BLUELOG_DATABASE_POOL = {
+        'pool_size': int(os.getenv('DATABASE_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DATABASE_MAX_OVERFLOW', 10)),
+        'pool_recycle': int(os.getenv('DATABASE_POOL_RECYCLE', 3600)),
+        'pool_pre_ping': os.getenv('DATABASE_POOL_PRE_PING', '1') == '1',
+    }
+    # 只读副本, blog 蓝本的 GET 请求从这里读取
+    BLUELOG_DATABASE_REPLICA_URI = os.getenv('DATABASE_REPLICA_URI')
+
     CKEDITOR_ENABLE_CSRF = True
     CKEDITOR_FILE_UPLOADER = 'admin.upload_image'
 
     MAIL_SERVER = os.getenv('MAIL_SERVER')
-    MAIL_PORT = 465
-    MAIL_USE_SSL = True
+    MAIL_PORT = int(os.getenv('MAIL_PORT', 465))
+    MAIL_USE_SSL = os.getenv('MAIL_USE_SSL', '1') == '1'
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = ('博客', MAIL_USERNAME)
 
     BLUELOG_EMAIL = os.getenv('BLUELOG_EMAIL')
+    # 发件箱: 每个进程的发送线程数 (0 表示只通过 flask send-mail 发送), 每批封数,
+    # 同一篇文章的通知合并的时间窗口 (分钟), 重试的初始间隔 (秒, 每次翻倍) 和最多尝试次数
+    BLUELOG_MAIL_WORKERS = int(os.getenv('BLUELOG_MAIL_WORKERS', 1))
+    BLUELOG_MAIL_BATCH_SIZE = 20
+    BLUELOG_MAIL_DIGEST_WINDOW = 10
+    BLUELOG_MAIL_RETRY_DELAY = 60
+    BLUELOG_MAIL_MAX_ATTEMPTS = 5
     BLUELOG_POST_PER_PAGE = 10
     BLUELOG_MANAGE_POST_PAGE = 15
     BLUELOG_COMMENT_PRE_PAGE = 15
+    # JSON 接口每页条数 (?limit=) 和一次最多查询回复的评论数的上限
+    BLUELOG_API_MAX_PAGE_SIZE = 50
 
     THEME = {'Perfect Pink': 'journal', 'Black Swan': 'black_swan', 'Perfect Blue': 'perfect_blue'}
 
     BLUELOG_UPLOAD_PATH = os.path.join(basedir, 'uploads')
     BLUELOG_ALLOWED_IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif']
+    # 上传图片生成的缩略图宽度 (需要 Pillow) 和生成缩略图的进程数 (0 表示在请求中直接生成)
+    BLUELOG_IMAGE_WIDTHS = [480, 960, 1600]
+    BLUELOG_IMAGE_WORKERS = int(os.getenv('BLUELOG_IMAGE_WORKERS', 1))
+    # 由前端服务器发送上传的文件: None / 'x-sendfile' (Apache, lighttpd) / 'x-accel-redirect' (Nginx, 内部 location 为 PREFIX)
+    BLUELOG_SENDFILE = os.getenv('BLUELOG_SENDFILE')
+    BLUELOG_SENDFILE_PREFIX = '/_uploads/'
+
+    BLUELOG_CACHE_PATH = os.path.join(basedir, 'cache')
+    BLUELOG_SITE_STAMP = os.path.join(BLUELOG_CACHE_PATH, 'site.stamp')
+
+    # 匿名读者整页缓存: None (关闭) / 'memory' (进程内 LRU) / 'filesystem'
+    # memory 的各个 worker 通过 PAGE_CACHE_STAMP 时间戳文件感知其他进程的失效操作
+    BLUELOG_PAGE_CACHE = os.getenv('BLUELOG_PAGE_CACHE')
+    BLUELOG_PAGE_CACHE_SIZE = 500
+    BLUELOG_PAGE_CACHE_PATH = os.path.join(BLUELOG_CACHE_PATH, 'pages')
+    BLUELOG_PAGE_CACHE_STAMP = os.path.join(BLUELOG_CACHE_PATH, 'pages.stamp')
+
+    # Atom 订阅文件的位置、条数和 Cache-Control 的 max-age (秒)
+    BLUELOG_FEED_PATH = os.path.join(BLUELOG_CACHE_PATH, 'feeds')
+    BLUELOG_FEED_SIZE = 20
+    BLUELOG_FEED_MAX_AGE = 300
+
+    # sitemap: 每个子 sitemap 最多 SIZE 个 URL.
+    # SITE_URL: 订阅和 sitemap 中绝对 URL 的根, 设置后不再使用请求的 Host 头 (可以被伪造), 生产环境应该设置
+    BLUELOG_SITEMAP_PATH = os.path.join(BLUELOG_CACHE_PATH, 'sitemaps')
+    BLUELOG_SITEMAP_SIZE = 50000
+    BLUELOG_SITEMAP_MAX_AGE = 3600
+    BLUELOG_SITE_URL = os.getenv('BLUELOG_SITE_URL')
+
+    # flask export 的输出目录; 打开 ON_WRITE 后管理员每次修改都会在后台增量导出
+    BLUELOG_EXPORT_PATH = os.getenv('BLUELOG_EXPORT_PATH', os.path.join(basedir, 'export'))
+    BLUELOG_EXPORT_ON_WRITE = os.getenv('BLUELOG_EXPORT_ON_WRITE') == '1'
+    BLUELOG_EXPORT_WORKERS = None
+    # 静态导出的页面里的评论表单没有 CSRF 令牌, 需要接受导出页面提交的评论时打开, 匿名评论不再校验 CSRF
+    BLUELOG_COMMENT_CSRF_EXEMPT = os.getenv('BLUELOG_COMMENT_CSRF_EXEMPT') == '1'
+
+    # 全文搜索: None 时 SQLite 使用 FTS5, 其他数据库使用纯 Python 倒排索引; 也可以指定 'fts5' / 'python'
+    BLUELOG_SEARCH_BACKEND = os.getenv('BLUELOG_SEARCH_BACKEND')
+    BLUELOG_SEARCH_RESULT_PER_PAGE = 10
+
+    # ASGI 部署 (bluelog.asgi) 的数据库/WSGI 线程池大小
+    BLUELOG_ASGI_WORKERS = int(os.getenv('BLUELOG_ASGI_WORKERS', 4))
+
+    # 文章页流式渲染: 先发出页头和正文, 再查询和渲染评论; BUFFER 为评论区每次发送的字节数
+    BLUELOG_STREAM_POST = os.getenv('BLUELOG_STREAM_POST') == '1'
+    BLUELOG_STREAM_BUFFER = 8192
+
+    # 响应压缩: 只压缩 MIMETYPES 中的类型和不小于 MIN_SIZE 字节的响应 (流式响应总是压缩)
+    BLUELOG_COMPRESS = os.getenv('BLUELOG_COMPRESS', '1') == '1'
+    BLUELOG_COMPRESS_MIN_SIZE = 500
+    BLUELOG_COMPRESS_LEVEL = int(os.getenv('BLUELOG_COMPRESS_LEVEL', 6))
+    BLUELOG_COMPRESS_BROTLI_QUALITY = int(os.getenv('BLUELOG_COMPRESS_BROTLI_QUALITY', 4))
+
+    # 请求/SQL 性能记录, 结果见 /admin/profile 和 flask profile-report
+    BLUELOG_PROFILE = os.getenv('BLUELOG_PROFILE') == '1'
+    BLUELOG_PROFILE_BUFFER = 1000
+    BLUELOG_PROFILE_LOG = os.getenv('BLUELOG_PROFILE_LOG')
 
 
 class DevelopmentConfig(BaseConfig):
@@ -56,6 +141,11 @@ class TestingConfig(BaseConfig):
     TESTING = True
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = prefix + ':memory:'
+    BLUELOG_SITE_STAMP = None
+    BLUELOG_PAGE_CACHE = None
+    BLUELOG_PAGE_CACHE_STAMP = None
+    BLUELOG_MAIL_WORKERS = 0
+    BLUELOG_IMAGE_WORKERS = 0
 
 
 class ProductionConfig(BaseConfig):
@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+from flask.signals import Namespace
+
+
+bluelog_signals = Namespace()
+
+# 管理员修改了博客信息、分类或链接 (侧边栏/导航栏内容发生变化)
+site_changed = bluelog_signals.signal('site-changed')
+
+# 博客标题/作者或分类名称变化 (分类改名、合并、删除), 会同时发送 site_changed; 订阅中的这些信息需要重新生成
+site_info_changed = bluelog_signals.signal('site-info-changed')
+
+# 文章被新建、修改或删除, 参数: post_id, category_ids (受影响的分类)
+post_changed = bluelog_signals.signal('post-changed')
+
+# 文章下公开可见的评论/回复发生变化, 参数: post_id, category_id
+comment_changed = bluelog_signals.signal('comment-changed')
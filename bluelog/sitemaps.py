@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import os
+import re
+import json
+import glob
+import tempfile
+from xml.sax.saxutils import escape
+
+from flask import current_app, url_for, send_file, abort
+
+from bluelog.extensions import db
+from bluelog.models import Post, Category
+from bluelog.signals import site_changed, post_changed, comment_changed
+from bluelog.utils import site_url_context
+
+INDEX = 'sitemap'
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+# 子 sitemap: posts-<k> 为 id 在 (k * SIZE, (k + 1) * SIZE] 之间的文章, pages-<k> 为首页、关于页和各个列表页
+_shard_re = re.compile(r'^(posts|pages)-(\d+)$')
+
+
+def _lastmod(*times):
+    times = [time for time in times if time is not None]
+    return max(times).strftime('%Y-%m-%dT%H:%M:%S+00:00') if times else None
+
+
+def _max(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+class SitemapStore(object):
+    """sitemap.xml 索引和分片的子 sitemap, 保存在 BLUELOG_SITEMAP_PATH
+
+    文章按 id 区间分片, 每片最多 BLUELOG_SITEMAP_SIZE 个 URL, 用 yield_per 逐行读取并写入文件, 不会一次加载所有文章.
+    lastmod 取文章的发布、修改和最近评论时间. 文章或评论变化时只删除所在的分片、列表页和索引,
+    下次请求索引 (或该分片) 时重新生成缺少的文件; flask sitemap 重新生成全部.
+    各分片的 lastmod 记录在 sitemaps.json 中, 生成索引时不需要读取分片.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_SITEMAP_PATH', os.path.join(app.instance_path, 'sitemaps'))
+        app.config.setdefault('BLUELOG_SITEMAP_SIZE', 50000)
+        app.config.setdefault('BLUELOG_SITEMAP_MAX_AGE', 3600)
+        app.config.setdefault('BLUELOG_SITE_URL', None)
+        post_changed.connect(self._on_post_changed, app)
+        comment_changed.connect(self._on_post_changed, app)
+        site_changed.connect(self._on_site_changed, app)
+
+    @staticmethod
+    def filename(app, name):
+        return os.path.join(app.config['BLUELOG_SITEMAP_PATH'], name + '.xml')
+
+    # ---- 请求 ----
+
+    def send(self, name=INDEX):
+        app = current_app._get_current_object()
+        filename = self.filename(app, name)
+        if not os.path.exists(filename):
+            match = _shard_re.match(name)
+            if name != INDEX and match is None:
+                abort(404)
+            # 生成的文件对所有人相同, 配置了 BLUELOG_SITE_URL 时不使用请求的 Host 头
+            with site_url_context(app):
+                if name == INDEX:
+                    self.build_index(app)
+                else:
+                    self._update_manifest(app, self._build_shard(app, match.group(1), int(match.group(2))))
+            if not os.path.exists(filename):
+                abort(404)
+        return send_file(filename, mimetype='application/xml', conditional=True,
+                         cache_timeout=app.config['BLUELOG_SITEMAP_MAX_AGE'])
+
+    # ---- 生成 (需要请求上下文来生成绝对 URL) ----
+
+    def rebuild(self, app, base_url=None):
+        """删除全部文件后重新生成, 返回 {子 sitemap: lastmod}"""
+        base_url = base_url or app.config['BLUELOG_SITE_URL']
+        if not base_url:
+            raise ValueError('BLUELOG_SITE_URL or base_url is required to build absolute URLs.')
+        with app.test_request_context('/', base_url=base_url):
+            for filename in glob.glob(os.path.join(app.config['BLUELOG_SITEMAP_PATH'], '*.*')):
+                os.remove(filename)
+            return self.build_index(app)
+
+    def build_index(self, app):
+        """生成缺少的子 sitemap 和索引"""
+        manifest = self._load_manifest(app)
+        size = app.config['BLUELOG_SITEMAP_SIZE']
+        max_id = db.session.query(db.func.max(Post.id)).scalar() or 0
+        shards = {}
+        for k in range((max_id + size - 1) // size):
+            name = 'posts-%d' % k
+            if name in manifest and os.path.exists(self.filename(app, name)):
+                shards[name] = manifest[name]
+            else:
+                shards.update(self._build_shard(app, 'posts', k))
+        pages = dict((name, lastmod) for name, lastmod in manifest.items() if name.startswith('pages-'))
+        if not pages or not all(os.path.exists(self.filename(app, name)) for name in pages):
+            pages = self.build_pages(app)
+        shards.update(pages)
+
+        # 删除已经不需要的分片 (例如文章被删除后空出来的区间)
+        for filename in glob.glob(os.path.join(app.config['BLUELOG_SITEMAP_PATH'], '*-*.xml')):
+            if os.path.basename(filename)[:-4] not in shards:
+                os.remove(filename)
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>\n', '<sitemapindex xmlns="%s">\n' % SITEMAP_NS]
+        for name in sorted(shards, key=_sort_key):
+            lines.append('<sitemap><loc>%s</loc>%s</sitemap>\n' % (
+                escape(url_for('blog.sitemap_shard', name=name, _external=True)),
+                '<lastmod>%s</lastmod>' % shards[name] if shards[name] else ''))
+        lines.append('</sitemapindex>\n')
+        self._write(self.filename(app, INDEX), lines)
+        self._save_manifest(app, shards)
+        return shards
+
+    def _build_shard(self, app, kind, k):
+        if kind == 'pages':
+            return self.build_pages(app)
+        return self.build_posts(app, k)
+
+    def build_posts(self, app, k):
+        """生成 posts-<k>, 区间内没有文章时删除它, 返回 {名称: lastmod}"""
+        size = app.config['BLUELOG_SITEMAP_SIZE']
+        name = 'posts-%d' % k
+        rows = db.session.query(Post.id, Post.timestamp, Post.updated_at, Post.commented_at).filter(
+            Post.id > k * size, Post.id <= (k + 1) * size).order_by(Post.id).yield_per(1000)
+        # 文章页的 URL 只有 id 不同, 生成一次后拼接, 不必对每篇文章调用 url_for
+        prefix = url_for('blog.show_post', post_id=0, _external=True)[:-1]
+        urls = ((prefix + str(row.id), _lastmod(row.timestamp, row.updated_at, row.commented_at)) for row in rows)
+        lastmod = self._write_urlset(self.filename(app, name), urls)
+        if lastmod is False:
+            return {}
+        return {name: lastmod}
+
+    def build_pages(self, app):
+        """首页、关于页、分类页和它们的 ?page=N 列表页, 超过 BLUELOG_SITEMAP_SIZE 时分成多个 pages-<k>"""
+        size = app.config['BLUELOG_SITEMAP_SIZE']
+        shards = {}
+        urls = self._page_urls(app)
+        k = 0
+        while True:
+            name = 'pages-%d' % k
+            lastmod = self._write_urlset(self.filename(app, name), _take(urls, size))
+            if lastmod is False:
+                break
+            shards[name] = lastmod
+            k += 1
+        return shards
+
+    @staticmethod
+    def _page_urls(app):
+        per_page = app.config['BLUELOG_POST_PER_PAGE']
+        count, created, updated, commented = db.session.query(
+            db.func.count(Post.id), db.func.max(Post.timestamp), db.func.max(Post.updated_at),
+            db.func.max(Post.commented_at)).one()
+        lastmod = _lastmod(created, updated, commented)
+        yield url_for('blog.index', _external=True), lastmod
+        for page in range(2, (count + per_page - 1) // per_page + 1):
+            yield url_for('blog.index', page=page, _external=True), lastmod
+        yield url_for('blog.about', _external=True), None
+
+        categories = db.session.query(
+            Category.id, db.func.count(Post.id), db.func.max(Post.timestamp), db.func.max(Post.updated_at),
+            db.func.max(Post.commented_at)).outerjoin(Post, Post.category_id == Category.id).group_by(
+            Category.id).order_by(Category.id)
+        for category_id, count, created, updated, commented in categories:
+            lastmod = _lastmod(created, updated, commented)
+            yield url_for('blog.show_category', category_id=category_id, _external=True), lastmod
+            for page in range(2, (count + per_page - 1) // per_page + 1):
+                yield url_for('blog.show_category', category_id=category_id, page=page, _external=True), lastmod
+
+    # ---- 文件 ----
+
+    def _write_urlset(self, filename, urls):
+        """逐个写入 <url>, 返回其中最新的 lastmod; 没有 URL 时删除文件并返回 False"""
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        newest = None
+        count = 0
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write('<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="%s">\n' % SITEMAP_NS)
+                for loc, lastmod in urls:
+                    if lastmod:
+                        f.write('<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (escape(loc), lastmod))
+                        newest = _max(newest, lastmod)
+                    else:
+                        f.write('<url><loc>%s</loc></url>\n' % escape(loc))
+                    count += 1
+                f.write('</urlset>\n')
+            if not count:
+                self._remove(filename)
+                return False
+            os.replace(tmp, filename)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return newest
+
+    def _write(self, filename, lines):
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(tmp, filename)
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _manifest_filename(app):
+        return os.path.join(app.config['BLUELOG_SITEMAP_PATH'], 'sitemaps.json')
+
+    def _load_manifest(self, app):
+        try:
+            with open(self._manifest_filename(app)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_manifest(self, app, shards):
+        self._write(self._manifest_filename(app), [json.dumps(shards, sort_keys=True)])
+
+    def _update_manifest(self, app, shards):
+        manifest = self._load_manifest(app)
+        manifest.update(shards)
+        self._save_manifest(app, manifest)
+
+    # ---- 失效 ----
+
+    def _invalidate(self, app, names):
+        for name in names:
+            self._remove(self.filename(app, name))
+        for filename in glob.glob(os.path.join(app.config['BLUELOG_SITEMAP_PATH'], 'pages-*.xml')):
+            self._remove(filename)
+        self._remove(self.filename(app, INDEX))
+
+    def _on_post_changed(self, sender, post_id, **extra):
+        # 文章和评论变化改变所在分片和列表页的 lastmod
+        self._invalidate(sender, ['posts-%d' % ((post_id - 1) // sender.config['BLUELOG_SITEMAP_SIZE'])])
+
+    def _on_site_changed(self, sender, **extra):
+        # 分类增删、合并只影响列表页
+        self._invalidate(sender, [])
+
+
+def _take(iterator, count):
+    for i, item in zip(range(count), iterator):
+        yield item
+
+
+def _sort_key(name):
+    kind, k = name.rsplit('-', 1)
+    return kind, int(k)
+
+
+sitemaps = SitemapStore()
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+from flask import current_app, g, stream_with_context, before_render_template, template_rendered, \
+    get_flashed_messages
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from markupsafe import Markup
+
+# 模板中 stream_flush() 输出的标记, 流式渲染时在这里把已经渲染的内容发出去
+FLUSH_MARKER = '\x00bluelog-flush\x00'
+
+
+def stream_flush():
+    """模板中使用: 流式渲染时立即发送前面的内容, 普通渲染时什么也不输出"""
+    return Markup(FLUSH_MARKER) if g.get('bluelog_streaming') else ''
+
+
+def stream_template(template_name, **context):
+    """与 render_template 相同, 但返回逐段生成 HTML 的响应
+
+    内容在 stream_flush() 处和累积超过 BLUELOG_STREAM_BUFFER 字节时发出; 模板中的延迟查询 (例如评论)
+    在前面的内容发出之后才执行. 这些查询发生在 after_request 之后, 不会计入 Profiler 的记录.
+    会话在生成器开始之前已经保存, 所以闪现消息和 CSRF 令牌要在这里提前取出 (结果缓存在请求上下文和 g 中,
+    模板里再调用时直接使用), 否则消息不会从会话中删除, 新的令牌也不会写入会话.
+    """
+    app = current_app._get_current_object()
+    get_flashed_messages()
+    if 'csrf' in app.extensions and current_user.is_authenticated:
+        # 只有管理员看到的表单在模板中调用 csrf_token(), 不为匿名访客创建会话
+        generate_csrf()
+    template = app.jinja_env.get_or_select_template(template_name)
+    app.update_template_context(context)
+    limit = app.config['BLUELOG_STREAM_BUFFER']
+    g.bluelog_streaming = True
+
+    def generate():
+        before_render_template.send(app, template=template, context=context)
+        buffer = []
+        size = 0
+        for chunk in template.generate(context):
+            parts = chunk.split(FLUSH_MARKER)
+            for i, part in enumerate(parts):
+                if i and buffer:
+                    yield ''.join(buffer)
+                    buffer, size = [], 0
+                if part:
+                    buffer.append(part)
+                    size += len(part)
+            if size >= limit:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer)
+        template_rendered.send(app, template=template, context=context)
+
+    return app.response_class(stream_with_context(generate()), mimetype='text/html')
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import os
+import re
+import json
+import hashlib
+import tempfile
+import mimetypes
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+from flask import current_app, send_from_directory, make_response, url_for, abort
+from flask.helpers import safe_join
+from markupsafe import escape
+
+try:
+    from PIL import Image
+except ImportError:  # 没有 Pillow 时只保存原图
+    Image = None
+
+CHUNK_SIZE = 64 * 1024
+
+# 按内容寻址的文件名: <前两位>/<sha256>.<扩展名>, 缩略图为 <sha256>-<宽度>.<扩展名|webp>
+_hashed_re = re.compile(r'^([0-9a-f]{2})/([0-9a-f]{64})(?:-(\d+))?\.(\w+)$')
+_picture_re = re.compile(r'<picture class="bluelog-image">(?:<source[^>]*>)*(<img[^>]*>)</picture>')
+_img_re = re.compile(r'<img\b[^>]*>')
+_src_re = re.compile(r'\ssrc="([^"]+)"')
+_srcset_re = re.compile(r'\s(?:srcset|sizes)="[^"]*"')
+
+
+def _variants(width, widths, ext):
+    """原图宽度为 width 时会生成的缩略图: [(宽度, 扩展名)], 不放大, GIF 不处理 (可能是动图)"""
+    if not width or ext == 'gif':
+        return []
+    sizes = sorted(w for w in widths if w < width)
+    return [(w, e) for w in sizes for e in (ext, 'webp')] + [(width, 'webp')]
+
+
+def make_variants(path, widths, quality=82):
+    """在进程池中运行: 生成缩略图和 WebP, 已经存在的跳过"""
+    base, ext = os.path.splitext(path)
+    ext = ext[1:]
+    with Image.open(path) as image:
+        image.load()
+        width, height = image.size
+        for w, e in _variants(width, widths, ext):
+            target = '%s-%d.%s' % (base, w, e) if w != width else '%s.%s' % (base, e)
+            if os.path.exists(target):
+                continue
+            resized = image if w == width else image.resize((w, max(1, round(height * w / width))), Image.LANCZOS)
+            if e in ('jpg', 'jpeg') and resized.mode not in ('RGB', 'L'):
+                resized = resized.convert('RGB')
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.' + e)
+            os.close(fd)
+            resized.save(tmp, 'WEBP' if e == 'webp' else None, quality=quality)
+            os.replace(tmp, target)
+
+
+class ImageStore(object):
+    """图片上传: 按内容哈希保存 (相同的图片只存一份), 后台进程池生成缩略图和 WebP
+
+    元数据 (宽高和缩略图列表) 保存在原图旁边的 .json 文件里, 保存文章时据此把正文中的图片改写为带 srcset 的 <picture>.
+    按哈希命名的文件内容不会变化, 返回一年的 immutable 缓存头; 配置 BLUELOG_SENDFILE 后由前端服务器发送文件.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_IMAGE_WIDTHS', [480, 960, 1600])
+        app.config.setdefault('BLUELOG_IMAGE_QUALITY', 82)
+        app.config.setdefault('BLUELOG_IMAGE_WORKERS', 1)
+        app.config.setdefault('BLUELOG_SENDFILE', None)
+        app.config.setdefault('BLUELOG_SENDFILE_PREFIX', '/_uploads/')
+        if app.config['BLUELOG_SENDFILE'] == 'x-sendfile':
+            app.config['USE_X_SENDFILE'] = True
+        app.extensions['image_store'] = dict(lock=Lock(), pool=None, pid=None)
+
+    # ---- 保存 ----
+
+    def save(self, storage):
+        """分块写入临时文件并计算哈希, 返回相对于 BLUELOG_UPLOAD_PATH 的文件名"""
+        app = current_app._get_current_object()
+        root = app.config['BLUELOG_UPLOAD_PATH']
+        ext = storage.filename.rsplit('.', 1)[1].lower()
+        if ext == 'jpeg':
+            ext = 'jpg'
+        os.makedirs(root, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=root, suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = storage.stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+            name = '%s/%s.%s' % (digest.hexdigest()[:2], digest.hexdigest(), ext)
+            path = os.path.join(root, name)
+            if os.path.exists(path):
+                return name
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self._process(app, path, ext)
+        return name
+
+    def _process(self, app, path, ext):
+        if Image is None:
+            return
+        try:
+            with Image.open(path) as image:
+                width, height = image.size
+        except Exception:
+            app.logger.warning('Not an image: %s', path)
+            return
+        widths = app.config['BLUELOG_IMAGE_WIDTHS']
+        meta = dict(width=width, height=height, variants=_variants(width, widths, ext))
+        with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+            json.dump(meta, f)
+        args = (path, widths, app.config['BLUELOG_IMAGE_QUALITY'])
+        pool = self._pool(app)
+        if pool is None:
+            make_variants(*args)
+        else:
+            pool.submit(make_variants, *args)
+
+    def _pool(self, app):
+        workers = app.config['BLUELOG_IMAGE_WORKERS']
+        if not workers:
+            return None
+        state = app.extensions['image_store']
+        with state['lock']:
+            if state['pid'] != os.getpid():
+                state['pid'] = os.getpid()
+                state['pool'] = ProcessPoolExecutor(workers)
+        return state['pool']
+
+    def meta(self, name):
+        match = _hashed_re.match(name)
+        if match is None or match.group(3):
+            return None
+        path = os.path.join(current_app.config['BLUELOG_UPLOAD_PATH'], os.path.splitext(name)[0] + '.json')
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    # ---- 改写文章正文 ----
+
+    def rewrite(self, body):
+        """把正文中上传的图片改写为带 srcset 的 <picture>; 已经改写过的先还原, 可以重复调用"""
+        if not body:
+            return body
+        body = _picture_re.sub(lambda match: _srcset_re.sub('', match.group(1)), body)
+        return _img_re.sub(self._picture, body)
+
+    def _picture(self, match):
+        tag = match.group(0)
+        src = _src_re.search(tag)
+        # filename 不能为空, 用一个字符生成后去掉
+        prefix = url_for('admin.get_image', filename='_')[:-1]
+        if src is None or not src.group(1).startswith(prefix):
+            return tag
+        name = src.group(1)[len(prefix):]
+        meta = self.meta(name)
+        if not meta or not meta['variants']:
+            return tag
+        base, ext = name.rsplit('.', 1)
+
+        def url(width, extension):
+            filename = '%s.%s' % (base, extension) if width == meta['width'] else '%s-%d.%s' % (base, width, extension)
+            return url_for('admin.get_image', filename=filename)
+
+        def srcset(extension, original):
+            items = ['%s %dw' % (url(w, e), w) for w, e in meta['variants'] if e == extension]
+            if original:
+                items.append('%s %dw' % (src.group(1), meta['width']))
+            return ', '.join(items)
+
+        sizes = '(max-width: %dpx) 100vw, %dpx' % (meta['width'], meta['width'])
+        img = tag[:-1].rstrip('/').rstrip() + ' srcset="%s" sizes="%s">' % (escape(srcset(ext, True)), sizes)
+        return '<picture class="bluelog-image"><source type="image/webp" srcset="%s" sizes="%s">%s</picture>' % (
+            escape(srcset('webp', False)), sizes, img)
+
+    # ---- 发送 ----
+
+    def send(self, name):
+        app = current_app._get_current_object()
+        root = app.config['BLUELOG_UPLOAD_PATH']
+        match = _hashed_re.match(name)
+        if match is None:
+            # 旧的按原文件名保存的图片
+            return self._send(app, root, name)
+        if not os.path.exists(os.path.join(root, name)):
+            # 缩略图还没生成好, 先返回原图, 不缓存太久
+            original = self._original(root, match)
+            if original is None:
+                abort(404)
+            response = self._send(app, root, original)
+            response.cache_control.max_age = 60
+            return response
+        response = self._send(app, root, name)
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+        return response
+
+    @staticmethod
+    def _original(root, match):
+        directory = os.path.join(root, match.group(1))
+        for ext in current_app.config['BLUELOG_ALLOWED_IMAGE_EXTENSIONS']:
+            name = '%s.%s' % (match.group(2), ext)
+            if os.path.exists(os.path.join(directory, name)):
+                return '%s/%s' % (match.group(1), name)
+
+    @staticmethod
+    def _send(app, root, name):
+        if app.config['BLUELOG_SENDFILE'] == 'x-accel-redirect':
+            # 与 send_from_directory 一样拒绝 .. 和绝对路径, 前端服务器只会收到 root 之下存在的文件
+            filename = safe_join(root, name)
+            if filename is None or not os.path.isfile(filename):
+                abort(404)
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = app.config['BLUELOG_SENDFILE_PREFIX'] + \
+                os.path.relpath(filename, root).replace(os.sep, '/')
+            response.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            return response
+        # x-sendfile 由 Flask 的 USE_X_SENDFILE 处理
+        return send_from_directory(root, name)
+
+
+image_store = ImageStore()
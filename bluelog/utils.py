@@ -8,6 +8,9 @@
     @Software: PyCharm
 """
 
+import re
+from contextlib import nullcontext
+from html.parser import HTMLParser
 from urllib.parse import urlparse, urljoin
 from flask import request, redirect, url_for,current_app
 
@@ -31,3 +34,63 @@ def redirect_back(default='blog.index', **kwargs):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in current_app.config['BLUELOG_ALLOWED_IMAGE_EXTENSIONS']
 
+
+def site_url_context(app):
+    """配置了 BLUELOG_SITE_URL 时返回以它为根的请求上下文, 其中生成的绝对 URL 不取决于请求的 Host 头"""
+    site_url = app.config.get('BLUELOG_SITE_URL')
+    if site_url:
+        return app.test_request_context('/', base_url=site_url)
+    return nullcontext()
+
+
+class _TextExtractor(HTMLParser):
+    block_tags = {'p', 'div', 'br', 'li', 'ul', 'ol', 'tr', 'td', 'th', 'table', 'blockquote',
+                  'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'img'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self._skip += 1
+        elif tag in self.block_tags:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self._skip:
+            self._skip -= 1
+        elif tag in self.block_tags:
+            self.parts.append(' ')
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+# 将 CKEditor 生成的 HTML 转为纯文本, 连续空白合并为一个空格
+def html_to_text(html):
+    parser = _TextExtractor()
+    parser.feed(html or '')
+    parser.close()
+    return ' '.join(''.join(parser.parts).split())
+
+
+# 中日韩文字每个字算一个词, 其他文字按空白和标点分词
+_cjk = '\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_word_re = re.compile(r'[%s]|[^\W_%s]+' % (_cjk, _cjk))
+
+
+def count_words(text):
+    return len(_word_re.findall(text))
+
+
+# 与 jinja 的 truncate 过滤器行为一致: 尽量在空格处截断, 末尾加上省略号
+def make_excerpt(text, length=255, end='...'):
+    if len(text) <= length:
+        return text
+    excerpt = text[:length - len(end)]
+    if ' ' in excerpt[-20:]:
+        excerpt = excerpt.rsplit(' ', 1)[0]
+    return excerpt + end
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import pytest
+
+from bluelog import create_app
+from bluelog.extensions import db
+from bluelog.migrations import upgrade
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """按 TestingConfig 创建应用, 数据库和各种缓存文件都放在临时目录里"""
+    apps = []
+
+    def make(**overrides):
+        config = dict(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + str(tmp_path / 'data.db'),
+            BLUELOG_UPLOAD_PATH=str(tmp_path / 'uploads'),
+            BLUELOG_PAGE_CACHE_PATH=str(tmp_path / 'pages'),
+            BLUELOG_FEED_PATH=str(tmp_path / 'feeds'),
+            BLUELOG_SITEMAP_PATH=str(tmp_path / 'sitemaps'),
+            BLUELOG_EXPORT_PATH=str(tmp_path / 'export'),
+        )
+        config.update(overrides)
+        app = create_app('testing', config)
+        with app.app_context():
+            upgrade(echo=None)
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        with app.app_context():
+            db.session.remove()
+            db.get_engine(app).dispose()
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app()
+    with app.app_context():
+        yield app
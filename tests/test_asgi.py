@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import re
+import gzip
+import asyncio
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+import pytest
+
+from bluelog import fakes
+from bluelog.asgi import AsyncBlog
+from bluelog.models import Comment
+from bluelog.profiler import profiler
+
+
+@pytest.fixture
+def blog(make_app):
+    app = make_app(WTF_CSRF_ENABLED=True, BLUELOG_PROFILE=True, BLUELOG_PROFILE_LOG=None, BLUELOG_COMPRESS=True,
+                   BLUELOG_COMPRESS_MIN_SIZE=0)
+    with app.app_context():
+        fakes.fake_admin()
+        fakes.fake_categories(2)
+        fakes.fake_posts(3)
+    blog = AsyncBlog(app, workers=2)
+    yield blog
+    blog.executor.shutdown(wait=True)
+
+
+def call(blog, method, path, headers=(), body=b''):
+    """把一个 HTTP 请求交给 ASGI 应用, 返回 (状态码, 响应头列表, 正文)"""
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+             'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]}
+    asyncio.run(blog(scope, receive, send))
+    headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in messages[0]['headers']]
+    return messages[0]['status'], headers, messages[1]['body']
+
+
+def test_comment_round_trip(blog):
+    # 匿名读者的 GET 走异步路径, 页面里的 CSRF 令牌必须随会话 cookie 一起发出
+    status, headers, body = call(blog, 'GET', '/show/post/1')
+    assert status == 200
+    cookies = [value for name, value in headers if name.lower() == 'set-cookie']
+    assert cookies
+    token = re.search(rb'name="csrf_token" type="hidden" value="([^"]+)"', body).group(1).decode()
+    cookie = SimpleCookie(cookies[0])
+    cookie_header = '; '.join('%s=%s' % (name, morsel.value) for name, morsel in cookie.items())
+
+    form = urlencode(dict(name='Guest', email='guest@example.com', comment='Hello', csrf_token=token)).encode()
+    status, headers, body = call(blog, 'POST', '/show/post/1', body=form, headers=[
+        ('Content-Type', 'application/x-www-form-urlencoded'), ('Cookie', cookie_header)])
+    assert status == 302
+    with blog.app.app_context():
+        assert Comment.query.filter_by(author='Guest').count() == 1
+
+
+def test_comment_without_token_is_rejected(blog):
+    form = urlencode(dict(name='Guest', email='guest@example.com', comment='Hello')).encode()
+    status, headers, body = call(blog, 'POST', '/show/post/1', body=form,
+                                 headers=[('Content-Type', 'application/x-www-form-urlencoded')])
+    assert status == 400
+
+
+def test_async_requests_are_profiled(blog):
+    status, headers, body = call(blog, 'GET', '/show/post/1')
+    assert status == 200
+    records = profiler.records(blog.app)
+    assert [record['endpoint'] for record in records] == ['blog.show_post']
+    # 线程池中执行的查询也计入这次请求
+    assert records[0]['query_count'] > 0
+
+
+def test_async_responses_are_compressed(blog):
+    status, headers, body = call(blog, 'GET', '/', headers=[('Accept-Encoding', 'gzip')])
+    headers = dict(headers)
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    assert b'</html>' in gzip.decompress(body)
+
+
+def test_missing_post_skips_other_queries(blog, monkeypatch):
+    calls = []
+    query = blog._query
+
+    def record(environ, func, *args):
+        calls.append(func.__name__)
+        return query(environ, func, *args)
+
+    monkeypatch.setattr(blog, '_query', record)
+    status, headers, body = call(blog, 'GET', '/show/post/999')
+    assert status == 404
+    assert calls == ['load_post']
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import pytest
+
+from bluelog import fakes
+from bluelog.extensions import db
+from bluelog.models import Admin, Category, Comment, Post, rebuild_counters
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app()
+    with app.app_context():
+        fakes.fake_admin()
+        fakes.fake_categories(3, seed=1)
+        fakes.fake_posts(8, seed=1, workers=0)
+        fakes.fake_comments(60, seed=1, workers=0)
+        fakes.fake_reply(20, seed=1, workers=0)
+        rebuild_counters()
+        db.session.commit()
+    return app
+
+
+@pytest.fixture
+def admin(app):
+    client = app.test_client()
+    response = client.post('/auth/login', data=dict(username='admin', password='helloflask'))
+    assert response.status_code == 302
+    return client
+
+
+def counters():
+    db.session.remove()
+    return dict(
+        posts=db.session.query(Post.id, Post.comment_count, Post.reviewed_comment_count, Post.reply_count).order_by(
+            Post.id).all(),
+        categories=db.session.query(Category.id, Category.post_count).order_by(Category.id).all(),
+        unread=db.session.query(Admin.unread_comment_count).scalar(),
+    )
+
+
+def assert_consistent(app):
+    """增量维护的计数器必须和 rebuild_counters() 重新统计的结果一致"""
+    with app.app_context():
+        before = counters()
+        rebuild_counters()
+        db.session.commit()
+        assert counters() == before
+
+
+def unread_comment_ids(app, limit=None):
+    with app.app_context():
+        query = db.session.query(Comment.id).filter_by(reviewed=False, spam=False).order_by(Comment.id)
+        return [comment_id for comment_id, in query.limit(limit)]
+
+
+def test_create_comment_and_reply(app, admin):
+    guest = app.test_client()
+    response = guest.post('/show/post/1', data=dict(name='Guest', email='guest@example.com', comment='Hello'))
+    assert response.status_code == 302
+    response = admin.post('/show/post/2', data=dict(comment='Hello from admin'))
+    assert response.status_code == 302
+    response = guest.post('/reply/form/1', data=dict(name='Guest', email='guest@example.com', comment='Reply'))
+    assert response.status_code == 302
+    assert_consistent(app)
+
+
+def test_approve_and_delete(app, admin):
+    first, second = unread_comment_ids(app, 2)
+    assert admin.post('/admin/manage/approve/%d' % first).status_code == 302
+    assert admin.post('/admin/delete/comment/%d' % first).status_code == 302
+    assert admin.post('/admin/delete/comment/%d' % second).status_code == 302
+    # 带回复的已审核评论
+    with app.app_context():
+        comment_id = db.session.query(Comment.id).filter(Comment.reviewed == True, Comment.replies.any()).first()[0]
+    assert admin.post('/admin/delete/comment/%d' % comment_id).status_code == 302
+    assert_consistent(app)
+
+
+@pytest.mark.parametrize('action', ['approve', 'spam', 'delete'])
+def test_bulk_moderation(app, admin, action):
+    ids = unread_comment_ids(app, 3) + [1, 2, 3]
+    response = admin.post('/admin/manage/comment/bulk', data=dict(action=action, ids=ids))
+    assert response.status_code == 302
+    response = admin.post('/admin/manage/comment/bulk', data=dict(action=action, post_id=4, filter='all'))
+    assert response.status_code == 302
+    assert_consistent(app)
+
+
+def test_category_merge_and_delete(app, admin):
+    response = admin.post('/admin/merge/category/2', data=dict(target=3))
+    assert response.status_code == 302
+    assert_consistent(app)
+    assert admin.post('/admin/delete/category/3').status_code == 302
+    assert_consistent(app)
+    with app.app_context():
+        assert Category.query.get(3) is None
+        assert sum(category.post_count for category in Category.query) == Post.query.count()
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import socket
+import socketserver
+import threading
+from datetime import datetime, timedelta
+from email import message_from_bytes, policy
+
+import pytest
+
+from bluelog.emails import outbox, send_mail
+from bluelog.extensions import db
+from bluelog.models import OutboxMessage
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """只实现 smtplib 发信用到的几条命令, 收到的邮件放进 server.messages"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii').strip().split(' ', 1)[0].upper()
+            if command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                for line in iter(self.rfile.readline, b'.\r\n'):
+                    lines.append(line[1:] if line.startswith(b'..') else line)
+                self.server.messages.append((recipients, message_from_bytes(b''.join(lines), policy=policy.default)))
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                recipients.append(line.decode('ascii').split(':', 1)[1].strip().strip('<>'))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 localhost')
+
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPHandler)
+    server.daemon_threads = True
+    server.messages = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def mail_config(port, **overrides):
+    config = dict(MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_USE_SSL=False, MAIL_USE_TLS=False,
+                  MAIL_SUPPRESS_SEND=False, MAIL_DEFAULT_SENDER=('Bluelog', 'blog@example.com'))
+    config.update(overrides)
+    return config
+
+
+@pytest.fixture
+def app(make_app, smtp_server):
+    app = make_app(**mail_config(smtp_server.server_address[1]))
+    with app.app_context():
+        yield app
+
+
+def test_send_batch_delivers(app, smtp_server):
+    for i in range(3):
+        send_mail('Hello %d' % i, 'reader%d@example.com' % i, '<p>Hello</p>')
+    assert outbox.send_batch(app) == 3
+    assert outbox.send_batch(app) == 0
+
+    assert sorted((recipients, message['Subject']) for recipients, message in smtp_server.messages) == [
+        (['reader0@example.com'], 'Hello 0'), (['reader1@example.com'], 'Hello 1'),
+        (['reader2@example.com'], 'Hello 2')]
+    assert OutboxMessage.query.filter(OutboxMessage.sent_at == None).count() == 0
+
+
+def test_digest_merging(app, smtp_server):
+    send_mail('1 new comment', 'admin@example.com', '<p>1</p>', digest_key='comment:1')
+    send_mail('2 new comments', 'admin@example.com', '<p>2</p>', digest_key='comment:1')
+    message = OutboxMessage.query.one()
+    assert message.count == 2
+    assert outbox.send_batch(app) == 1
+    assert [message['Subject'] for recipients, message in smtp_server.messages] == ['2 new comments']
+
+    # 合并窗口内的下一封要等到窗口结束才发送
+    send_mail('3 new comments', 'admin@example.com', '<p>3</p>', digest_key='comment:1')
+    pending = OutboxMessage.query.filter(OutboxMessage.sent_at == None).one()
+    assert pending.send_after >= message.sent_at + timedelta(minutes=app.config['BLUELOG_MAIL_DIGEST_WINDOW'])
+    assert outbox.send_batch(app) == 0
+    assert outbox.flush(app) == 1
+    assert len(smtp_server.messages) == 2
+
+
+def test_refused_connection_backs_off(make_app):
+    # 先占用一个端口再关闭, 连接会被拒绝
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    app = make_app(**mail_config(port, BLUELOG_MAIL_RETRY_DELAY=60, BLUELOG_MAIL_MAX_ATTEMPTS=3))
+    with app.app_context():
+        send_mail('Hello', 'reader@example.com', '<p>Hello</p>')
+        for attempts, delay in [(1, 60), (2, 120)]:
+            start = datetime.utcnow()
+            assert outbox.send_batch(app) == 1
+            message = OutboxMessage.query.one()
+            assert (message.attempts, message.failed, message.sent_at) == (attempts, False, None)
+            assert message.last_error.startswith('ConnectionRefusedError')
+            assert start + timedelta(seconds=delay) <= message.send_after <= \
+                datetime.utcnow() + timedelta(seconds=delay)
+            # 退避期间不会再次领取
+            assert outbox.send_batch(app) == 0
+            message.send_after = datetime.utcnow()
+            db.session.commit()
+
+        assert outbox.send_batch(app) == 1
+        message = OutboxMessage.query.one()
+        assert (message.attempts, message.failed) == (3, True)
+        assert outbox.send_batch(app) == 0
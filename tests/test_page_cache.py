@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import re
+
+import pytest
+from sqlalchemy import event
+
+from bluelog import fakes
+from bluelog.caching import PageCache
+from bluelog.extensions import db
+from bluelog.models import Post
+from bluelog.signals import post_changed, comment_changed
+
+TOKEN_RE = re.compile(rb'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+@pytest.fixture(params=['memory', 'filesystem'])
+def app(make_app, request):
+    app = make_app(BLUELOG_PAGE_CACHE=request.param, WTF_CSRF_ENABLED=True)
+    with app.app_context():
+        fakes.fake_admin()
+        fakes.fake_categories(2)
+        fakes.fake_posts(3)
+        # 文章 1 在分类 1, 文章 2 在分类 2, 失效时才能区分
+        Post.query.get(1).category_id = 1
+        Post.query.get(2).category_id = 2
+        db.session.commit()
+    return app
+
+
+@pytest.fixture
+def get(app):
+    """发起 GET 请求, 返回 (响应, 期间执行的 SQL 条数)"""
+    statements = []
+    with app.app_context():
+        engine = db.get_engine(app)
+
+    def count(*args):
+        statements.append(args[2])
+
+    event.listen(engine, 'before_cursor_execute', count)
+
+    def get(url, client=None):
+        del statements[:]
+        response = (client or app.test_client()).get(url)
+        return response, len(statements)
+
+    yield get
+    event.remove(engine, 'before_cursor_execute', count)
+
+
+PAGES = ['/about', '/', '/show/post/1', '/show/post/2', '/show/category/1', '/show/category/2']
+
+
+def hits(get):
+    """依次访问 PAGES, 返回每个页面是否命中缓存 (没有执行 SQL)"""
+    result = {}
+    for url in PAGES:
+        response, queries = get(url)
+        assert response.status_code == 200, url
+        result[url] = queries == 0
+    return result
+
+
+def test_anonymous_get_is_cached(get):
+    for url in PAGES:
+        response, queries = get(url)
+        assert response.status_code == 200
+        assert queries > 0, url
+        response, queries = get(url)
+        assert response.status_code == 200
+        assert queries == 0, url
+
+
+def test_csrf_token_is_substituted(app, get):
+    first, second = app.test_client(), app.test_client()
+    response, queries = get('/show/post/1', first)
+    token = TOKEN_RE.search(response.data).group(1)
+
+    response, queries = get('/show/post/1', second)
+    assert queries == 0
+    assert PageCache.CSRF_PLACEHOLDER not in response.data
+    other = TOKEN_RE.search(response.data).group(1)
+    assert other != token
+
+    # 替换进去的令牌属于当前会话, 可以直接用来提交评论
+    response = second.post('/show/post/1', data=dict(
+        name='Guest', email='guest@example.com', comment='Hello', csrf_token=other.decode()))
+    assert response.status_code == 302
+
+
+def test_post_changed_evicts_post_category_and_index(app, get):
+    hits(get)
+    assert all(hits(get).values())
+    with app.app_context():
+        post_changed.send(app, post_id=1, category_ids=[1])
+    assert hits(get) == {'/': False, '/show/post/1': False, '/show/post/2': True,
+                         '/show/category/1': False, '/show/category/2': True, '/about': True}
+
+
+def test_comment_changed_evicts_post_category_and_index(app, get):
+    hits(get)
+    assert all(hits(get).values())
+    with app.app_context():
+        comment_changed.send(app, post_id=2, category_id=2)
+    assert hits(get) == {'/': False, '/show/post/1': True, '/show/post/2': False,
+                         '/show/category/1': True, '/show/category/2': False, '/about': True}
@@ -0,0 +1,20 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+    @Time    : 2020/6/1 11:42
+    @Author  : David Ben
+    @FileName: __init__.py.py
+    @Email: hsudavid@163.com
+    @Software: PyCharm
+"""
+
+import pytest
+
+from bluelog.migrations import HOT_QUERIES, explain, full_scans
+
+
+@pytest.mark.parametrize('item', HOT_QUERIES, ids=[item[0] for item in HOT_QUERIES])
+def test_hot_queries_use_indexes(app, item):
+    name, factory, index_scan = (item + (False,))[:3]
+    plan = explain(factory())
+    assert full_scans(plan, index_scan) == [], plan